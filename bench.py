@@ -0,0 +1,532 @@
+"""Нагрузочный прогон бота без Telegram.
+
+Настоящее приложение из main.build_application() получает обновления
+напрямую через process_update, а запросы к Bot API уходят в FakeBotAPI
+(tests/fake_bot_api.py) — подменённый транспорт, который хранит сообщения чатов в памяти. N чатов
+параллельно проходят /tournament и /random_tournament до конца и листают
+историю; для каждого размера истории (заранее заполненной) запускается
+отдельный процесс в чистом временном каталоге.
+
+С --transport webhook обновления идут как от Telegram: POST-запросами в
+настоящий WebhookServer на локальном порту, через очередь и
+PerChatUpdateProcessor; задержка считается от запроса до конца обработки.
+
+С --telegram-limits исходящие идут через OutboundDispatcher с настоящими
+лимитами Telegram, а поддельный API с вероятностью --flood отвечает 429:
+так видно ожидание в очереди чата, схлопывание правок и повторы.
+
+    python bench.py --chats 20 --sizes 10,1000,100000 --output bench_output.txt
+    python bench.py --transport webhook --sizes 1000
+    python bench.py --telegram-limits --flood 0.05 --group-chats --transport webhook --chats 10 --sizes 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+# Поддельный Bot API общий с тестами
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests"))
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+# Лимиты исходящих, которые снимаются для замера обработчиков
+OUTBOUND_LIMITS = ("OUTBOUND_GLOBAL_RATE", "OUTBOUND_CHAT_RATE", "OUTBOUND_GROUP_RATE", "OUTBOUND_CHAT_BURST")
+
+BENCH_ENV = {
+    # Без лимитов Telegram (если не задан --telegram-limits) и с короткой
+    # задержкой правки сетки: меряем обработчики, а не ожидание
+    "OUTBOUND_GLOBAL_RATE": "1000000",
+    "OUTBOUND_CHAT_RATE": "1000000",
+    "OUTBOUND_GROUP_RATE": "1000000",
+    "OUTBOUND_CHAT_BURST": "1000000",
+    "BRACKET_EDIT_DELAY": "0.01",
+    "HISTORY_COMPACT_INTERVAL": "0",
+    "PERSISTENCE_INTERVAL": "5",
+    "METRICS_PORT": "0",
+    "METRICS_LOG_INTERVAL": "0",
+    "BOT_MODE": "polling",
+}
+
+PLAYER_POOL = [f"Игрок{i}" for i in range(300)]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# ======================
+# Поддельный Telegram для webhook
+# ======================
+
+WEBHOOK_PATH = "/bench"
+WEBHOOK_SECRET = "bench-secret"
+
+# Шлёт обновления POST-запросами по одному keep-alive соединению, как
+# Telegram; на 429 ждёт Retry-After и повторяет
+class WebhookPoster:
+    def __init__(self, port: int):
+        self.port = port
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, body: bytes) -> tuple:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self._writer.write(
+            f"POST {WEBHOOK_PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {WEBHOOK_SECRET}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+        )
+        await self._writer.drain()
+        status = int((await self._reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        await self._reader.readexactly(int(headers.get("content-length", "0")))
+        return status, headers
+
+    async def post(self, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        while True:
+            status, headers = await self.request(body)
+            if status != 429:
+                break
+            await asyncio.sleep(float(headers.get("retry-after", "1")))
+        if status != 200:
+            raise RuntimeError(f"webhook ответил {status}")
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+# Конец обработки обновления: обработчик в последней группе будит того,
+# кто прислал обновление
+class UpdateWaiters:
+    def __init__(self):
+        self.futures: Dict[int, asyncio.Future] = {}
+
+    def expect(self, update_id: int) -> asyncio.Future:
+        future = self.futures[update_id] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def done(self, update, context):
+        future = self.futures.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+
+# Запросы, которые сервер обязан отклонить с 400, а не оборвать соединение
+WEBHOOK_BAD_BODIES = [b"[1, 2]", b"null", b"{}", b'{"update_id": "x", "message": 5}', b"{not json"]
+
+async def check_webhook_errors(port: int):
+    poster = WebhookPoster(port)
+    try:
+        for body in WEBHOOK_BAD_BODIES:
+            status, _ = await poster.request(body)
+            if status != 400:
+                raise RuntimeError(f"webhook: на {body!r} ответ {status} вместо 400")
+    finally:
+        await poster.close()
+
+
+def callbacks(message: dict) -> List[str]:
+    markup = message.get("reply_markup") or {}
+    return [button.get("callback_data", "") for row in markup.get("inline_keyboard", []) for button in row]
+
+
+# ======================
+# Чат-пользователь
+# ======================
+
+# Один чат: шлёт обновления по одному и меряет время process_update
+# (или, через webhook, от запроса до конца обработки)
+class ChatClient:
+    update_ids = iter(range(1, 10 ** 9))
+
+    def __init__(self, application, api, chat_id: int, rng: random.Random, latencies: Dict[str, List[float]],
+                 poster: Optional[WebhookPoster] = None, waiters: Optional[UpdateWaiters] = None):
+        self.application = application
+        self.poster = poster
+        self.waiters = waiters
+        self.api = api
+        self.chat_id = chat_id
+        self.rng = rng
+        self.latencies = latencies
+        self.user = {"id": abs(chat_id), "is_bot": False, "first_name": f"U{abs(chat_id)}"}
+        self.chat = {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}
+        self.message_ids = iter(range(10 ** 6, 10 ** 9))
+
+    async def _process(self, label: str, data: dict) -> str:
+        from telegram import Update
+        started = time.perf_counter()
+        if self.poster is not None:
+            done = self.waiters.expect(data["update_id"])
+            await self.poster.post(data)
+            await done
+        else:
+            update = Update.de_json(data, self.application.bot)
+            started = time.perf_counter()
+            await self.application.process_update(update)
+        self.latencies.setdefault(label, []).append(time.perf_counter() - started)
+        return label
+
+    async def text(self, label: str, text: str):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": self.chat, "from": self.user, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        await self._process(label, {"update_id": next(self.update_ids), "message": message})
+
+    async def click(self, label: str, message: dict, data: str):
+        query = {"id": str(next(self.update_ids)), "from": self.user, "chat_instance": str(self.chat_id),
+                 "data": data, "message": message}
+        await self._process(label, {"update_id": next(self.update_ids), "callback_query": query})
+
+    def last_message(self) -> dict:
+        return self.api.messages(self.chat_id)[-1]
+
+    def bracket(self) -> Optional[dict]:
+        for message in reversed(self.api.messages(self.chat_id)):
+            if any(data.startswith("match_") for data in callbacks(message)):
+                return message
+        return None
+
+    def finished_since(self, count: int) -> bool:
+        return any("🏆" in m["text"] for m in self.api.messages(self.chat_id)[count:])
+
+    async def play(self):
+        start = len(self.api.messages(self.chat_id))
+        while True:
+            message = await self._wait_bracket(start)
+            if message is None:
+                return
+            data = next(d for d in callbacks(message) if d.startswith("match_"))
+            await self.click("match", message, data)
+            s1, s2 = self.rng.sample(range(6), 2)
+            seen = len(self.api.messages(self.chat_id))
+            await self.text("result", f"{s1}:{s2}")
+            if self.finished_since(seen):
+                # Последний результат: сохранение турнира в историю
+                self.latencies["result_final"] = self.latencies.setdefault("result_final", [])
+                self.latencies["result_final"].append(self.latencies["result"].pop())
+                return
+            message_id = message["message_id"]
+            await self.api.wait(self.chat_id, lambda: data not in callbacks(
+                self.api.chats[self.chat_id][message_id]))
+
+    async def _wait_bracket(self, start: int) -> Optional[dict]:
+        await self.api.wait(self.chat_id, lambda: self.bracket() is not None or self.finished_since(start))
+        return None if self.finished_since(start) else self.bracket()
+
+    async def tournament(self, name: str, fmt: str, teams: int):
+        await self.text("/tournament", f"/tournament {name}")
+        if fmt != "single":
+            await self.click("fmt", self.last_message(), f"fmt_{fmt}")
+        await self.text("size", str(teams))
+        for i in range(teams):
+            players = self.rng.sample(PLAYER_POOL, 3)
+            await self.text("team", "\n".join([f"{name} К{i + 1}"] + players))
+        await self.play()
+
+    async def random_tournament(self, name: str, fmt: str, players: int):
+        await self.text("/random_tournament", f"/random_tournament {name}")
+        if fmt != "single":
+            await self.click("rfmt", self.last_message(), f"rfmt_{fmt}")
+        await self.text("random_size", str(players))
+        for player in self.rng.sample(PLAYER_POOL, players):
+            await self.text("player", player)
+        await self.play()
+
+    async def browse_history(self):
+        await self.text("/historytournament", "/historytournament")
+        listing = self.last_message()
+        views = [d for d in callbacks(listing) if d.startswith("view_")]
+        if not views:
+            return
+        await self.click("view", listing, self.rng.choice(views))
+        page = self.api.chats[self.chat_id][listing["message_id"]]
+        following = [d for d in callbacks(page) if d.startswith("tpage_")]
+        if len(following) > 1:
+            await self.click("tpage", page, following[-1])
+        await self.click("back", page, "back_to_history")
+        if "hpage_1" in callbacks(self.api.chats[self.chat_id][listing["message_id"]]):
+            await self.click("hpage", listing, "hpage_1")
+        await self.text("/stats", f"/stats {self.rng.choice(PLAYER_POOL)}")
+        await self.text("/leaderboard", "/leaderboard")
+
+
+# ======================
+# Предзаполнение истории
+# ======================
+
+def history_templates(rng: random.Random) -> list:
+    import main
+    templates = []
+    for fmt in main.SCHEDULERS:
+        for size in (4, 6, 8):
+            state = {"teams": [{"name": str(i), "players": []} for i in range(size)],
+                     "seed": rng.randrange(2 ** 32)}
+            scheduler = main.SCHEDULERS[fmt].create(state)
+            main.init_result_log(state)
+            while not scheduler.finished():
+                stage, pos = next((s, p) for s, stage in enumerate(scheduler.stages)
+                                  for p, match in enumerate(stage) if match.playable)
+                s1, s2 = rng.sample(range(6), 2)
+                scheduler, _ = main.log_result(state, stage, pos, s1, s2)
+            templates.append((fmt, state["seed"], scheduler.stages, scheduler.placements(), state["events"]))
+    return templates
+
+# Турниры за последние два года с id по времени, как их выдаёт бот
+def preload_history(count: int, rng: random.Random, chunk: int = 2000) -> float:
+    import main
+    templates = [(fmt, seed, stages, places, events, _team_count(stages))
+                 for fmt, seed, stages, places, events in history_templates(rng)]
+    now = datetime.now()
+    stamps = sorted(now - timedelta(seconds=rng.uniform(3600, 730 * 86400)) for _ in range(count))
+    store = main.open_history_store()
+    started = time.perf_counter()
+    ops = []
+    for k, stamp in enumerate(stamps):
+        fmt, seed, stages, places, events, size = rng.choice(templates)
+        teams = [{"name": f"Команда {rng.randrange(500)}", "players": rng.sample(PLAYER_POOL, 3)}
+                 for _ in range(size)]
+        tid = str(int(stamp.timestamp() * 1000) * 1000 + k % 1000)
+        record = main.encode_tournament(f"Турнир {k}", stamp.strftime(main.HISTORY_DATE_FORMAT),
+                                        teams, stages, seed, fmt, places, events)
+        ops.append(("put", tid, record))
+        if len(ops) >= chunk:
+            store.apply_batch(ops)
+            ops = []
+    if ops:
+        store.apply_batch(ops)
+    store.close()
+    return time.perf_counter() - started
+
+def _team_count(stages) -> int:
+    teams = set()
+    for stage in stages:
+        for match in stage:
+            teams.update(t for t in (match.t1, match.t2) if t is not None)
+    return max(teams) + 1
+
+
+# ======================
+# Прогон одного размера истории
+# ======================
+
+async def run_worker(args) -> dict:
+    import main
+    rng = random.Random(args.seed)
+    report = {"history": args.size, "chats": args.chats}
+    report["rss_start_mb"] = rss_mb()
+    report["preload_s"] = preload_history(args.size, rng) if args.size else 0.0
+
+    main.metrics.enabled = True
+    api = FakeBotAPI(args.api_latency / 1000, args.flood, args.seed)
+    application = main.build_application("1:bench", request=api)
+    waiters = server = None
+    if args.transport == "webhook":
+        from telegram import Update
+        from telegram.ext import TypeHandler
+        waiters = UpdateWaiters()
+        application.add_handler(TypeHandler(Update, waiters.done), group=10 ** 6)
+        server = main.WebhookServer(application, host="127.0.0.1", port=0,
+                                    path=WEBHOOK_PATH, secret=WEBHOOK_SECRET)
+    await application.initialize()
+    report["rss_before_mb"] = rss_mb()
+
+    await main.history_service.start()
+    started = time.perf_counter()
+    await main.history_service.compact()
+    report["compact_s"] = time.perf_counter() - started
+    started = time.perf_counter()
+    await main.history_service.index()
+    report["index_s"] = time.perf_counter() - started
+    started = time.perf_counter()
+    await main.load_history_aggregates()
+    report["aggregates_s"] = time.perf_counter() - started
+    report["rss_loaded_mb"] = rss_mb()
+
+    await application.start()
+    if server is not None:
+        await server.start()
+        await check_webhook_errors(server.port)
+    latencies: Dict[str, List[float]] = {}
+    formats = list(main.SCHEDULERS)
+
+    async def chat_session(i: int):
+        poster = WebhookPoster(server.port) if server is not None else None
+        chat_id = -(10_000 + i) if args.group_chats else 10_000 + i
+        client = ChatClient(application, api, chat_id, random.Random(args.seed + i), latencies,
+                            poster, waiters)
+        for round_no in range(args.rounds):
+            fmt = formats[(i + round_no) % len(formats)]
+            await client.tournament(f"Кубок {i}-{round_no}", fmt, args.teams)
+            await client.random_tournament(f"Рандом {i}-{round_no}", fmt, args.players)
+            await client.browse_history()
+        if poster is not None:
+            await poster.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(chat_session(i) for i in range(args.chats)))
+    wall = time.perf_counter() - started
+    report["rss_end_mb"] = rss_mb()
+
+    if server is not None:
+        await server.stop()
+    await application.stop()
+    await main.stop_services(application)
+    await application.shutdown()
+
+    # Повторный запуск: агрегаты берутся из снимка, сохранённого при остановке
+    await main.history_service.start()
+    started = time.perf_counter()
+    await main.load_history_aggregates()
+    report["aggregates_warm_s"] = time.perf_counter() - started
+    await main.history_service.stop()
+
+    every = [value for values in latencies.values() for value in values]
+    report["updates"] = len(every)
+    report["wall_s"] = wall
+    report["updates_per_s"] = len(every) / wall if wall else 0.0
+    report["p50_ms"] = percentile(every, 0.5) * 1000
+    report["p99_ms"] = percentile(every, 0.99) * 1000
+    report["handlers"] = {
+        label: {"n": len(values), "p50_ms": percentile(values, 0.5) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000}
+        for label, values in sorted(latencies.items())
+    }
+    report["api_calls"] = api.calls
+    dispatcher = application.bot.rate_limiter
+    report["outbound"] = {"sent": dispatcher.sent, "coalesced": dispatcher.coalesced,
+                          "retries": dispatcher.retries, "flooded": api.flooded}
+    report["history_io"] = {
+        value: {"n": h.count, "mean_ms": h.total / h.count * 1000}
+        for (name, _, value), h in main.metrics.histograms.items()
+        if name == "bot_history_io_seconds" and h.count
+    }
+    return report
+
+
+def spawn_worker(args, size: int) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--size", str(size),
+               "--chats", str(args.chats), "--rounds", str(args.rounds), "--teams", str(args.teams),
+               "--players", str(args.players), "--api-latency", str(args.api_latency),
+               "--seed", str(args.seed), "--transport", args.transport, "--flood", str(args.flood)]
+    if args.group_chats:
+        command.append("--group-chats")
+    env = dict(os.environ, **BENCH_ENV)
+    if args.telegram_limits:
+        for name in OUTBOUND_LIMITS:
+            env.pop(name, None)
+    env["HISTORY_BACKEND"] = args.backend
+    if args.transport == "webhook":
+        env["BOT_MODE"] = "webhook"
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__)) + os.pathsep + env.get("PYTHONPATH", "")
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"история {size}: прогон упал\n{result.stderr[-4000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def format_report(reports: List[dict], args) -> str:
+    lines = [
+        f"bench: {args.chats} чатов × {args.rounds} раунд(а), {args.teams} команд, "
+        f"{args.players} игроков, хранилище {args.backend}, задержка API {args.api_latency} мс, "
+        f"транспорт {args.transport}"
+        + (f", лимиты Telegram, 429 с вероятностью {args.flood}" if args.telegram_limits else "")
+        + (", группы" if args.group_chats else ""),
+        "",
+        f"{'история':>8} {'запись,с':>9} {'сжатие,с':>9} {'индекс,с':>9} {'агрег.,с':>9} {'повт.,с':>8} {'обновл.':>8} "
+        f"{'обн/с':>8} {'p50,мс':>7} {'p99,мс':>7} {'сохр. p99':>9} {'история p99':>11} {'RSS, МБ':>16}",
+    ]
+    for r in reports:
+        handlers = r["handlers"]
+        final = handlers.get("result_final", {}).get("p99_ms", 0.0)
+        history = max(handlers.get(k, {}).get("p99_ms", 0.0) for k in ("/historytournament", "view", "hpage"))
+        lines.append(
+            f"{r['history']:>8} {r['preload_s']:>9.2f} {r['compact_s']:>9.2f} {r['index_s']:>9.3f} {r['aggregates_s']:>9.2f} "
+            f"{r['aggregates_warm_s']:>8.3f} {r['updates']:>8} {r['updates_per_s']:>8.0f} {r['p50_ms']:>7.2f} {r['p99_ms']:>7.2f} "
+            f"{final:>9.2f} {history:>11.2f} {r['rss_before_mb']:>6.0f}→{r['rss_end_mb']:<6.0f}"
+        )
+    for r in reports:
+        lines += ["", f"история {r['history']}: обработчики (n, p50/p99 мс)"]
+        for label, h in r["handlers"].items():
+            lines.append(f"  {label:<20} {h['n']:>6} {h['p50_ms']:>8.2f} {h['p99_ms']:>8.2f}")
+        io = ", ".join(f"{op} {h['mean_ms']:.2f} мс ×{h['n']}" for op, h in sorted(r["history_io"].items()))
+        lines.append(f"  хранилище: {io or 'нет операций'}")
+        out = r["outbound"]
+        lines.append(f"  исходящие: отправлено {out['sent']}, схлопнуто правок {out['coalesced']}, "
+                     f"повторов {out['retries']} (429 от API: {out['flooded']})")
+        lines.append(f"  память: старт {r['rss_start_mb']:.0f}, после загрузки истории {r['rss_loaded_mb']:.0f}, "
+                     f"в конце {r['rss_end_mb']:.0f} МБ")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота с поддельным Bot API")
+    parser.add_argument("--chats", type=int, default=20, help="одновременных чатов")
+    parser.add_argument("--rounds", type=int, default=1, help="сколько раз каждый чат проходит сценарий")
+    parser.add_argument("--teams", type=int, default=8, help="команд в обычном турнире")
+    parser.add_argument("--players", type=int, default=12, help="игроков в рандом-турнире")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000", help="размеры истории через запятую")
+    parser.add_argument("--backend", default="log", choices=("log", "sqlite"))
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--transport", default="direct", choices=("direct", "webhook"),
+                        help="direct — process_update, webhook — POST в WebhookServer")
+    parser.add_argument("--telegram-limits", action="store_true", help="настоящие лимиты исходящих")
+    parser.add_argument("--flood", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument("--group-chats", action="store_true", help="чаты — группы (лимит 20 в минуту)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для отчёта (например bench_output.txt)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        report = asyncio.run(run_worker(args))
+        print(json.dumps(report))
+        return
+
+    reports = []
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        print(f"история {size}...", file=sys.stderr, flush=True)
+        reports.append(spawn_worker(args, size))
+    text = format_report(reports, args)
+    print(text, end="")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,51 @@
+import asyncio
+import bisect
+import copy
+import csv
+import io
+import gzip
+import hashlib
+import hmac
+import html
 import json
 import os
 import random
+import re
 import logging
-from datetime import datetime
-from typing import List, Optional
+import multiprocessing
+import signal
+import sqlite3
+import ssl
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache, wraps
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 from telegram import (
     Update,
+    ForceReply,
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
     ConversationHandler
@@ -37,21 +67,1022 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 SELECT_SIZE, COLLECTING_TEAMS, ENTERING_RESULT = range(3)
 SELECT_RANDOM_SIZE, COLLECTING_RANDOM_PLAYERS = range(3, 5)
 
-HISTORY_FILE = "tournaments.json"
+HISTORY_FILE = "tournaments.json"  # старый формат, переносится мигратором
+
+# Хранилище истории: "log" — append-only журналы по месяцам, "sqlite" — база SQLite
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "log")
+HISTORY_DIR = os.environ.get("HISTORY_DIR", "history")
+HISTORY_LOG_FILE = os.environ.get("HISTORY_LOG_FILE", "tournaments.log")  # единый журнал, переносится в HISTORY_DIR
+HISTORY_DB_FILE = os.environ.get("HISTORY_DB_FILE", "tournaments.db")
+# Сколько последних месяцев остаются открытыми журналами; более старые
+# сжимаются в архив раз в HISTORY_COMPACT_INTERVAL секунд
+HISTORY_HOT_MONTHS = int(os.environ.get("HISTORY_HOT_MONTHS", "2"))
+HISTORY_COMPACT_INTERVAL = float(os.environ.get("HISTORY_COMPACT_INTERVAL", str(6 * 60 * 60)))
+# Сколько отрисованных карточек турниров держать в памяти
+HISTORY_RENDER_CACHE_SIZE = int(os.environ.get("HISTORY_RENDER_CACHE_SIZE", "256"))
+HISTORY_PAGE_SIZE = 10
+# Запас под разметку кнопок и заголовок продолжения в пределах лимита Telegram
+DETAILS_PAGE_LIMIT = MessageLimit.MAX_TEXT_LENGTH - 96
+
+# Ограничения исходящих запросов (по правилам Telegram: ~30 сообщений в секунду
+# на бота, ~1 в секунду в личный чат и ~20 в минуту в группу)
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+
+# Режим получения обновлений: "polling" (по умолчанию) или "webhook".
+# Telegram доставляет webhook только по HTTPS (порты 443, 80, 88, 8443):
+# либо бот сам слушает TLS с WEBHOOK_CERT/WEBHOOK_KEY, либо перед ним
+# стоит обратный прокси, который снимает TLS, — тогда бот по умолчанию
+# слушает только 127.0.0.1
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com/telegram
+WEBHOOK_CERT = os.environ.get("WEBHOOK_CERT", "")  # PEM-сертификат (цепочка) для TLS без прокси
+WEBHOOK_KEY = os.environ.get("WEBHOOK_KEY", "")  # закрытый ключ к WEBHOOK_CERT
+WEBHOOK_SELF_SIGNED = os.environ.get("WEBHOOK_SELF_SIGNED", "") == "1"  # отправить сертификат в setWebhook
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0" if WEBHOOK_CERT else "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Больше обновление Telegram не бывает; тело крупнее отклоняется с 413
+WEBHOOK_MAX_BODY = int(os.environ.get("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+# Сколько секунд ждать заголовков и тела запроса и сколько держать
+# простаивающее keep-alive соединение
+HTTP_REQUEST_TIMEOUT = float(os.environ.get("HTTP_REQUEST_TIMEOUT", "10"))
+HTTP_IDLE_TIMEOUT = float(os.environ.get("HTTP_IDLE_TIMEOUT", "60"))
+# Сколько обновлений может одновременно обрабатываться (в обоих режимах)
+# и ждать в очереди webhook
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "64"))
+# Сколько соединений Telegram держит к webhook (1–100): столько обновлений
+# он доставляет параллельно. Больше MAX_CONCURRENT_UPDATES ставить
+# незачем — лишние будут ждать в очереди
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_PENDING = int(os.environ.get("WEBHOOK_MAX_PENDING", "1000"))
+
+# Метрики: порт локального эндпоинта /metrics (0 — выключен) и период
+# сводки в лог в секундах (0 — без сводки)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.environ.get("METRICS_LOG_INTERVAL", "0"))
+
+# Состояние незавершённых турниров (user_data и шаги диалогов)
+PERSISTENCE_FILE = os.environ.get("PERSISTENCE_FILE", "state.db")
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "5"))
+HISTORY_DATE_FORMAT = "%d.%m.%Y %H:%M"
+
+# Экспорт турниров: процессов отрисовки (0 — в потоке по умолчанию) и
+# сколько готовых файлов держать в памяти
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", str(min(2, os.cpu_count() or 1))))
+EXPORT_CACHE_SIZE = int(os.environ.get("EXPORT_CACHE_SIZE", "64"))
 
 # ======================
-# Вспомогательные функции
+# Метрики
 # ======================
 
-def load_history() -> dict:
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+# Гистограммы задержек и счётчики: по обработчикам, вызовам Bot API и
+# операциям хранилища истории. При METRICS_PORT=0 и METRICS_LOG_INTERVAL=0
+# метрики выключены: обработчики не оборачиваются, а остальные места
+# проверяют один флаг.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    # Оценка квантиля сверху: верхняя граница корзины, где он лежит
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(METRIC_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    HELP = {
+        "bot_handler_seconds": "Время работы обработчика",
+        "bot_telegram_api_seconds": "Время запроса к Bot API, включая ожидание лимитов",
+        "bot_history_io_seconds": "Время операции хранилища истории",
+        "bot_export_seconds": "Время отрисовки экспорта",
+        "bot_updates_total": "Полученные обновления",
+        "bot_handler_errors_total": "Исключения в обработчиках",
+        "bot_telegram_retries_total": "Повторы после RetryAfter",
+        "bot_history_summary_loads_total": "Загрузки сводок истории из хранилища",
+        "bot_history_render_cache_hits_total": "Попадания в кэш отрисованных страниц истории",
+        "bot_history_render_cache_misses_total": "Промахи кэша отрисованных страниц истории",
+        "bot_history_render_cache_size": "Записей в кэше отрисованных страниц истории",
+    }
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, str, str], int] = {}
+        # Значения, которые считаются вне Metrics: функции отдают
+        # (имя, тип, метка, значение метки, число) в момент выгрузки
+        self.collectors: List[Callable[[], List[Tuple[str, str, str, str, float]]]] = []
+
+    def observe(self, name: str, label: str, value: str, seconds: float):
+        key = (name, label, value)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name: str, label: str = "", value: str = "", amount: int = 1):
+        key = (name, label, value)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(label: str, value: str, extra: str = "") -> str:
+        parts = [f'{label}="{value}"'] if label else []
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    # Текстовый формат Prometheus
+    def render(self) -> str:
+        lines = []
+        described = set()
+
+        def describe(name: str, kind: str):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, label, value), histogram in sorted(self.histograms.items()):
+            describe(name, "histogram")
+            seen = 0
+            for bound, count in zip(METRIC_BUCKETS, histogram.counts):
+                seen += count
+                le = self._labels(label, value, 'le="%s"' % bound)
+                lines.append(f"{name}_bucket{le} {seen}")
+            le = self._labels(label, value, 'le="+Inf"')
+            lines.append(f"{name}_bucket{le} {histogram.count}")
+            lines.append(f"{name}_sum{self._labels(label, value)} {histogram.total:.6f}")
+            lines.append(f"{name}_count{self._labels(label, value)} {histogram.count}")
+        for (name, label, value), count in sorted(self.counters.items()):
+            describe(name, "counter")
+            lines.append(f"{name}{self._labels(label, value)} {count}")
+        for collector in self.collectors:
+            for name, kind, label, value, number in collector():
+                describe(name, kind)
+                lines.append(f"{name}{self._labels(label, value)} {number}")
+        return "\n".join(lines) + "\n"
+
+    # Короткая сводка для лога: самые медленные по p99
+    def summary(self, limit: int = 8) -> str:
+        rows = sorted(self.histograms.items(), key=lambda item: item[1].quantile(0.99), reverse=True)
+        parts = [
+            f"{value or name}: n={h.count} p50≤{h.quantile(0.5) * 1000:.0f}мс p99≤{h.quantile(0.99) * 1000:.0f}мс"
+            for (name, _, value), h in rows[:limit]
+        ]
+        return "; ".join(parts) or "нет данных"
+
+metrics = Metrics(enabled=METRICS_PORT > 0 or METRICS_LOG_INTERVAL > 0)
+
+def timed_callback(callback: Callable) -> Callable:
+    label = getattr(callback, "__name__", "handler")
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", "handler", label)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", "handler", label, time.perf_counter() - started)
+    return wrapper
+
+# Оборачивает колбэки обработчика, включая все шаги диалога
+def instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            instrument_handler(inner)
+        for handlers in handler.states.values():
+            for inner in handlers:
+                instrument_handler(inner)
+    elif asyncio.iscoroutinefunction(getattr(handler, "callback", None)):
+        handler.callback = timed_callback(handler.callback)
+
+async def count_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    metrics.inc("bot_updates_total")
+
+def instrument_application(application: Application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            instrument_handler(handler)
+    application.add_handler(TypeHandler(Update, count_update), group=-100)
+
+# ======================
+# Хранилище истории
+# ======================
+
+# Базовый интерфейс хранилища: чтение, запись и удаление одного турнира
+class HistoryStore:
+    def get(self, tid: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put(self, tid: str, data: dict):
+        raise NotImplementedError
+
+    def delete(self, tid: str) -> bool:
+        raise NotImplementedError
+
+    # Пачка операций ("put"/"delete", tid, data) одной записью на диск
+    def apply_batch(self, ops: List[Tuple[str, str, Optional[dict]]]) -> list:
+        return [self.put(tid, data) if op == "put" else self.delete(tid) for op, tid, data in ops]
+
+    # Краткие сведения (название и дата) по всем турнирам без чтения сеток
+    def summaries(self) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        return len(self.summaries())
+
+    def __contains__(self, tid: str) -> bool:
+        return tid in self.summaries()
+
+    # Уборка: сжатие турниров старше месяца before ("ГГГГ-ММ") и выброс
+    # удалённых записей; возвращает число убранных записей
+    def compact(self, before: str) -> int:
+        return sum(self.compact_part(part) for part in self.compact_parts(before))
+
+    # Та же уборка по частям (у журнала по месяцам — по месяцу), чтобы
+    # каждая часть занимала поток истории ненадолго
+    def compact_parts(self, before: str) -> List[str]:
+        return [before]
+
+    def compact_part(self, part: str) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+
+# Append-only журнал: каждая строка — `заголовок\tданные`.
+# В памяти держится индекс id → (смещение, длина), поэтому чтение одного
+# турнира — один seek + read. Удаление дописывает «надгробие» (tombstone).
+# При открытии разбираются только заголовки, JSON сеток не читается.
+class LogHistoryStore(HistoryStore):
+    def __init__(self, path: str, fallback: Optional[Callable[[str], bool]] = None):
+        self.path = path
+        # fallback сообщает, есть ли турнир вне журнала (в архиве месяца):
+        # тогда удаление тоже записывается надгробием
+        self.fallback = fallback
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._summaries: Dict[str, dict] = {}
+        self.tombstones = set()
+        self._file = open(path, "a+b")
+        self._load_index()
+
+    # Обрезается только недописанный хвост после сбоя; испорченная строка
+    # в середине пропускается, чтобы не потерять записи после неё
+    def _load_index(self):
+        self._file.seek(0)
+        offset = 0
+        good_end = 0
+        for line in self._file:
+            end = offset + len(line)
+            if not line.endswith(b"\n"):
+                break  # недописанная строка после сбоя
+            header_raw, sep, _ = line.partition(b"\t")
+            try:
+                header = json.loads(header_raw)
+                tid, op = header["id"], header["op"]
+                if not isinstance(tid, str):
+                    raise TypeError("id должен быть строкой")
+                summary = {"name": header["name"], "date": header["date"]} if op == "put" else None
+            except (ValueError, TypeError, KeyError):
+                logging.warning("Журнал истории %s: пропущена испорченная строка на смещении %d", self.path, offset)
+                offset = good_end = end
+                continue
+            if op == "put":
+                data_offset = offset + len(header_raw) + len(sep)
+                self._index[tid] = (data_offset, end - 1 - data_offset)
+                self._summaries[tid] = summary
+                self.tombstones.discard(tid)
+            elif op == "del":
+                self._index.pop(tid, None)
+                self._summaries.pop(tid, None)
+                self.tombstones.add(tid)
+            offset = good_end = end
+        if good_end != os.path.getsize(self.path):
+            logging.warning("Журнал истории %s обрезан до %d байт после сбоя", self.path, good_end)
+            self._file.truncate(good_end)
+
+    def get(self, tid: str) -> Optional[dict]:
+        pos = self._index.get(tid)
+        if pos is None:
+            return None
+        offset, length = pos
+        self._file.seek(offset)
+        return json.loads(self._file.read(length))
+
+    def put(self, tid: str, data: dict):
+        self.apply_batch([("put", tid, data)])
+
+    def delete(self, tid: str) -> bool:
+        return self.apply_batch([("delete", tid, None)])[0]
+
+    # Все строки пачки пишутся одним write и одним fsync; оборванный хвост
+    # отбрасывается при следующем открытии, так что пачка не рвёт журнал
+    def apply_batch(self, ops: List[Tuple[str, str, Optional[dict]]]) -> list:
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        chunks = []
+        results = []
+        index_updates = []
+        alive: Dict[str, bool] = {}
+        for op, tid, data in ops:
+            if op == "put":
+                header = {"op": "put", "id": tid, "name": data["name"], "date": data["date"]}
+                head = json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\t"
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                chunks += [head, body, b"\n"]
+                index_updates.append((tid, (offset + len(head), len(body)), header))
+                offset += len(head) + len(body) + 1
+                alive[tid] = True
+                results.append(None)
+            else:
+                exists = alive.get(tid, tid in self._index)
+                if tid not in alive and not exists and tid not in self.tombstones and self.fallback:
+                    exists = self.fallback(tid)
+                if exists:
+                    line = json.dumps({"op": "del", "id": tid}).encode("utf-8") + b"\t\n"
+                    chunks.append(line)
+                    index_updates.append((tid, None, None))
+                    offset += len(line)
+                    alive[tid] = False
+                results.append(exists)
+        if chunks:
+            self._file.write(b"".join(chunks))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        for tid, pos, header in index_updates:
+            if pos is None:
+                self._index.pop(tid, None)
+                self._summaries.pop(tid, None)
+                self.tombstones.add(tid)
+            else:
+                self._index[tid] = pos
+                self._summaries[tid] = {"name": header["name"], "date": header["date"]}
+                self.tombstones.discard(tid)
+        return results
+
+    def records(self):
+        for tid in list(self._index):
+            yield tid, self.get(tid)
+
+    def summaries(self) -> Dict[str, dict]:
+        return self._summaries
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, tid: str) -> bool:
+        return tid in self._index
+
+    def close(self):
+        self._file.close()
+
+# Идентификатор турнира — миллисекунды создания * 1000 плюс счётчик:
+# строго возрастает даже для турниров, завершённых в одну миллисекунду,
+# и несёт время, по которому выбирается месяц хранения. Старые id были
+# секундами и тоже читаются.
+class TournamentIds:
+    def __init__(self):
+        self._last = 0
+
+    def observe(self, tid: str):
+        ts = tid_timestamp(tid)
+        if ts is not None:
+            self._last = max(self._last, int(tid) if int(tid) >= 10 ** 12 else int(ts * 1000) * 1000)
+
+    def next(self) -> str:
+        self._last = max(int(time.time() * 1000) * 1000, self._last + 1)
+        return str(self._last)
+
+def tid_timestamp(tid: str) -> Optional[float]:
+    if not tid.isdigit():
+        return None
+    value = int(tid)
+    return value / 1e6 if value >= 10 ** 12 else float(value)
+
+# Граница уборки: месяцы раньше неё сжимаются, hot_months последних — нет
+def history_cutoff_month(now: datetime, hot_months: int) -> str:
+    index = now.year * 12 + now.month - 1 - max(hot_months - 1, 0)
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+# Месяц считается в UTC: от часового пояса сервера он зависеть не должен
+def tid_month(tid: str) -> str:
+    ts = tid_timestamp(tid)
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m") if ts is not None else "misc"
+
+
+# История по месяцам: у каждого месяца свой журнал `ГГГГ-ММ.log`. Старые
+# месяцы compact() сжимает в архив `ГГГГ-ММ.json.gz` без удалённых
+# турниров, а названия и даты кладёт рядом в `ГГГГ-ММ.idx.json`, чтобы
+# список истории строился без распаковки. Архив не меняется: правки
+# старого месяца снова пишутся в его журнал поверх архива и уходят в архив
+# при следующей уборке. Чтение турнира трогает только его месяц.
+class ShardedHistoryStore(HistoryStore):
+    def __init__(self, directory: str, archive_cache_size: int = 4):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._logs: Dict[str, LogHistoryStore] = {}
+        self._archived: Dict[str, Dict[str, dict]] = {}
+        self._archives = LRUCache(archive_cache_size)
+        # Месяц, в котором турнир уже лежит. Записи, разложенные по
+        # местному времени старыми версиями, ищутся там, где они есть
+        self._months: Dict[str, str] = {}
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(".idx.json"):
+                month = file_name[:-len(".idx.json")]
+                with open(os.path.join(directory, file_name), "r", encoding="utf-8") as f:
+                    self._archived[month] = json.load(f)
+                self._months.update(dict.fromkeys(self._archived[month], month))
+            elif file_name.endswith(".log"):
+                month = file_name[:-len(".log")]
+                log = self._log(month)
+                self._months.update(dict.fromkeys(log.summaries(), month))
+                self._months.update(dict.fromkeys(log.tombstones, month))
+
+    def _path(self, month: str, suffix: str) -> str:
+        return os.path.join(self.directory, month + suffix)
+
+    def _log(self, month: str) -> LogHistoryStore:
+        log = self._logs.get(month)
+        if log is None:
+            log = self._logs[month] = LogHistoryStore(
+                self._path(month, ".log"), lambda tid: tid in self._archived.get(month, {})
+            )
+        return log
+
+    def _archive(self, month: str) -> Dict[str, dict]:
+        records = self._archives.get(month)
+        if records is None:
+            with gzip.open(self._path(month, ".json.gz"), "rt", encoding="utf-8") as f:
+                records = json.load(f)
+            self._archives.put(month, records)
+        return records
+
+    def _month(self, tid: str) -> str:
+        return self._months.get(tid) or tid_month(tid)
+
+    def get(self, tid: str) -> Optional[dict]:
+        month = self._month(tid)
+        log = self._logs.get(month)
+        if log is not None:
+            if tid in log:
+                return log.get(tid)
+            if tid in log.tombstones:
+                return None
+        if tid in self._archived.get(month, {}):
+            return self._archive(month)[tid]
+        return None
+
+    def __contains__(self, tid: str) -> bool:
+        month = self._month(tid)
+        log = self._logs.get(month)
+        if log is not None:
+            if tid in log:
+                return True
+            if tid in log.tombstones:
+                return False
+        return tid in self._archived.get(month, {})
+
+    def put(self, tid: str, data: dict):
+        self.apply_batch([("put", tid, data)])
+
+    def delete(self, tid: str) -> bool:
+        return self.apply_batch([("delete", tid, None)])[0]
+
+    # Пачка делится по месяцам; на каждый затронутый месяц — одна запись
+    def apply_batch(self, ops: List[Tuple[str, str, Optional[dict]]]) -> list:
+        by_month: Dict[str, List[int]] = {}
+        for i, (_, tid, _) in enumerate(ops):
+            by_month.setdefault(self._month(tid), []).append(i)
+        results = [None] * len(ops)
+        for month, positions in by_month.items():
+            month_results = self._log(month).apply_batch([ops[i] for i in positions])
+            for i, result in zip(positions, month_results):
+                results[i] = result
+                if ops[i][0] == "put" or result:
+                    self._months[ops[i][1]] = month
+        return results
+
+    def summaries(self) -> Dict[str, dict]:
+        summaries: Dict[str, dict] = {}
+        for month in sorted(set(self._archived) | set(self._logs)):
+            log = self._logs.get(month)
+            for tid, summary in self._archived.get(month, {}).items():
+                if log is None or (tid not in log.tombstones and tid not in log):
+                    summaries[tid] = summary
+            if log is not None:
+                summaries.update(log.summaries())
+        return summaries
+
+    def compact_parts(self, before: str) -> List[str]:
+        return [month for month in sorted(self._logs) if month < before]
+
+    def compact_part(self, month: str) -> int:
+        log = self._logs.get(month)
+        if log is None:
+            return 0
+        records = dict(self._archive(month)) if month in self._archived else {}
+        for tid in log.tombstones:
+            records.pop(tid, None)
+            self._months.pop(tid, None)
+        dropped = len(log.tombstones) + sum(1 for tid in records if tid in log)
+        records.update(log.records())
+        summaries = {tid: {"name": data["name"], "date": data["date"]} for tid, data in records.items()}
+        archive_path, index_path = self._path(month, ".json.gz"), self._path(month, ".idx.json")
+        if records:
+            with gzip.open(archive_path + ".tmp", "wt", encoding="utf-8") as f:
+                json.dump(records, f, ensure_ascii=False)
+            os.replace(archive_path + ".tmp", archive_path)
+            with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(summaries, f, ensure_ascii=False)
+            os.replace(index_path + ".tmp", index_path)
+            self._archived[month] = summaries
+            self._archives.put(month, records)
+        else:
+            for path in (archive_path, index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._archived.pop(month, None)
+            self._archives.invalidate(month)
+        # Журнал удаляется последним: до этого он перекрывает архив и
+        # после сбоя посередине данные остаются согласованными
+        log.close()
+        os.remove(log.path)
+        del self._logs[month]
+        logging.info("История за %s сжата: %d турниров, убрано %d записей", month, len(records), dropped)
+        return dropped
+
+    def close(self):
+        for log in self._logs.values():
+            log.close()
+        self._logs.clear()
+
+
+# Хранилище на SQLite: строка на турнир, удаление — пометка deleted
+class SqliteHistoryStore(HistoryStore):
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tournaments ("
+            "id TEXT PRIMARY KEY, name TEXT NOT NULL, date TEXT NOT NULL, "
+            "data TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.commit()
+
+    def get(self, tid: str) -> Optional[dict]:
+        row = self._db.execute(
+            "SELECT data FROM tournaments WHERE id = ? AND deleted = 0", (tid,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, tid: str, data: dict):
+        self.apply_batch([("put", tid, data)])
+
+    def delete(self, tid: str) -> bool:
+        return self.apply_batch([("delete", tid, None)])[0]
+
+    # Вся пачка — одна транзакция
+    def apply_batch(self, ops: List[Tuple[str, str, Optional[dict]]]) -> list:
+        results = []
+        with self._db:
+            for op, tid, data in ops:
+                if op == "put":
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO tournaments (id, name, date, data, deleted) VALUES (?, ?, ?, ?, 0)",
+                        (tid, data["name"], data["date"], json.dumps(data, ensure_ascii=False))
+                    )
+                    results.append(None)
+                else:
+                    cur = self._db.execute(
+                        "UPDATE tournaments SET deleted = 1 WHERE id = ? AND deleted = 0", (tid,)
+                    )
+                    results.append(cur.rowcount > 0)
+        return results
+
+    def summaries(self) -> Dict[str, dict]:
+        rows = self._db.execute(
+            "SELECT id, name, date FROM tournaments WHERE deleted = 0 ORDER BY rowid"
+        )
+        return {tid: {"name": name, "date": date} for tid, name, date in rows}
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM tournaments WHERE deleted = 0").fetchone()[0]
+
+    def __contains__(self, tid: str) -> bool:
+        return self._db.execute(
+            "SELECT 1 FROM tournaments WHERE id = ? AND deleted = 0", (tid,)
+        ).fetchone() is not None
+
+    # Таблица и так индексирована по id, поэтому уборка — только выброс
+    # помеченных удалёнными строк
+    def compact_part(self, part: str) -> int:
+        with self._db:
+            return self._db.execute("DELETE FROM tournaments WHERE deleted = 1").rowcount
+
+    def close(self):
+        self._db.close()
+
+
+HISTORY_BACKENDS = {
+    "log": lambda: ShardedHistoryStore(HISTORY_DIR),
+    "sqlite": lambda: SqliteHistoryStore(HISTORY_DB_FILE),
+}
+
+# Однократный перенос tournaments.json в новое хранилище
+def migrate_json_history(json_path: str, store: HistoryStore) -> int:
+    if not os.path.exists(json_path):
+        return 0
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    for tid, tournament in data.items():
+        if tid not in store:
+            teams, stages = decode_tournament(tournament)
+            store.put(tid, encode_tournament(tournament["name"], tournament["date"], teams, stages))
+    os.replace(json_path, json_path + ".migrated")
+    logging.info("История перенесена из %s: %d турниров", json_path, len(data))
+    return len(data)
+
+# Однократный перенос единого журнала в помесячные
+def migrate_log_history(log_path: str, store: HistoryStore) -> int:
+    if not os.path.exists(log_path) or isinstance(store, LogHistoryStore):
+        return 0
+    log = LogHistoryStore(log_path)
+    ops = [("put", tid, data) for tid, data in log.records() if tid not in store]
+    log.close()
+    if ops:
+        store.apply_batch(ops)
+    os.replace(log_path, log_path + ".migrated")
+    logging.info("История перенесена из %s: %d турниров", log_path, len(ops))
+    return len(ops)
+
+# Служебный файл рядом с хранилищем (например, готовые агрегаты истории)
+def history_sidecar_path(name: str) -> str:
+    if HISTORY_BACKEND == "sqlite":
+        return f"{HISTORY_DB_FILE}.{name}.json"
+    return os.path.join(HISTORY_DIR, f"{name}.json")
+
+def open_history_store() -> HistoryStore:
+    if HISTORY_BACKEND not in HISTORY_BACKENDS:
+        raise ValueError(f"❌ Неизвестное хранилище истории: {HISTORY_BACKEND}")
+    store = HISTORY_BACKENDS[HISTORY_BACKEND]()
+    if HISTORY_BACKEND == "log":
+        migrate_log_history(HISTORY_LOG_FILE, store)
+    migrate_json_history(HISTORY_FILE, store)
+    return store
+
+# ======================
+# Асинхронный сервис истории
+# ======================
+
+# Ограниченный LRU-кэш со счётчиками попаданий и промахов
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, object]" = OrderedDict()
+
+    def get(self, key: str):
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: str):
+        self._data.pop(key, None)
+
+    def values(self) -> list:
+        return list(self._data.values())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+def parse_history_date(date: str) -> float:
+    try:
+        return datetime.strptime(date, HISTORY_DATE_FORMAT).timestamp()
+    except ValueError:
+        return 0.0
+
+# Отсортированные индексы по дате и по названию. Страница N и фильтры
+# находятся бинарным поиском и трогают только подходящие записи.
+class HistoryIndex:
+    def __init__(self, summaries: Dict[str, dict]):
+        self.summaries: Dict[str, dict] = {}
+        self._by_time: List[Tuple[float, str]] = []
+        self._by_name: List[Tuple[str, float, str]] = []
+        for tid, summary in summaries.items():
+            self.summaries[tid] = summary
+            ts = parse_history_date(summary["date"])
+            self._by_time.append((ts, tid))
+            self._by_name.append((summary["name"].casefold(), ts, tid))
+        self._by_time.sort()
+        self._by_name.sort()
+
+    def __len__(self) -> int:
+        return len(self.summaries)
+
+    def oldest_first(self) -> List[str]:
+        return [tid for _, tid in self._by_time]
+
+    def add(self, tid: str, summary: dict):
+        self.remove(tid)
+        self.summaries[tid] = summary
+        ts = parse_history_date(summary["date"])
+        bisect.insort(self._by_time, (ts, tid))
+        bisect.insort(self._by_name, (summary["name"].casefold(), ts, tid))
 
-def save_history(data: dict):
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    def remove(self, tid: str):
+        summary = self.summaries.pop(tid, None)
+        if summary is None:
+            return
+        ts = parse_history_date(summary["date"])
+        del self._by_time[bisect.bisect_left(self._by_time, (ts, tid))]
+        del self._by_name[bisect.bisect_left(self._by_name, (summary["name"].casefold(), ts, tid))]
+
+    # Страница от новых к старым: (id на странице, всего подходящих)
+    def page(self, page: int, size: int, prefix: str = "",
+             date_from: Optional[float] = None, date_to: Optional[float] = None) -> Tuple[List[str], int]:
+        lo_ts = float("-inf") if date_from is None else date_from
+        hi_ts = float("inf") if date_to is None else date_to
+        lo = bisect.bisect_left(self._by_time, (lo_ts, ""))
+        hi = max(bisect.bisect_right(self._by_time, (hi_ts, "\uffff")), lo)
+        if prefix:
+            key = prefix.casefold()
+            name_lo = bisect.bisect_left(self._by_name, (key,))
+            name_hi = bisect.bisect_left(self._by_name, (key + "\uffff",))
+            if name_hi - name_lo < hi - lo:
+                matched = sorted(
+                    ((ts, tid) for _, ts, tid in self._by_name[name_lo:name_hi] if lo_ts <= ts <= hi_ts),
+                    reverse=True
+                )
+                return [tid for _, tid in matched[page * size:(page + 1) * size]], len(matched)
+            matched = [
+                (ts, tid) for ts, tid in reversed(self._by_time[lo:hi])
+                if self.summaries[tid]["name"].casefold().startswith(key)
+            ]
+            return [tid for _, tid in matched[page * size:(page + 1) * size]], len(matched)
+        start = max(hi - (page + 1) * size, lo)
+        end = hi - page * size
+        return [tid for _, tid in reversed(self._by_time[start:end])] if end > lo else [], hi - lo
+
+# Весь дисковый ввод-вывод идёт в одном фоновом потоке, поэтому event loop
+# не блокируется, а обращения к хранилищу не пересекаются. Изменения
+# проходят через очередь единственного писателя: всплеск записей
+# сливается в одну пачку с одним fsync.
+# Список турниров читается с диска один раз и дальше правится на месте
+# при записи; готовые карточки турниров лежат в LRU-кэше.
+class HistoryService:
+    def __init__(self, store_factory: Callable[[], HistoryStore] = open_history_store,
+                 max_batch: int = 256, render_cache_size: int = HISTORY_RENDER_CACHE_SIZE,
+                 sidecar_path: Callable[[str], str] = history_sidecar_path):
+        self._store_factory = store_factory
+        self._sidecar_path = sidecar_path
+        self._index: Optional[HistoryIndex] = None
+        self._summary_loads = 0
+        self.rendered = LRUCache(render_cache_size)
+        self._store: Optional[HistoryStore] = None
+        self._max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        # Подписчики на изменения истории: fn(id, запись, +1 или -1)
+        self.listeners: List[Callable[[str, dict, int], None]] = []
+        self.ids = TournamentIds()
+        self._compactor: Optional[asyncio.Task] = None
+
+    async def _run(self, fn: Callable, *args, op: Optional[str] = None):
+        loop = asyncio.get_running_loop()
+        if op is None or not metrics.enabled:
+            return await loop.run_in_executor(self._executor, fn, *args)
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            metrics.observe("bot_history_io_seconds", "op", op, time.perf_counter() - started)
+
+    def _open_store(self) -> HistoryStore:
+        if self._store is None:
+            self._store = self._store_factory()
+        return self._store
+
+    async def start(self):
+        await self._run(self._open_store)
+        if self._writer is None:
+            self._queue = asyncio.Queue()
+            self._writer = asyncio.create_task(self._writer_loop())
+        if self._compactor is None and HISTORY_COMPACT_INTERVAL > 0:
+            self._compactor = asyncio.create_task(self._compaction_loop())
+
+    async def stop(self):
+        if self._compactor is not None:
+            self._compactor.cancel()
+            try:
+                await self._compactor
+            except asyncio.CancelledError:
+                pass
+            self._compactor = None
+        if self._writer is not None:
+            await self._queue.put(None)
+            await self._writer
+            self._writer = None
+        if self._store is not None:
+            await self._run(self._store.close)
+            self._store = None
+            self._index = None
+
+    async def _writer_loop(self):
+        while True:
+            item = await self._queue.get()
+            batch = [item]
+            while len(batch) < self._max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            stop = None in batch
+            batch = [entry for entry in batch if entry is not None]
+            if batch:
+                ops = [op for op, _ in batch]
+                try:
+                    results = await self._run(lambda: self._open_store().apply_batch(ops), op="write_batch")
+                except Exception as e:
+                    logging.exception("Ошибка записи истории")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for (_, future), result in zip(batch, results):
+                        if not future.done():
+                            future.set_result(result)
+            if stop:
+                return
+
+    # Уборка идёт в том же потоке, что и записи, поэтому с ними не пересекается;
+    # по месяцу за задание, чтобы чтения и записи в очереди не ждали всю уборку
+    async def compact(self, now: Optional[datetime] = None) -> int:
+        before = history_cutoff_month(now or datetime.now(timezone.utc), HISTORY_HOT_MONTHS)
+        parts = await self._run(lambda: self._open_store().compact_parts(before))
+        dropped = 0
+        for part in parts:
+            dropped += await self._run(lambda: self._open_store().compact_part(part), op="compact")
+        return dropped
+
+    async def _compaction_loop(self):
+        while True:
+            try:
+                await self.compact()
+            except Exception:
+                logging.exception("Ошибка уборки истории")
+            await asyncio.sleep(HISTORY_COMPACT_INTERVAL)
+
+    async def _submit(self, op: str, tid: str, data: Optional[dict] = None):
+        if self._writer is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((op, tid, data), future))
+        return await future
+
+    async def get(self, tid: str) -> Optional[dict]:
+        return await self._run(lambda: self._open_store().get(tid), op="get")
+
+    async def index(self) -> HistoryIndex:
+        if self._index is None:
+            self._index = await self._run(lambda: HistoryIndex(self._open_store().summaries()), op="summaries")
+            self._summary_loads += 1
+            for tid in self._index.summaries:
+                self.ids.observe(tid)
+        return self._index
+
+    async def summaries(self) -> Dict[str, dict]:
+        return (await self.index()).summaries
+
+    # Новый id: больше всех уже выданных, в том числе до перезапуска
+    async def new_id(self) -> str:
+        await self.index()
+        return self.ids.next()
+
+    # Прогоняет турниры (по умолчанию все) от старых к новым через fn в потоке
+    # истории; порциями, чтобы записи в очереди не ждали конца всего прохода
+    async def replay(self, fn: Callable[[str, dict], None], chunk: int = 256,
+                     tids: Optional[List[str]] = None):
+        if tids is None:
+            tids = (await self.index()).oldest_first()
+        for start in range(0, len(tids), chunk):
+            part = tids[start:start + chunk]
+
+            def run():
+                store = self._open_store()
+                for tid in part:
+                    record = store.get(tid)
+                    if record is not None:
+                        fn(tid, record)
+            await self._run(run, op="replay")
+
+    async def put(self, tid: str, data: dict):
+        old = None
+        if self.listeners and self._index is not None and tid in self._index.summaries:
+            old = await self.get(tid)
+        await self._submit("put", tid, data)
+        for listener in self.listeners:
+            if old is not None:
+                listener(tid, old, -1)
+            listener(tid, data, 1)
+        self.rendered.invalidate(tid)
+        if self._index is not None:
+            self._index.add(tid, {"name": data["name"], "date": data["date"]})
+
+    async def delete(self, tid: str) -> bool:
+        old = await self.get(tid) if self.listeners else None
+        deleted = await self._submit("delete", tid)
+        if deleted and old is not None:
+            for listener in self.listeners:
+                listener(tid, old, -1)
+        self.rendered.invalidate(tid)
+        if self._index is not None:
+            self._index.remove(tid)
+        return deleted
+
+    # Служебные файлы читаются и пишутся в том же потоке, что и история;
+    # запись через временный файл, data=None удаляет файл
+    async def read_sidecar(self, name: str) -> Optional[dict]:
+        def read():
+            path = self._sidecar_path(name)
+            if not os.path.exists(path):
+                return None
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning("Не удалось прочитать %s: %s", path, e)
+                return None
+        return await self._run(read)
+
+    async def write_sidecar(self, name: str, data: Optional[dict]):
+        def write():
+            path = self._sidecar_path(name)
+            if data is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                return
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+        await self._run(write)
+
+    def cache_stats(self) -> dict:
+        return {"summary_loads": self._summary_loads, "rendered": self.rendered.stats()}
+
+history_service = HistoryService()
+
+def history_cache_metrics() -> List[Tuple[str, str, str, str, float]]:
+    stats = history_service.cache_stats()
+    rendered = stats["rendered"]
+    return [
+        ("bot_history_summary_loads_total", "counter", "", "", stats["summary_loads"]),
+        ("bot_history_render_cache_hits_total", "counter", "", "", rendered["hits"]),
+        ("bot_history_render_cache_misses_total", "counter", "", "", rendered["misses"]),
+        ("bot_history_render_cache_size", "gauge", "", "", rendered["size"]),
+    ]
+
+metrics.collectors.append(history_cache_metrics)
+
+# ======================
+# Вспомогательные функции
+# ======================
 
 def format_team(team: Optional[dict]) -> str:
     if not team:
@@ -61,23 +1092,1364 @@ def format_team(team: Optional[dict]) -> str:
         lines.append(f"Участник {i}: {player}")
     return "\n".join(lines)
 
-def generate_bracket(teams: List[dict]) -> List[dict]:
-    if len(teams) == 1:
-        return [{"team1": teams[0], "team2": None, "score1": None, "score2": None, "winner": teams[0]}]
-    shuffled = teams[:]
-    random.shuffle(shuffled)
-    matches = []
-    for i in range(0, len(shuffled), 2):
-        team1 = shuffled[i]
-        team2 = shuffled[i + 1] if i + 1 < len(shuffled) else None
-        matches.append({
-            "team1": team1,
-            "team2": team2,
-            "score1": None,
-            "score2": None,
-            "winner": None
-        })
-    return matches
+def team_name(teams: List[dict], idx: Optional[int]) -> str:
+    return teams[idx]["name"] if idx is not None else "—"
+
+# ======================
+# Модель турнира
+# ======================
+
+# Матч хранит только индексы команд в таблице турнира, счёт и индекс
+# победителя; сами команды и игроки лежат в таблицах один раз.
+class Match:
+    __slots__ = ("t1", "t2", "s1", "s2", "w", "third")
+
+    def __init__(self, t1: Optional[int], t2: Optional[int], s1: Optional[int] = None,
+                 s2: Optional[int] = None, w: Optional[int] = None, third: bool = False):
+        self.t1 = t1
+        self.t2 = t2
+        self.s1 = s1
+        self.s2 = s2
+        self.w = w
+        self.third = third
+
+    @property
+    def played(self) -> bool:
+        return self.s1 is not None
+
+    # Проход без игры: соперника нет, победитель назначен сразу
+    @property
+    def bye(self) -> bool:
+        return self.s1 is None and self.w is not None
+
+    @property
+    def playable(self) -> bool:
+        return self.t1 is not None and self.t2 is not None and self.s1 is None
+
+    @property
+    def loser(self) -> Optional[int]:
+        if self.w is None:
+            return None
+        return self.t2 if self.w == self.t1 else self.t1
+
+    def to_list(self) -> list:
+        row = [self.t1, self.t2, self.s1, self.s2, self.w]
+        if self.third:
+            row.append(1)
+        return row
+
+    @classmethod
+    def from_list(cls, row: list) -> "Match":
+        return cls(row[0], row[1], row[2], row[3], row[4], len(row) > 5 and bool(row[5]))
+
+    def __getstate__(self):
+        return self.to_list()
+
+    def __setstate__(self, row):
+        self.t1, self.t2, self.s1, self.s2, self.w = row[:5]
+        self.third = len(row) > 5 and bool(row[5])
+
+# Запись истории: таблица игроков, таблица команд [название, [id игроков]]
+# и стадии из матчей-списков [t1, t2, s1, s2, w(, 1 — матч за 3-е место)].
+# Если передан журнал результатов (v3), вместо стадий сохраняется он:
+# сетка восстанавливается из формата, посева и событий.
+def encode_tournament(name: str, date: str, teams: List[dict], stages: List[List[Match]],
+                      seed: Optional[int] = None, fmt: Optional[str] = None,
+                      places: Optional[List[int]] = None, events: Optional[List[list]] = None) -> dict:
+    players: List[str] = []
+    player_ids: Dict[str, int] = {}
+    encoded_teams = []
+    for team in teams:
+        ids = []
+        for player in team["players"]:
+            if player not in player_ids:
+                player_ids[player] = len(players)
+                players.append(player)
+            ids.append(player_ids[player])
+        encoded_teams.append([team["name"], ids])
+    record = {
+        "v": 2,
+        "name": name,
+        "date": date,
+        "players": players,
+        "teams": encoded_teams,
+        "stages": [[m.to_list() for m in stage] for stage in stages]
+    }
+    if seed is not None:
+        record["seed"] = seed
+    if fmt is not None:
+        record["format"] = fmt
+    if places is not None:
+        record["places"] = places
+    if events is not None and seed is not None and fmt is not None:
+        record["v"] = 3
+        record["events"] = events
+        del record["stages"]
+    return record
+
+# Читает и новый формат, и старый (полные словари команд в каждом матче)
+def decode_tournament(record: dict) -> Tuple[List[dict], List[List[Match]]]:
+    if record.get("v", 1) >= 2:
+        players = record["players"]
+        teams = [{"name": name, "players": [players[i] for i in ids]} for name, ids in record["teams"]]
+        if "events" in record:
+            state = {"teams": teams, "seed": record["seed"], "format": record["format"]}
+            return teams, replay_events(state, record["events"]).stages
+        stages = [[Match.from_list(row) for row in stage] for stage in record["stages"]]
+        return teams, stages
+
+    teams: List[dict] = []
+    team_ids: Dict[tuple, int] = {}
+
+    def intern(team: Optional[dict]) -> Optional[int]:
+        if not team:
+            return None
+        key = (team["name"], tuple(team["players"]))
+        if key not in team_ids:
+            team_ids[key] = len(teams)
+            teams.append({"name": team["name"], "players": list(team["players"])})
+        return team_ids[key]
+
+    stages = []
+    for stage in record["stages"]:
+        stages.append([
+            Match(intern(m["team1"]), intern(m["team2"]), m["score1"], m["score2"],
+                  intern(m["winner"]), bool(m.get("is_third_place")))
+            for m in stage
+        ])
+    return teams, stages
+
+# Карточка турнира блоками: каждый блок — законченный кусок разметки
+# (заголовок стадии идёт вместе с первым матчем), поэтому резать текст
+# между блоками можно, не ломая сущности Markdown
+def iter_tournament_blocks(tournament: dict):
+    teams, stages = decode_tournament(tournament)
+    yield f"**{tournament['name']}**\n📅 Дата: {tournament['date']}\n\n"
+    for i, stage in enumerate(stages):
+        header = f"**Стадия {i + 1}:**\n"
+        for match in stage:
+            if match.bye or (match.t1 is None and match.t2 is None):
+                continue
+            block = header
+            header = ""
+            team2_name = team_name(teams, match.t2)
+            if match.third:
+                block += "🥉 **Матч за 3-е место:**\n"
+            if match.played:
+                block += f"{team_name(teams, match.t1)} {match.s1}:{match.s2} {team2_name}\n"
+                team2 = teams[match.t2] if match.t2 is not None else None
+                block += f"👥 Участники:\n{format_team(teams[match.t1])}\n{format_team(team2)}\n\n"
+            else:
+                block += f"{team_name(teams, match.t1)} — {team2_name}\n\n"
+            yield block
+    scheduler_cls = SCHEDULERS.get(tournament.get("format"))
+    if scheduler_cls is not None and scheduler_cls.has_table:
+        yield standings_text(teams, compute_standings(len(teams), stages)) + "\n"
+
+# Режет строку длиннее width по последнему пробелу, а без пробелов — где
+# придётся; разрезанное жирное выделение закрывается и открывается заново
+def split_long_line(line: str, width: int) -> List[str]:
+    pieces = []
+    room = max(width - 2, 1)  # место под закрывающие **
+    while len(line) > width:
+        cut = line.rfind(" ", 1, room + 1)
+        if cut <= 0:
+            cut = room
+        piece, line = line[:cut], line[cut:].lstrip(" ")
+        if piece.count("**") % 2:
+            piece += "**"
+            line = "**" + line
+        pieces.append(piece)
+    pieces.append(line)
+    return pieces
+
+# Собирает блоки в страницы не длиннее limit; слишком длинный блок
+# делится по строкам, а слишком длинная строка — по словам
+def paginate_blocks(blocks, limit: int, continued: str = ""):
+    page = ""
+    width = limit - len(continued)
+    for block in blocks:
+        pieces = [block]
+        if len(block) > width:
+            pieces = [piece + "\n" for line in block.rstrip("\n").split("\n")
+                      for piece in split_long_line(line, width - 1)]
+        for piece in pieces:
+            if page and len(page) + len(piece) > limit:
+                yield page
+                page = continued
+            page += piece
+    if page:
+        yield page
+
+def render_tournament_pages(tournament: dict) -> List[str]:
+    continued = f"**{tournament['name']}** (продолжение)\n\n"
+    return list(paginate_blocks(iter_tournament_blocks(tournament), DETAILS_PAGE_LIMIT, continued))
+
+# ======================
+# Сетка плей-офф
+# ======================
+
+# Сетка строится целиком сразу: стадия r+1 вдвое короче стадии r, победитель
+# матча pos уходит в матч pos // 2 следующей стадии (слот pos % 2), поэтому
+# продвижение по сетке — O(1) без пересчёта стадий. Недостающие до степени
+# двойки места — проходы без игры (bye) для верхних посевов.
+
+MAX_TEAMS = 256
+BRACKET_MAX_BUTTONS = 100  # ограничение Telegram на число кнопок
+# Пауза перед правкой сообщения сетки: быстрые обновления сливаются в одну
+BRACKET_EDIT_DELAY = float(os.environ.get("BRACKET_EDIT_DELAY", "0.7"))
+# Сообщение сетки не длиннее лимита Telegram; таблица занимает не больше половины
+BRACKET_TEXT_LIMIT = MessageLimit.MAX_TEXT_LENGTH
+BRACKET_TABLE_LIMIT = BRACKET_TEXT_LIMIT // 2
+BRACKET_CUT_NOTE = "… остальные матчи не поместились — кнопки ниже.\n\n"
+
+# Порядок посевов в первом раунде: 1–N, N/2–N/2+1, ... (для 8: 1 8 4 5 2 7 3 6)
+def seed_positions(size: int) -> List[int]:
+    positions = [1]
+    while len(positions) < size:
+        total = len(positions) * 2 + 1
+        positions = [s for p in positions for s in (p, total - p)]
+    return positions
+
+# seeding — id команд по посеву (сильнейшая первой); если не задан,
+# посев случайный, но воспроизводимый по seed
+def build_bracket(team_ids: List[int], seed: Optional[int] = None,
+                  seeding: Optional[List[int]] = None) -> List[List[Match]]:
+    order = list(seeding) if seeding is not None else list(team_ids)
+    if seeding is None:
+        random.Random(seed).shuffle(order)
+    size = max(2, 1 << (len(order) - 1).bit_length())
+    slots = [order[s - 1] if s <= len(order) else None for s in seed_positions(size)]
+
+    stages = [[Match(slots[i], slots[i + 1]) for i in range(0, size, 2)]]
+    while len(stages[-1]) > 1:
+        stages.append([Match(None, None) for _ in range(len(stages[-1]) // 2)])
+    if len(order) >= 4:
+        stages[-1].append(Match(None, None, third=True))
+
+    for pos, match in enumerate(stages[0]):
+        if match.t2 is None:
+            match.w = match.t1
+            advance_winner(stages, 0, pos)
+    return stages
+
+def advance_winner(stages: List[List[Match]], stage: int, pos: int):
+    if stage + 1 >= len(stages):
+        return
+    match = stages[stage][pos]
+    parent = stages[stage + 1][pos // 2]
+    if pos % 2 == 0:
+        parent.t1 = match.w
+    else:
+        parent.t2 = match.w
+    # Проигравшие полуфиналов идут в матч за 3-е место
+    if stage + 2 == len(stages) and len(stages[-1]) > 1:
+        third = stages[-1][1]
+        if pos % 2 == 0:
+            third.t1 = match.loser
+        else:
+            third.t2 = match.loser
+
+def record_result(stages: List[List[Match]], stage: int, pos: int, s1: int, s2: int) -> Match:
+    match = stages[stage][pos]
+    match.s1 = s1
+    match.s2 = s2
+    match.w = match.t1 if s1 > s2 else match.t2
+    advance_winner(stages, stage, pos)
+    return match
+
+def bracket_finished(stages: List[List[Match]]) -> bool:
+    return all(m.played for m in stages[-1])
+
+def stage_title(stages: List[List[Match]], stage: int) -> str:
+    from_end = len(stages) - 1 - stage
+    if from_end == 0:
+        return "Финал"
+    if from_end == 1:
+        return "Полуфиналы"
+    if from_end == 2:
+        return "Четвертьфиналы"
+    return f"Раунд {stage + 1}"
+
+# ======================
+# Форматы турниров
+# ======================
+
+# Общее ядро расписания: все форматы хранят матчи в одном виде — стадии
+# из Match в state["bracket"], — поэтому показ сетки и история одинаковы
+# для всех. Объект формата — лёгкая обёртка над состоянием турнира
+# (сейчас это user_data), создаётся заново на каждый запрос.
+class Scheduler:
+    key = ""
+    title = ""
+    allows_draws = False
+    has_table = False
+    min_teams = 2
+    max_teams = MAX_TEAMS
+    # Ключи состояния, которые меняет record: их копии — снимки журнала
+    state_keys: Tuple[str, ...] = ("bracket",)
+
+    def __init__(self, state: dict):
+        self.state = state
+        self.stages: List[List[Match]] = state["bracket"]
+        # Матчи (стадия, номер), изменившиеся при последней записи результата
+        self.changed: List[Tuple[int, int]] = []
+
+    @classmethod
+    def create(cls, state: dict) -> "Scheduler":
+        state["format"] = cls.key
+        state["bracket"] = cls.build(len(state["teams"]), state["seed"], state)
+        return cls(state)
+
+    @classmethod
+    def build(cls, n: int, seed: int, state: dict) -> List[List[Match]]:
+        raise NotImplementedError
+
+    def record(self, stage: int, pos: int, s1: int, s2: int) -> Match:
+        raise NotImplementedError
+
+    def finished(self) -> bool:
+        raise NotImplementedError
+
+    # Команды на 1-м, 2-м и 3-м месте
+    def placements(self) -> List[int]:
+        raise NotImplementedError
+
+    def stage_title(self, stage: int) -> str:
+        return f"Тур {stage + 1}"
+
+
+class SingleElimination(Scheduler):
+    key = "single"
+    title = "Олимпийская система"
+
+    @classmethod
+    def build(cls, n: int, seed: int, state: dict) -> List[List[Match]]:
+        return build_bracket(list(range(n)), seed)
+
+    def record(self, stage: int, pos: int, s1: int, s2: int) -> Match:
+        match = record_result(self.stages, stage, pos, s1, s2)
+        self.changed.append((stage, pos))
+        if stage + 1 < len(self.stages):
+            self.changed.append((stage + 1, pos // 2))
+            if stage + 2 == len(self.stages) and len(self.stages[-1]) > 1:
+                self.changed.append((stage + 1, 1))
+        return match
+
+    def finished(self) -> bool:
+        return bracket_finished(self.stages)
+
+    def placements(self) -> List[int]:
+        final = self.stages[-1]
+        places = [final[0].w, final[0].loser]
+        if len(final) > 1:
+            places.append(final[1].w)
+        return places
+
+    def stage_title(self, stage: int) -> str:
+        return stage_title(self.stages, stage)
+
+
+# Схема двойного выбывания: куда уходят победитель и проигравший каждого
+# матча ((стадия, матч, слот) или None) и какие слоты заведомо пусты из-за
+# проходов без игры. Зависит только от числа команд, поэтому кэшируется.
+@lru_cache(maxsize=None)
+def double_elimination_layout(n: int):
+    size = max(4, 1 << (n - 1).bit_length())
+    k = size.bit_length() - 1  # раундов в верхней сетке
+    wb_counts = [size >> (r + 1) for r in range(k)]
+    lb_counts = [size >> (j // 2 + 2) for j in range(2 * (k - 1))]
+    wb_base = 0
+    lb_base = k
+    gf = k + len(lb_counts)
+
+    winner_to: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
+    loser_to: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
+    for r, count in enumerate(wb_counts):
+        for pos in range(count):
+            if r + 1 < k:
+                winner_to[(wb_base + r, pos)] = (wb_base + r + 1, pos // 2, pos % 2)
+            else:
+                winner_to[(wb_base + r, pos)] = (gf, 0, 0)
+            if r == 0:
+                loser_to[(wb_base, pos)] = (lb_base, pos // 2, pos % 2)
+            else:
+                # Разворот порядка в нечётных раундах уменьшает повторные встречи
+                lb_round = 2 * r - 1
+                target = count - 1 - pos if r % 2 else pos
+                loser_to[(wb_base + r, pos)] = (lb_base + lb_round, target, 1)
+    for j, count in enumerate(lb_counts):
+        for pos in range(count):
+            if j + 1 == len(lb_counts):
+                winner_to[(lb_base + j, pos)] = (gf, 0, 1)
+            elif j % 2 == 0:
+                winner_to[(lb_base + j, pos)] = (lb_base + j + 1, pos, 0)
+            else:
+                winner_to[(lb_base + j, pos)] = (lb_base + j + 1, pos // 2, pos % 2)
+
+    # Какие слоты получат команду: в первом раунде пусты места посевов > n,
+    # проигравший есть только у матча с двумя командами
+    slots = seed_positions(size)
+    real: Dict[Tuple[int, int], List[bool]] = {}
+    for pos in range(wb_counts[0]):
+        real[(wb_base, pos)] = [slots[2 * pos] <= n, slots[2 * pos + 1] <= n]
+    order = [(wb_base + r, pos) for r in range(1, k) for pos in range(wb_counts[r])]
+    order += [(lb_base + j, pos) for j in range(len(lb_counts)) for pos in range(lb_counts[j])]
+    order.append((gf, 0))
+    for key in order:
+        real[key] = [False, False]
+    for key in [(wb_base, pos) for pos in range(wb_counts[0])] + order:
+        has_winner = any(real[key])
+        has_loser = all(real[key])
+        if has_winner and key in winner_to:
+            stage, pos, slot = winner_to[key]
+            real[(stage, pos)][slot] = True
+        if has_loser and key in loser_to:
+            stage, pos, slot = loser_to[key]
+            real[(stage, pos)][slot] = True
+    return size, wb_counts, lb_counts, winner_to, loser_to, real
+
+
+class DoubleElimination(Scheduler):
+    key = "double"
+    title = "Двойное выбывание"
+    min_teams = 3
+
+    def __init__(self, state: dict):
+        super().__init__(state)
+        layout = double_elimination_layout(len(state["teams"]))
+        self.size, self.wb_counts, self.lb_counts, self.winner_to, self.loser_to, self.real = layout
+
+    @classmethod
+    def build(cls, n: int, seed: int, state: dict) -> List[List[Match]]:
+        size, wb_counts, lb_counts, _, _, _ = double_elimination_layout(n)
+        order = list(range(n))
+        random.Random(seed).shuffle(order)
+        slots = [order[s - 1] if s <= n else None for s in seed_positions(size)]
+        stages = [[Match(slots[i], slots[i + 1]) for i in range(0, size, 2)]]
+        stages += [[Match(None, None) for _ in range(count)] for count in wb_counts[1:]]
+        stages += [[Match(None, None) for _ in range(count)] for count in lb_counts]
+        stages.append([Match(None, None)])
+        state["bracket"] = stages
+        scheduler = cls(state)
+        for pos, match in enumerate(stages[0]):
+            if match.t2 is None:
+                match.w = match.t1
+                scheduler._advance(0, pos)
+        return stages
+
+    def _place(self, target: Tuple[int, int, int], team: int):
+        stage, pos, slot = target
+        match = self.stages[stage][pos]
+        self.changed.append((stage, pos))
+        if slot == 0:
+            match.t1 = team
+        else:
+            match.t2 = team
+        # Соперник в этот матч не придёт — проход без игры
+        if not all(self.real[(stage, pos)]):
+            match.w = team
+            self._advance(stage, pos)
+
+    def _advance(self, stage: int, pos: int):
+        match = self.stages[stage][pos]
+        target = self.winner_to.get((stage, pos))
+        if target is not None:
+            self._place(target, match.w)
+        target = self.loser_to.get((stage, pos))
+        if target is not None and match.played:
+            self._place(target, match.loser)
+
+    def record(self, stage: int, pos: int, s1: int, s2: int) -> Match:
+        match = self.stages[stage][pos]
+        self.changed.append((stage, pos))
+        match.s1 = s1
+        match.s2 = s2
+        match.w = match.t1 if s1 > s2 else match.t2
+        self._advance(stage, pos)
+        return match
+
+    def finished(self) -> bool:
+        return self.stages[-1][0].played
+
+    def placements(self) -> List[int]:
+        grand_final = self.stages[-1][0]
+        lower_final = self.stages[-2][0]
+        return [grand_final.w, grand_final.loser, lower_final.loser]
+
+    def stage_title(self, stage: int) -> str:
+        k = len(self.wb_counts)
+        if stage == len(self.stages) - 1:
+            return "Гранд-финал"
+        if stage < k:
+            return "Верхняя сетка: финал" if stage == k - 1 else f"Верхняя сетка: раунд {stage + 1}"
+        j = stage - k
+        if j == len(self.lb_counts) - 1:
+            return "Нижняя сетка: финал"
+        return f"Нижняя сетка: раунд {j + 1}"
+
+
+# Таблица для круговых форматов: на команду [очки, победы, ничьи,
+# поражения, забито, пропущено]; обновляется по одному матчу
+POINTS_WIN, POINTS_DRAW = 3, 1
+
+def update_standings(standings: List[List[int]], match: Match):
+    rows = ((match.t1, match.s1, match.s2), (match.t2, match.s2, match.s1))
+    for team, scored, conceded in rows:
+        row = standings[team]
+        row[4] += scored
+        row[5] += conceded
+        if scored > conceded:
+            row[0] += POINTS_WIN
+            row[1] += 1
+        elif scored == conceded:
+            row[0] += POINTS_DRAW
+            row[2] += 1
+        else:
+            row[3] += 1
+
+def ranking(standings: List[List[int]]) -> List[int]:
+    return sorted(range(len(standings)), key=lambda t: (
+        -standings[t][0], -(standings[t][4] - standings[t][5]), -standings[t][4], t
+    ))
+
+def compute_standings(n: int, stages: List[List[Match]]) -> List[List[int]]:
+    standings = [[0] * 6 for _ in range(n)]
+    for stage in stages:
+        for match in stage:
+            if match.played:
+                update_standings(standings, match)
+            elif match.bye:
+                standings[match.w][0] += POINTS_WIN
+                standings[match.w][1] += 1
+    return standings
+
+
+class RoundRobin(Scheduler):
+    key = "rr"
+    title = "Круговая система"
+    allows_draws = True
+    has_table = True
+    max_teams = 32
+    state_keys = ("bracket", "standings", "remaining")
+
+    # Метод круга: первая команда на месте, остальные сдвигаются по кругу
+    @classmethod
+    def build(cls, n: int, seed: int, state: dict) -> List[List[Match]]:
+        ids: List[Optional[int]] = list(range(n))
+        random.Random(seed).shuffle(ids)
+        if n % 2:
+            ids.append(None)
+        m = len(ids)
+        stages = []
+        for r in range(m - 1):
+            stage = []
+            for i in range(m // 2):
+                a, b = ids[i], ids[m - 1 - i]
+                if a is None or b is None:
+                    continue
+                if i == 0 and r % 2:
+                    a, b = b, a
+                stage.append(Match(a, b))
+            stages.append(stage)
+            ids = [ids[0], ids[-1]] + ids[1:-1]
+        state["standings"] = [[0] * 6 for _ in range(n)]
+        state["remaining"] = sum(len(stage) for stage in stages)
+        return stages
+
+    def record(self, stage: int, pos: int, s1: int, s2: int) -> Match:
+        match = self.stages[stage][pos]
+        self.changed.append((stage, pos))
+        match.s1 = s1
+        match.s2 = s2
+        match.w = match.t1 if s1 > s2 else match.t2 if s2 > s1 else None
+        update_standings(self.state["standings"], match)
+        self.state["remaining"] -= 1
+        return match
+
+    def finished(self) -> bool:
+        return self.state["remaining"] == 0
+
+    def placements(self) -> List[int]:
+        return ranking(self.state["standings"])[:3]
+
+
+# Швейцарская система: ceil(log2 N) туров, каждый следующий тур строится,
+# когда сыгран предыдущий. Пары подбираются внутри групп по очкам сверху
+# вниз без повторных встреч; при нечётном числе команд нижняя команда без
+# прохода получает bye (засчитывается как победа).
+SWISS_PAIRING_BUDGET = 20000
+
+def swiss_pairs(order: List[int], opponents: List[List[int]]) -> List[Tuple[int, int]]:
+    budget = [SWISS_PAIRING_BUDGET]
+
+    def pair(players: List[int]) -> Optional[List[Tuple[int, int]]]:
+        if not players:
+            return []
+        first = players[0]
+        for j in range(1, len(players)):
+            budget[0] -= 1
+            if budget[0] < 0:
+                return None
+            other = players[j]
+            if other in opponents[first]:
+                continue
+            rest = pair(players[1:j] + players[j + 1:])
+            if rest is not None:
+                return [(first, other)] + rest
+        return None
+
+    pairs = pair(order)
+    if pairs is None:
+        # Без повторов не разбить — соседи по таблице
+        pairs = [(order[i], order[i + 1]) for i in range(0, len(order), 2)]
+    return pairs
+
+
+class Swiss(Scheduler):
+    key = "swiss"
+    title = "Швейцарская система"
+    allows_draws = True
+    has_table = True
+    state_keys = ("bracket", "standings", "opponents", "remaining")
+
+    @classmethod
+    def build(cls, n: int, seed: int, state: dict) -> List[List[Match]]:
+        order = list(range(n))
+        random.Random(seed).shuffle(order)
+        state["rounds_total"] = max(1, (n - 1).bit_length())
+        state["standings"] = [[0] * 6 for _ in range(n)]
+        state["opponents"] = [[] for _ in range(n)]
+        stages: List[List[Match]] = []
+        state["bracket"] = stages
+        # Первый тур: верхняя половина посева против нижней
+        bye = order.pop() if n % 2 else None
+        half = len(order) // 2
+        cls(state)._append_round(list(zip(order[:half], order[half:])), bye)
+        return stages
+
+    def _append_round(self, pairs: List[Tuple[int, int]], bye: Optional[int]):
+        stage = [Match(a, b) for a, b in pairs]
+        opponents = self.state["opponents"]
+        for a, b in pairs:
+            opponents[a].append(b)
+            opponents[b].append(a)
+        if bye is not None:
+            stage.append(Match(bye, None, w=bye))
+            opponents[bye].append(-1)
+            self.state["standings"][bye][0] += POINTS_WIN
+            self.state["standings"][bye][1] += 1
+        self.stages.append(stage)
+        self.state["remaining"] = len(pairs)
+
+    def _next_round(self):
+        order = ranking(self.state["standings"])
+        bye = None
+        if len(order) % 2:
+            opponents = self.state["opponents"]
+            bye = next((t for t in reversed(order) if -1 not in opponents[t]), order[-1])
+            order.remove(bye)
+        self._append_round(swiss_pairs(order, self.state["opponents"]), bye)
+
+    def record(self, stage: int, pos: int, s1: int, s2: int) -> Match:
+        match = self.stages[stage][pos]
+        self.changed.append((stage, pos))
+        match.s1 = s1
+        match.s2 = s2
+        match.w = match.t1 if s1 > s2 else match.t2 if s2 > s1 else None
+        update_standings(self.state["standings"], match)
+        self.state["remaining"] -= 1
+        if self.state["remaining"] == 0 and len(self.stages) < self.state["rounds_total"]:
+            self._next_round()
+        return match
+
+    def finished(self) -> bool:
+        return self.state["remaining"] == 0 and len(self.stages) >= self.state["rounds_total"]
+
+    def placements(self) -> List[int]:
+        return ranking(self.state["standings"])[:3]
+
+
+SCHEDULERS: Dict[str, type] = {
+    cls.key: cls for cls in (SingleElimination, DoubleElimination, RoundRobin, Swiss)
+}
+
+def get_scheduler(state: dict) -> Scheduler:
+    return SCHEDULERS[state.get("format", SingleElimination.key)](state)
+
+# limit — предельная длина текста: нижняя часть таблицы сворачивается
+def standings_text(teams: List[dict], standings: List[List[int]], limit: Optional[int] = None) -> str:
+    lines = ["📊 **Таблица:**"]
+    order = ranking(standings)
+    size = len(lines[0])
+    for place, team in enumerate(order, 1):
+        pts, wins, draws, losses, scored, conceded = standings[team]
+        line = f"{place}. {teams[team]['name']} — {pts} очк. ({wins}-{draws}-{losses}, {scored - conceded:+d})"
+        size += len(line) + 1
+        if limit is not None and size > limit - 32:
+            lines.append(f"… и ещё команд: {len(order) - place + 1}")
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+# ======================
+# Журнал результатов
+# ======================
+
+# Результаты не перезаписываются, а дописываются событиями в журнал
+# турнира state["events"]: ["r", стадия, матч, s1, s2] — результат,
+# ["u"] — отмена последнего, ["e", стадия, матч, s1, s2] — исправление.
+# Из журнала выводится список действующих результатов state["results"]
+# ([стадия, матч, s1, s2, t1, t2]); каждые RESULT_SNAPSHOT_EVERY
+# результатов снимается копия состояния формата, так что откат к любому
+# моменту — восстановление ближайшего снимка и повтор результатов после
+# него. Этот же журнал сохраняется в историю вместо готовой сетки.
+# Сохраняется только исходное состояние state["result_base"]; снимки
+# лежат в state["_snapshots"], который не попадает в персистентность, и
+# после перезапуска набираются заново по ходу повторов.
+RESULT_SNAPSHOT_EVERY = 16
+
+def _snapshot(state: dict) -> dict:
+    return copy.deepcopy({key: state[key] for key in SCHEDULERS[state["format"]].state_keys})
+
+def init_result_log(state: dict):
+    state["events"] = []
+    state["results"] = []
+    state["result_base"] = _snapshot(state)
+    state["_snapshots"] = [[0, state["result_base"]]]
+
+def _snapshots(state: dict) -> List[list]:
+    snapshots = state.get("_snapshots")
+    if snapshots is None:
+        if "result_base" not in state:
+            # Турнир, сохранённый со всеми снимками в состоянии
+            state["result_base"] = state.pop("snapshots")[0][1]
+        snapshots = state["_snapshots"] = [[0, state["result_base"]]]
+    return snapshots
+
+def _restore(state: dict, count: int, snapshot_every: int = RESULT_SNAPSHOT_EVERY) -> Scheduler:
+    snapshots = _snapshots(state)
+    while snapshots[-1][0] > count:
+        snapshots.pop()
+    base, payload = snapshots[-1]
+    state.update(copy.deepcopy(payload))
+    scheduler = get_scheduler(state)
+    for done, (stage, pos, s1, s2, *_) in enumerate(state["results"][base:count], base + 1):
+        scheduler.record(stage, pos, s1, s2)
+        if snapshot_every and done % snapshot_every == 0:
+            snapshots.append([done, _snapshot(state)])
+    return scheduler
+
+def _apply_result(state: dict, scheduler: Scheduler, stage: int, pos: int, s1: int, s2: int,
+                  entry: Optional[list] = None, snapshot_every: int = RESULT_SNAPSHOT_EVERY) -> list:
+    match = scheduler.stages[stage][pos]
+    if entry is None:
+        entry = [stage, pos, s1, s2, match.t1, match.t2]
+    scheduler.record(stage, pos, s1, s2)
+    state["results"].append(entry)
+    count = len(state["results"])
+    if snapshot_every and count % snapshot_every == 0:
+        _snapshots(state).append([count, _snapshot(state)])
+    return entry
+
+def _undo_result(state: dict, snapshot_every: int = RESULT_SNAPSHOT_EVERY) -> Optional[list]:
+    if not state["results"]:
+        return None
+    entry = state["results"].pop()
+    _restore(state, len(state["results"]), snapshot_every)
+    return entry
+
+# Исправление: откат к результату матча, новый счёт и повтор всех
+# последующих результатов, матчи которых остались с теми же соперниками;
+# остальные (например, сыгранные другим победителем) отбрасываются
+def _edit_result(state: dict, stage: int, pos: int, s1: int, s2: int,
+                 snapshot_every: int = RESULT_SNAPSHOT_EVERY):
+    results = state["results"]
+    k = next((i for i in range(len(results) - 1, -1, -1) if results[i][:2] == [stage, pos]), None)
+    if k is None:
+        return None, None, []
+    old, later = results[k], results[k + 1:]
+    del results[k:]
+    scheduler = _restore(state, k, snapshot_every)
+    new = _apply_result(state, scheduler, stage, pos, s1, s2, snapshot_every=snapshot_every)
+    dropped = []
+    for entry in later:
+        stages = scheduler.stages
+        match = stages[entry[0]][entry[1]] if entry[0] < len(stages) and entry[1] < len(stages[entry[0]]) else None
+        if match is not None and match.playable and [match.t1, match.t2] == entry[4:6]:
+            _apply_result(state, scheduler, entry[0], entry[1], entry[2], entry[3], entry, snapshot_every)
+        else:
+            dropped.append(entry)
+    return old, new, dropped
+
+def log_result(state: dict, stage: int, pos: int, s1: int, s2: int) -> Tuple[Scheduler, list]:
+    state["events"].append(["r", stage, pos, s1, s2])
+    scheduler = get_scheduler(state)
+    return scheduler, _apply_result(state, scheduler, stage, pos, s1, s2)
+
+def undo_result(state: dict) -> Optional[list]:
+    if not state["results"]:
+        return None
+    state["events"].append(["u"])
+    return _undo_result(state)
+
+def edit_result(state: dict, stage: int, pos: int, s1: int, s2: int):
+    state["events"].append(["e", stage, pos, s1, s2])
+    return _edit_result(state, stage, pos, s1, s2)
+
+# Восстановление сетки из журнала (для записей истории): без
+# промежуточных снимков, они нужны только живому турниру
+def replay_events(state: dict, events: List[list]) -> Scheduler:
+    SCHEDULERS[state["format"]].create(state)
+    init_result_log(state)
+    for event in events:
+        if event[0] == "r":
+            _apply_result(state, get_scheduler(state), *event[1:], snapshot_every=0)
+        elif event[0] == "u":
+            _undo_result(state, snapshot_every=0)
+        elif event[0] == "e":
+            _edit_result(state, *event[1:], snapshot_every=0)
+    state["events"] = list(events)
+    return get_scheduler(state)
+
+# ======================
+# Рейтинг игроков
+# ======================
+
+# Эло по игрокам: рейтинг команды — среднее рейтингов её участников,
+# после матча каждый участник получает одинаковую поправку. При запуске
+# рейтинги берутся из снимка истории или пересчитываются по ней, дальше
+# обновляются после каждого введённого результата. Удаление турнира из истории скажется на
+# рейтингах только после перезапуска.
+RATING_START = 1000.0
+RATING_K = 32.0
+
+class PlayerRatings:
+    def __init__(self):
+        self.ratings: Dict[str, float] = {}
+        self.games: Dict[str, int] = {}
+        self.ready = False
+        self._pending: List[tuple] = []
+
+    @staticmethod
+    def key(name: str) -> str:
+        return name.strip().casefold()
+
+    def get(self, name: str) -> float:
+        return self.ratings.get(self.key(name), RATING_START)
+
+    def team_rating(self, players: List[str]) -> float:
+        return sum(self.get(p) for p in players) / len(players) if players else RATING_START
+
+    def _apply(self, players1: List[str], players2: List[str], s1: int, s2: int):
+        r1, r2 = self.team_rating(players1), self.team_rating(players2)
+        expected = 1 / (1 + 10 ** ((r2 - r1) / 400))
+        score = 1.0 if s1 > s2 else 0.0 if s1 < s2 else 0.5
+        delta = RATING_K * (score - expected)
+        for players, sign in ((players1, 1), (players2, -1)):
+            for name in players:
+                key = self.key(name)
+                self.ratings[key] = self.ratings.get(key, RATING_START) + sign * delta
+                self.games[key] = self.games.get(key, 0) + 1
+        return delta
+
+    # Возвращает поправку, чтобы результат можно было отменить через revert;
+    # None — результат ждёт пересчёта истории
+    def record_match(self, players1: List[str], players2: List[str], s1: int, s2: int) -> Optional[float]:
+        # Пока история не пересчитана, результаты копятся и применяются после
+        if not self.ready:
+            self._pending.append((players1, players2, s1, s2))
+            return None
+        return self._apply(players1, players2, s1, s2)
+
+    # Снимает поправку отменённого результата (приближённо: последующие
+    # матчи этих игроков считались уже с ней)
+    def revert(self, players1: List[str], players2: List[str], s1: int, s2: int, delta: Optional[float]):
+        if delta is None:
+            if (players1, players2, s1, s2) in self._pending:
+                self._pending.remove((players1, players2, s1, s2))
+            return
+        for players, sign in ((players1, 1), (players2, -1)):
+            for name in players:
+                key = self.key(name)
+                self.ratings[key] = self.ratings.get(key, RATING_START) - sign * delta
+                self.games[key] = self.games.get(key, 1) - 1
+                if self.games[key] <= 0:
+                    del self.games[key]
+                    self.ratings.pop(key, None)
+
+    def replay_tournament(self, record: dict):
+        teams, stages = decode_tournament(record)
+        for stage in stages:
+            for match in stage:
+                if match.played and match.t1 is not None and match.t2 is not None:
+                    self._apply(teams[match.t1]["players"], teams[match.t2]["players"], match.s1, match.s2)
+
+    # Принимает таблицу, пересчитанную по истории, и досчитывает то, что
+    # накопилось за время пересчёта
+    def adopt(self, table: "PlayerRatings"):
+        self.ratings, self.games = table.ratings, table.games
+        for args in self._pending:
+            self._apply(*args)
+        self._pending.clear()
+        self.ready = True
+
+player_ratings = PlayerRatings()
+
+# Разбиение игроков на команды по 3 с минимальным разбросом суммарных
+# рейтингов. Жадная раздача (сильнейший — в самую слабую неполную команду)
+# даёт хорошее начало, затем локальный поиск обменивает игроков между
+# командами. Дисперсия сумм определяется суммой их квадратов, а обмен
+# игроков a и b между командами i и j меняет её на 2d(S_i - S_j) + 2d^2,
+# где d = r_b - r_a, — каждый кандидат оценивается за O(1) без пересчёта.
+def balance_teams(players: List[str], ratings: PlayerRatings, team_size: int = 3,
+                  rng: Optional[random.Random] = None, max_passes: int = 50,
+                  tolerance: float = 10.0) -> List[List[str]]:
+    rng = rng or random.Random()
+    order = players[:]
+    rng.shuffle(order)  # равные рейтинги распределяются случайно
+    values = {name: ratings.get(name) for name in order}
+    order.sort(key=values.__getitem__, reverse=True)
+
+    count = len(players) // team_size
+    teams: List[List[str]] = [[] for _ in range(count)]
+    sums = [0.0] * count
+    for name in order:
+        i = min((t for t in range(count) if len(teams[t]) < team_size), key=sums.__getitem__)
+        teams[i].append(name)
+        sums[i] += values[name]
+
+    def try_swap(i: int, j: int) -> bool:
+        gap = sums[i] - sums[j]
+        best, best_a, best_b = -1e-9, -1, -1
+        for a, pa in enumerate(teams[i]):
+            ra = values[pa]
+            for b, pb in enumerate(teams[j]):
+                d = values[pb] - ra
+                delta = 2 * d * (gap + d)
+                if delta < best:
+                    best, best_a, best_b = delta, a, b
+        if best_a < 0:
+            return False
+        pa, pb = teams[i][best_a], teams[j][best_b]
+        teams[i][best_a], teams[j][best_b] = pb, pa
+        d = values[pb] - values[pa]
+        sums[i] += d
+        sums[j] -= d
+        return True
+
+    # Сначала дёшево: тяжёлые команды в паре с лёгкими (k/2 пар за проход);
+    # когда так улучшить уже нельзя — полный перебор всех пар команд
+    for _ in range(max_passes):
+        # Разница средних рейтингов команд в несколько очков уже ничего не значит
+        if (max(sums) - min(sums)) / team_size <= tolerance:
+            break
+        ranked = sorted(range(count), key=sums.__getitem__)
+        improved = False
+        for i, j in zip(reversed(ranked), ranked[:count // 2]):
+            improved |= try_swap(i, j)
+        if not improved:
+            improved = any([try_swap(i, j) for i in range(count) for j in range(i + 1, count)])
+        if not improved:
+            break
+    return teams
+
+# ======================
+# Статистика
+# ======================
+
+# Сводная статистика по игрокам и командам (ключ — имя без учёта регистра)
+# хранится готовой и меняется только на вклад одного турнира: прибавляется
+# при сохранении и вычитается при удалении, поэтому запросы не трогают
+# историю. При остановке таблица сохраняется рядом с историей, при запуске
+# берётся оттуда, а если снимка нет или он от другой истории — собирается
+# тем же проходом по истории, что и рейтинги.
+class StatLine:
+    __slots__ = ("name", "tournaments", "titles", "podiums", "won", "drawn", "lost", "scored", "conceded")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.tournaments = self.titles = self.podiums = 0
+        self.won = self.drawn = self.lost = self.scored = self.conceded = 0
+
+    FIELDS = __slots__[1:]
+
+    def add(self, other: "StatLine", sign: int):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + sign * getattr(other, field))
+
+    @property
+    def sort_key(self) -> tuple:
+        return self.titles, self.podiums, self.won, self.scored - self.conceded
+
+# Места турнира: сохранённые при записи или, для старых записей
+# олимпийской системы, восстановленные по финалу и матчу за 3-е место
+def record_places(record: dict, stages: List[List[Match]]) -> List[int]:
+    if "places" in record:
+        return record["places"]
+    final = stages[-1] if stages else []
+    places = []
+    for match in final:
+        if match.w is not None and not match.third:
+            places = [match.w, match.loser]
+    for match in final:
+        if match.w is not None and match.third:
+            places.append(match.w)
+    return [place for place in places if place is not None]
+
+def tournament_stats(record: dict) -> Tuple[Dict[str, StatLine], Dict[str, StatLine]]:
+    teams, stages = decode_tournament(record)
+    team_lines = [StatLine(team["name"]) for team in teams]
+    for stage in stages:
+        for match in stage:
+            if not match.played or match.t1 is None or match.t2 is None:
+                continue
+            for team, scored, conceded in ((match.t1, match.s1, match.s2), (match.t2, match.s2, match.s1)):
+                line = team_lines[team]
+                line.scored += scored
+                line.conceded += conceded
+                if scored > conceded:
+                    line.won += 1
+                elif scored < conceded:
+                    line.lost += 1
+                else:
+                    line.drawn += 1
+    for place, team in enumerate(record_places(record, stages)):
+        team_lines[team].podiums += 1
+        team_lines[team].titles += place == 0
+
+    by_team: Dict[str, StatLine] = {}
+    by_player: Dict[str, StatLine] = {}
+    for team, line in zip(teams, team_lines):
+        line.tournaments = 1
+        for table, name in [(by_team, team["name"])] + [(by_player, p) for p in team["players"]]:
+            key = PlayerRatings.key(name)
+            if key in table:
+                continue  # одно имя дважды в турнире учитываем один раз
+            share = table[key] = StatLine(name)
+            share.add(line, 1)
+    return by_player, by_team
+
+class HistoryStats:
+    def __init__(self):
+        self.players: Dict[str, StatLine] = {}
+        self.teams: Dict[str, StatLine] = {}
+        self.applied = set()
+        self.ready = False
+        self._pending: List[tuple] = []
+        self._leaders: Dict[str, List[StatLine]] = {}
+
+    def apply(self, tid: str, record: dict, sign: int):
+        if not self.ready:
+            self._pending.append((tid, record, sign))
+            return
+        self._apply(tid, record, sign)
+
+    def _apply(self, tid: str, record: dict, sign: int):
+        # Повторное сохранение и удаление несохранённого ничего не меняют
+        if (tid in self.applied) == (sign > 0):
+            return
+        if sign > 0:
+            self.applied.add(tid)
+        else:
+            self.applied.discard(tid)
+        for table, lines in zip((self.players, self.teams), tournament_stats(record)):
+            for key, line in lines.items():
+                total = table.get(key)
+                if total is None:
+                    total = table[key] = StatLine(line.name)
+                total.add(line, sign)
+                if total.tournaments <= 0:
+                    del table[key]
+        self._leaders.clear()
+
+    def adopt(self, table: "HistoryStats"):
+        self.players, self.teams, self.applied = table.players, table.teams, table.applied
+        self.ready = True
+        for args in self._pending:
+            self._apply(*args)
+        self._pending.clear()
+        self._leaders.clear()
+
+    def leaderboard(self, kind: str) -> List[StatLine]:
+        if kind not in self._leaders:
+            table = self.players if kind == "players" else self.teams
+            self._leaders[kind] = sorted(table.values(), key=lambda line: line.sort_key, reverse=True)
+        return self._leaders[kind]
+
+history_stats = HistoryStats()
+history_service.listeners.append(history_stats.apply)
+
+# Рейтинги только по сохранённой истории — ровно то, что дал бы пересчёт при
+# запуске; их и сохраняем. Удалённый турнир из них не вычесть, поэтому после
+# удаления снимок не пишется до следующего пересчёта.
+class HistoryRatings:
+    def __init__(self):
+        self.table = PlayerRatings()
+        self.stale = False
+        self.ready = False
+        self._pending: List[dict] = []
+
+    def apply(self, tid: str, record: dict, sign: int):
+        if sign < 0:
+            self.stale = True
+        elif not self.ready:
+            self._pending.append(record)
+        else:
+            self.table.replay_tournament(record)
+
+    def adopt(self, table: PlayerRatings):
+        self.table = table
+        for record in self._pending:
+            table.replay_tournament(record)
+        self._pending.clear()
+        self.ready = True
+
+history_ratings = HistoryRatings()
+history_service.listeners.append(history_ratings.apply)
+
+# Снимок агрегатов годен, только если снят с той же версией расчёта и с
+# того же набора турниров, что сейчас в истории
+AGGREGATES_SIDECAR = "aggregates"
+AGGREGATES_VERSION = 1
+
+def aggregates_snapshot() -> Optional[dict]:
+    if not (history_stats.ready and history_ratings.ready) or history_ratings.stale:
+        return None
+    table = history_ratings.table
+    return {
+        "v": AGGREGATES_VERSION,
+        "rating": [RATING_START, RATING_K],
+        "applied": sorted(history_stats.applied, key=int),
+        "ratings": table.ratings,
+        "games": table.games,
+        "players": {key: [line.name] + [getattr(line, f) for f in StatLine.FIELDS]
+                    for key, line in history_stats.players.items()},
+        "teams": {key: [line.name] + [getattr(line, f) for f in StatLine.FIELDS]
+                  for key, line in history_stats.teams.items()},
+    }
+
+def restore_aggregates(snapshot: dict, tids: List[str]) -> Optional[Tuple[PlayerRatings, HistoryStats]]:
+    if snapshot.get("v") != AGGREGATES_VERSION or snapshot.get("rating") != [RATING_START, RATING_K] \
+            or set(snapshot["applied"]) != set(tids):
+        return None
+    ratings, stats = PlayerRatings(), HistoryStats()
+    ratings.ratings, ratings.games = snapshot["ratings"], snapshot["games"]
+    stats.applied = set(snapshot["applied"])
+    for table, rows in ((stats.players, snapshot["players"]), (stats.teams, snapshot["teams"])):
+        for key, (name, *values) in rows.items():
+            line = table[key] = StatLine(name)
+            for field, value in zip(StatLine.FIELDS, values):
+                setattr(line, field, value)
+    return ratings, stats
+
+async def load_history_aggregates():
+    tids = (await history_service.index()).oldest_first()
+    # Снимок удаляется сразу: после сбоя он уже не соответствовал бы истории
+    snapshot = await history_service.read_sidecar(AGGREGATES_SIDECAR)
+    await history_service.write_sidecar(AGGREGATES_SIDECAR, None)
+    restored = restore_aggregates(snapshot, tids) if snapshot is not None else None
+    if restored is not None:
+        ratings, stats = restored
+    else:
+        ratings, stats = PlayerRatings(), HistoryStats()
+
+        def feed(tid: str, record: dict):
+            ratings.replay_tournament(record)
+            stats.apply(tid, record, 1)
+
+        stats.ready = True
+        await history_service.replay(feed, tids=tids)
+    live = PlayerRatings()
+    live.ratings, live.games = dict(ratings.ratings), dict(ratings.games)
+    player_ratings.adopt(live)
+    history_ratings.adopt(ratings)
+    history_stats.adopt(stats)
+    logging.info("История %s: игроков %d, команд %d", "загружена из снимка" if restored else "пересчитана",
+                 len(stats.players), len(stats.teams))
+
+async def save_history_aggregates():
+    await history_service.write_sidecar(AGGREGATES_SIDECAR, aggregates_snapshot())
+
+# Загрузка агрегатов идёт фоном после запуска; задача хранится, чтобы
+# остановка отменила её до закрытия хранилища
+class AggregatesLoader:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._load())
+
+    async def _load(self):
+        try:
+            await load_history_aggregates()
+        except Exception:
+            logging.exception("Ошибка загрузки агрегатов истории")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+aggregates_loader = AggregatesLoader()
+
+# ======================
+# Массовая регистрация
+# ======================
+
+# Команды и игроки можно прислать разом: одним сообщением (команды
+# разделены пустой строкой, игроки — по одному на строку) или файлом
+# CSV/JSON. Всё разбирается и проверяется за один проход; при ошибках
+# ничего не добавляется, а все ошибки приходят одним ответом.
+BULK_FILE_LIMIT = 512 * 1024
+BULK_MAX_ERRORS = 20
+BULK_FILE_EXTENSIONS = ("csv", "json")
+
+def make_team(fields: List[str], where: str) -> Tuple[Optional[dict], Optional[str]]:
+    fields = [str(field).strip() for field in fields]
+    if len(fields) != 4:
+        return None, f"{where}: нужно 4 поля — название и 3 участника, а их {len(fields)}"
+    if not all(fields):
+        return None, f"{where}: все поля обязательны"
+    return {"name": fields[0], "players": fields[1:]}, None
+
+def split_team_blocks(text: str) -> List[List[str]]:
+    blocks, current = [], []
+    for line in text.strip().split("\n"):
+        if line.strip():
+            current.append(line)
+        elif current:
+            blocks.append(current)
+            current = []
+    if current:
+        blocks.append(current)
+    return blocks
+
+def parse_team_text(text: str) -> Tuple[List[dict], List[str]]:
+    teams, errors = [], []
+    for n, block in enumerate(split_team_blocks(text), 1):
+        team, error = make_team(block, f"Команда {n}")
+        if error:
+            errors.append(error)
+        else:
+            teams.append(team)
+    return teams, errors
+
+def parse_player_text(text: str) -> List[str]:
+    return [line.strip() for line in text.split("\n") if line.strip()]
+
+def read_document(file_name: str, data: bytes):
+    """Возвращает строки CSV (списки полей) или разобранный JSON."""
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("❌ Файл должен быть в кодировке UTF-8.")
+    if file_name.lower().endswith(".json"):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"❌ Некорректный JSON: {e}")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    try:
+        return [row for row in csv.reader(io.StringIO(text), dialect) if any(cell.strip() for cell in row)]
+    except csv.Error as e:
+        raise ValueError(f"❌ Некорректный CSV: {e}")
+
+# Заголовок CSV узнаём по первой ячейке
+CSV_HEADER_NAMES = {"name", "team", "player", "название", "команда", "игрок", "имя"}
+
+def _skip_csv_header(rows: List[List[str]]) -> Tuple[List[List[str]], int]:
+    if rows and rows[0] and rows[0][0].strip().lower() in CSV_HEADER_NAMES:
+        return rows[1:], 2
+    return rows, 1
+
+def parse_team_document(file_name: str, data: bytes) -> Tuple[List[dict], List[str]]:
+    content = read_document(file_name, data)
+    if file_name.lower().endswith(".json"):
+        if isinstance(content, dict):
+            content = content.get("teams")
+        if not isinstance(content, list):
+            return [], ["Ожидается список команд: [{\"name\": ..., \"players\": [...]}, ...]"]
+        rows = []
+        for item in content:
+            if isinstance(item, dict) and isinstance(item.get("players"), list):
+                rows.append([item.get("name", "")] + item["players"])
+            else:
+                rows.append(item if isinstance(item, list) else None)
+        first, where = 1, "Запись"
+    else:
+        rows, first = _skip_csv_header(content)
+        where = "Строка"
+
+    teams, errors = [], []
+    for n, row in enumerate(rows, first):
+        if row is None:
+            errors.append(f"{where} {n}: ожидается объект с полями name и players")
+            continue
+        team, error = make_team(row, f"{where} {n}")
+        if error:
+            errors.append(error)
+        else:
+            teams.append(team)
+    return teams, errors
+
+def parse_player_document(file_name: str, data: bytes) -> Tuple[List[str], List[str]]:
+    content = read_document(file_name, data)
+    if isinstance(content, dict):
+        content = content.get("players")
+    if not isinstance(content, list):
+        return [], ["Ожидается список игроков: [\"Имя 1\", \"Имя 2\", ...]"]
+    if file_name.lower().endswith(".json"):
+        players, errors = [], []
+        for n, item in enumerate(content, 1):
+            if isinstance(item, str) and item.strip():
+                players.append(item.strip())
+            else:
+                errors.append(f"Запись {n}: имя игрока должно быть непустой строкой")
+        return players, errors
+    rows, _ = _skip_csv_header(content)
+    return [row[0].strip() for row in rows if row and row[0].strip()], []
+
+def check_team_batch(teams: List[dict], existing: List[dict], remaining: Optional[int]) -> List[str]:
+    errors = []
+    seen = {team["name"].casefold() for team in existing}
+    for team in teams:
+        key = team["name"].casefold()
+        if key in seen:
+            errors.append(f"Команда '{team['name']}' уже есть в турнире")
+        seen.add(key)
+    if remaining is not None and len(teams) > remaining:
+        errors.append(f"Команд больше, чем свободных мест: {len(teams)} из {remaining}")
+    return errors
+
+def bulk_error_text(errors: List[str]) -> str:
+    lines = [f"❌ Ошибок: {len(errors)}. Ничего не добавлено, исправь и пришли заново:"]
+    lines += [f"• {error}" for error in errors[:BULK_MAX_ERRORS]]
+    if len(errors) > BULK_MAX_ERRORS:
+        lines.append(f"…и ещё {len(errors) - BULK_MAX_ERRORS}")
+    return "\n".join(lines)
+
+async def download_document(update: Update) -> Tuple[Optional[str], Optional[bytes]]:
+    """Скачивает присланный файл; при ошибке отвечает пользователю и возвращает (None, None)."""
+    document = update.message.document
+    name = document.file_name or ""
+    if not name.lower().endswith(tuple("." + ext for ext in BULK_FILE_EXTENSIONS)):
+        await update.message.reply_text("❌ Поддерживаются только файлы .csv и .json.")
+        return None, None
+    if document.file_size and document.file_size > BULK_FILE_LIMIT:
+        await update.message.reply_text(f"❌ Файл слишком большой (максимум {BULK_FILE_LIMIT // 1024} КБ).")
+        return None, None
+    file = await document.get_file()
+    return name, bytes(await file.download_as_bytearray())
 
 # ======================
 # Обработчики команд
@@ -89,18 +2461,45 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Вот что я умею:\n\n"
         "🔹 **/tournament <название>**\n"
         "   Создать турнир с ручным вводом команд.\n"
-        "   Поддерживаемые размеры: 2, 4, 8 или 16 команд.\n"
+        "   От 2 до 256 команд: выбери 2, 4, 8, 16 кнопкой или отправь число.\n"
+        "   Недостающие до сетки места — проход без игры для сильнейших посевов.\n"
+        "   Команды можно прислать пачкой через пустую строку\n"
+        "   или файлом .csv (название;участник 1;участник 2;участник 3) / .json.\n"
+        "   Форматы: олимпийская система, двойное выбывание,\n"
+        "   круговая система (до 32 команд) и швейцарская система.\n"
         "   Пример: `/tournament Кубок чемпионов`\n\n"
         "🔹 **/random_tournament <название>**\n"
         "   Создать турнир, куда игроки регистрируются по одному.\n"
-        "   Бот сам распределит их по командам и сетке.\n"
-        "   Поддерживаемые размеры: 6 или 12 игроков.\n"
+        "   Бот сам распределит их по командам и сетке,\n"
+        "   уравнивая команды по рейтингу игроков (Эло по прошлым матчам).\n"
+        f"   Число игроков — кратное 3, от 6 до {MAX_TEAMS * 3}.\n"
+        "   Имена можно прислать списком или файлом .csv/.json.\n"
         "   Пример: `/random_tournament Летний микс`\n\n"
-        "🔹 **/historytournament**\n"
-        "   Просмотреть список всех завершённых турниров.\n"
-        "   Можно посмотреть детали или удалить турнир.\n\n"
+        "🔹 **/historytournament [название] [с:дд.мм.гггг] [по:дд.мм.гггг]**\n"
+        "   Просмотреть завершённые турниры (по страницам, новые сверху).\n"
+        "   Можно отфильтровать по началу названия и датам,\n"
+        "   посмотреть детали или удалить турнир.\n"
+        "   Пример: `/historytournament Кубок с:01.01.2025`\n\n"
+        "🔹 **Ввод результатов**\n"
+        "   Нажми кнопку матча под сеткой и ответь на сообщение бота счётом.\n"
+        "   В группе результаты может вводить любой участник, несколько\n"
+        "   турниров в одном чате идут независимо.\n\n"
+        "🔹 **/undo**\n"
+        "   Отменить последний введённый результат (ответом на сетку —\n"
+        "   в этом турнире). Любой результат можно исправить кнопкой\n"
+        "   «✏️ Исправить результат» под сеткой.\n\n"
+        "🔹 **/export [id] [png|html|csv]**\n"
+        "   Выгрузить турнир из истории картинкой сетки, страницей HTML\n"
+        "   и таблицей результатов. Без id — последний завершённый турнир\n"
+        "   чата; то же есть кнопками на карточке турнира.\n\n"
+        "🔹 **/stats <игрок или команда>**\n"
+        "   Победы, призовые места, матчи и рейтинг по всей истории.\n\n"
+        "🔹 **/leaderboard [команды]**\n"
+        "   Лучшие игроки (или команды) по победам в турнирах.\n\n"
         "🔹 **/cancel**\n"
-        "   Отменить создание турнира на любом этапе.\n\n"
+        "   Отменить создание турнира на любом этапе, а после старта —\n"
+        "   идущий турнир (ответом на сетку — именно этот). В чате может\n"
+        f"   идти не больше {CHAT_TOURNAMENTS_LIMIT} турниров одновременно.\n\n"
         "💡 После завершения турнира результаты сохраняются автоматически.\n"
         "🏆 В турнирах от 4 команд есть матч за 3-е место!"
     )
@@ -111,42 +2510,157 @@ async def start_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not args:
         await update.message.reply_text("Используй: /tournament <название турнира>")
         return ConversationHandler.END
+    if chat_is_full(context):
+        await update.message.reply_text(TOURNAMENTS_FULL_TEXT)
+        return ConversationHandler.END
 
     tournament_name = " ".join(args)
     context.user_data.clear()
     context.user_data["tournament_name"] = tournament_name
     context.user_data["teams"] = []
+    context.user_data["format"] = SingleElimination.key
+
+    reply_markup = size_keyboard(SingleElimination.key)
+    await update.message.reply_text(
+        f"Выбери размер турнира или отправь число команд (от 2 до {MAX_TEAMS}):",
+        reply_markup=reply_markup
+    )
+    return SELECT_SIZE
+
+# Кнопки выбора формата под кнопками размера; выбранный отмечен галочкой
+def format_buttons(selected: str, prefix: str) -> List[List[InlineKeyboardButton]]:
+    buttons = [
+        InlineKeyboardButton(("✅ " if key == selected else "") + cls.title, callback_data=f"{prefix}_{key}")
+        for key, cls in SCHEDULERS.items()
+    ]
+    return [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
 
+def size_keyboard(fmt: str) -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton("Турнир 2 команды", callback_data="size_2")],
         [InlineKeyboardButton("Турнир 4 команды", callback_data="size_4")],
         [InlineKeyboardButton("Турнир 8 команд", callback_data="size_8")],
         [InlineKeyboardButton("Турнир 16 команд", callback_data="size_16")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выбери размер турнира:", reply_markup=reply_markup)
+    return InlineKeyboardMarkup(keyboard + format_buttons(fmt, "fmt"))
+
+def team_count_error(fmt: str, size: int) -> Optional[str]:
+    cls = SCHEDULERS[fmt]
+    if not cls.min_teams <= size <= cls.max_teams:
+        return f"❌ {cls.title}: нужно от {cls.min_teams} до {cls.max_teams} команд."
+    return None
+
+async def select_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    fmt = query.data.split("_", 1)[1]
+    if fmt in SCHEDULERS and fmt != context.user_data.get("format"):
+        context.user_data["format"] = fmt
+        await query.edit_message_reply_markup(size_keyboard(fmt))
     return SELECT_SIZE
 
+def size_prompt(size: int) -> str:
+    return (
+        f"Начинаем сбор данных для турнира на {size} команд.\n"
+        "Отправь данные первой команды в формате:\n"
+        "Название команды\nУчастник 1\nУчастник 2\nУчастник 3\n\n"
+        "Можно прислать сразу несколько команд через пустую строку "
+        "или файл .csv/.json со всеми командами."
+    )
+
 async def select_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     size = int(query.data.split("_")[1])
-    allowed_sizes = {2, 4, 8, 16}
-    if size not in allowed_sizes:
+    if not 2 <= size <= MAX_TEAMS:
         await query.edit_message_text("Недопустимый размер турнира.")
         return ConversationHandler.END
+    error = team_count_error(context.user_data.get("format", SingleElimination.key), size)
+    if error:
+        await query.message.reply_text(error)
+        return SELECT_SIZE
 
     context.user_data["size"] = size
     context.user_data["current_team_index"] = 0
 
-    await query.edit_message_text(
-        f"Начинаем сбор данных для турнира на {size} команд.\n"
-        "Отправь данные первой команды в формате:\n"
-        "Название команды\nУчастник 1\nУчастник 2\nУчастник 3"
-    )
+    await query.edit_message_text(size_prompt(size))
+    return COLLECTING_TEAMS
+
+async def select_size_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    # Вместо числа можно сразу прислать все команды — размер возьмём по ним
+    if "\n" in text:
+        teams, errors = parse_team_text(text)
+        return await register_teams(update, context, teams, errors, SELECT_SIZE)
+    if not text.isdigit() or not 2 <= int(text) <= MAX_TEAMS:
+        await update.message.reply_text(f"❌ Отправь число от 2 до {MAX_TEAMS}.")
+        return SELECT_SIZE
+
+    size = int(text)
+    error = team_count_error(context.user_data.get("format", SingleElimination.key), size)
+    if error:
+        await update.message.reply_text(error)
+        return SELECT_SIZE
+    context.user_data["size"] = size
+    context.user_data["current_team_index"] = 0
+
+    await update.message.reply_text(size_prompt(size))
     return COLLECTING_TEAMS
 
+async def select_size_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await collect_teams_document(update, context, SELECT_SIZE)
+
+async def collect_teams_document(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 state: int = COLLECTING_TEAMS):
+    file_name, data = await download_document(update)
+    if data is None:
+        return state
+    try:
+        teams, errors = parse_team_document(file_name, data)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return state
+    return await register_teams(update, context, teams, errors, state)
+
+# Добавляет пачку команд целиком или не добавляет ничего. На шаге выбора
+# размера размер турнира равен числу присланных команд.
+async def register_teams(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                         teams: List[dict], errors: List[str], state: int):
+    existing = context.user_data["teams"]
+    if state == SELECT_SIZE:
+        remaining = None
+        if teams and not errors:
+            size_error = team_count_error(context.user_data.get("format", SingleElimination.key), len(teams))
+            if size_error:
+                errors.append(size_error.lstrip("❌ "))
+    else:
+        remaining = context.user_data["size"] - len(existing)
+    errors += check_team_batch(teams, existing, remaining)
+    if not teams and not errors:
+        errors.append("Не найдено ни одной команды")
+    if errors:
+        await update.message.reply_text(bulk_error_text(errors))
+        return state
+
+    if state == SELECT_SIZE:
+        context.user_data["size"] = len(teams)
+    existing.extend(teams)
+    left = context.user_data["size"] - len(existing)
+    if left:
+        await update.message.reply_text(
+            f"✅ Добавлено команд: {len(teams)}\nОсталось: {left}\n"
+            "Отправь следующие команды (можно несколько, через пустую строку):"
+        )
+        return COLLECTING_TEAMS
+    state = start_bracket(update, context)
+    await show_bracket(update, context, state)
+    return ConversationHandler.END
+
 async def collect_teams(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(split_team_blocks(update.message.text)) > 1:
+        teams, errors = parse_team_text(update.message.text)
+        return await register_teams(update, context, teams, errors, COLLECTING_TEAMS)
+
     text = update.message.text.strip().split("\n")
     if len(text) != 4:
         await update.message.reply_text("❌ Неверный формат!\nДолжно быть ровно 4 строки:\nНазвание\nУчастник 1\nУчастник 2\nУчастник 3")
@@ -158,6 +2672,10 @@ async def collect_teams(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return COLLECTING_TEAMS
 
     team = {"name": name, "players": [p1, p2, p3]}
+    errors = check_team_batch([team], context.user_data["teams"], None)
+    if errors:
+        await update.message.reply_text(f"❌ {errors[0]}")
+        return COLLECTING_TEAMS
     context.user_data["teams"].append(team)
     current = len(context.user_data["teams"])
     total = context.user_data["size"]
@@ -169,10 +2687,9 @@ async def collect_teams(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return COLLECTING_TEAMS
     else:
-        bracket = generate_bracket(context.user_data["teams"])
-        context.user_data["bracket"] = [bracket]
-        await show_bracket(update, context)
-        return ENTERING_RESULT
+        state = start_bracket(update, context)
+        await show_bracket(update, context, state)
+        return ConversationHandler.END
 
 # ================
 # РАНДОМ-ТУРНИР
@@ -183,34 +2700,136 @@ async def start_random_tournament(update: Update, context: ContextTypes.DEFAULT_
     if not args:
         await update.message.reply_text("Используй: /random_tournament <название>")
         return ConversationHandler.END
+    if chat_is_full(context):
+        await update.message.reply_text(TOURNAMENTS_FULL_TEXT)
+        return ConversationHandler.END
 
     context.user_data.clear()
     context.user_data["tournament_name"] = " ".join(args)
+    context.user_data["format"] = SingleElimination.key
+
+    reply_markup = random_size_keyboard(SingleElimination.key)
+    await update.message.reply_text(
+        "Сколько игроков будет участвовать?\n"
+        "Можно отправить число игроков (кратное 3) или сразу список имён\n"
+        "(по одному на строку) либо файл .csv/.json.",
+        reply_markup=reply_markup
+    )
+    return SELECT_RANDOM_SIZE
 
+def random_size_keyboard(fmt: str) -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton("6 игроков (2 команды)", callback_data="random_6")],
         [InlineKeyboardButton("12 игроков (4 команды)", callback_data="random_12")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Сколько игроков будет участвовать?", reply_markup=reply_markup)
+    return InlineKeyboardMarkup(keyboard + format_buttons(fmt, "rfmt"))
+
+async def select_random_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    fmt = query.data.split("_", 1)[1]
+    if fmt in SCHEDULERS and fmt != context.user_data.get("format"):
+        context.user_data["format"] = fmt
+        await query.edit_message_reply_markup(random_size_keyboard(fmt))
     return SELECT_RANDOM_SIZE
 
+RANDOM_MAX_PLAYERS = MAX_TEAMS * 3
+
+def random_size_error(fmt: str, num: int) -> Optional[str]:
+    if num % 3 or not 6 <= num <= RANDOM_MAX_PLAYERS:
+        return f"❌ Число игроков должно делиться на 3: от 6 до {RANDOM_MAX_PLAYERS}."
+    return team_count_error(fmt, num // 3)
+
+def random_players_prompt(num: int) -> str:
+    return (
+        f"Отлично! Ожидаю {num} игроков.\nОтправь имя первого игрока.\n"
+        "Можно прислать сразу несколько имён, по одному на строку, или файл .csv/.json."
+    )
+
 async def select_random_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     num = int(query.data.split("_")[1])
-    if num not in (6, 12):
-        await query.edit_message_text("Поддерживаются только 6 или 12 игроков.")
-        return ConversationHandler.END
+    error = random_size_error(context.user_data.get("format", SingleElimination.key), num)
+    if error:
+        await query.message.reply_text(error)
+        return SELECT_RANDOM_SIZE
 
     context.user_data["total_players"] = num
     context.user_data["players"] = []
     context.user_data["current_player"] = 0
 
-    await query.edit_message_text(f"Отлично! Ожидаю {num} игроков.\nОтправь имя первого игрока:")
+    await query.edit_message_text(random_players_prompt(num))
     return COLLECTING_RANDOM_PLAYERS
 
+async def select_random_size_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if text.isdigit():
+        num = int(text)
+        error = random_size_error(context.user_data.get("format", SingleElimination.key), num)
+        if error:
+            await update.message.reply_text(error)
+            return SELECT_RANDOM_SIZE
+        context.user_data["total_players"] = num
+        context.user_data["players"] = []
+        context.user_data["current_player"] = 0
+        await update.message.reply_text(random_players_prompt(num))
+        return COLLECTING_RANDOM_PLAYERS
+    players = parse_player_text(text)
+    return await register_players(update, context, players, [], SELECT_RANDOM_SIZE)
+
+async def select_random_size_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await collect_random_players_document(update, context, SELECT_RANDOM_SIZE)
+
+async def collect_random_players_document(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                          state: int = COLLECTING_RANDOM_PLAYERS):
+    file_name, data = await download_document(update)
+    if data is None:
+        return state
+    try:
+        players, errors = parse_player_document(file_name, data)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return state
+    return await register_players(update, context, players, errors, state)
+
+# Как register_teams, но для игроков рандом-турнира: на шаге выбора
+# размера число имён должно делиться на 3
+async def register_players(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                           players: List[str], errors: List[str], state: int):
+    if state == SELECT_RANDOM_SIZE:
+        if not errors:
+            size_error = random_size_error(context.user_data.get("format", SingleElimination.key), len(players))
+            if size_error:
+                errors.append(f"{size_error.lstrip('❌ ')} Прислано: {len(players)}")
+    else:
+        remaining = context.user_data["total_players"] - len(context.user_data["players"])
+        if len(players) > remaining:
+            errors.append(f"Игроков больше, чем свободных мест: {len(players)} из {remaining}")
+        if not players and not errors:
+            errors.append("Не найдено ни одного имени")
+    if errors:
+        await update.message.reply_text(bulk_error_text(errors))
+        return state
+
+    if state == SELECT_RANDOM_SIZE:
+        context.user_data["total_players"] = len(players)
+        context.user_data["players"] = []
+    context.user_data["players"].extend(players)
+    left = context.user_data["total_players"] - len(context.user_data["players"])
+    if left:
+        await update.message.reply_text(
+            f"✅ Добавлено игроков: {len(players)}\nОсталось: {left}\n"
+            "Отправь следующих игроков (по одному на строку):"
+        )
+        return COLLECTING_RANDOM_PLAYERS
+    return await finish_random_players(update, context)
+
 async def collect_random_players(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if "\n" in update.message.text.strip():
+        players = parse_player_text(update.message.text)
+        return await register_players(update, context, players, [], COLLECTING_RANDOM_PLAYERS)
+
     player_name = update.message.text.strip()
     if not player_name:
         await update.message.reply_text("Имя не может быть пустым. Попробуй ещё раз.")
@@ -224,109 +2843,439 @@ async def collect_random_players(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text(f"✅ Игрок '{player_name}' добавлен!\nОсталось: {total - current}\nОтправь следующего игрока:")
         return COLLECTING_RANDOM_PLAYERS
     else:
-        players = context.user_data["players"][:]
-        random.shuffle(players)
-        teams = []
-        team_letters = ['A', 'B', 'C', 'D']
-        for i in range(0, len(players), 3):
-            team_players = players[i:i+3]
-            team_name = f"Команда {team_letters[len(teams)]}"
-            teams.append({"name": team_name, "players": team_players})
-
-        context.user_data["teams"] = teams
-        context.user_data["size"] = len(teams)
+        return await finish_random_players(update, context)
+
+def random_team_name(i: int) -> str:
+    return f"Команда {chr(ord('A') + i)}" if i < 26 else f"Команда {i + 1}"
+
+async def finish_random_players(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    groups = balance_teams(context.user_data["players"], player_ratings)
+    teams = [{"name": random_team_name(i), "players": group} for i, group in enumerate(groups)]
+
+    context.user_data["teams"] = teams
+    state = start_bracket(update, context)
+
+    lines = [f"{team['name']} — {player_ratings.team_rating(team['players']):.0f}" for team in teams]
+    await update.message.reply_text(
+        "🎲 Игроки распределены по командам и сетке с учётом рейтинга!\n"
+        "Средний рейтинг команд:\n" + "\n".join(lines)
+    )
+    await show_bracket(update, context, state)
+    return ConversationHandler.END
+
+# ======================
+# Основная логика турнира
+# ======================
+
+# Запущенный турнир принадлежит чату, а не создателю: он лежит в
+# chat_data["tournaments"] под коротким id, и результаты в группе может
+# вводить любой участник. Id турнира и матча едут в кнопках и в
+# приглашении ввести счёт, а каждое изменение турнира идёт под его замком.
+CHAT_TOURNAMENTS_LIMIT = 20
+TOURNAMENTS_KEEP_FINISHED = 3
+RESULT_PROMPTS_LIMIT = 50
+SCORE_PATTERN = re.compile(r"^\s*\d+\s*:\s*\d+\s*$")
+
+# Ключи user_data, которые нужны только для сбора турнира
+SETUP_KEYS = ("tournament_name", "teams", "format", "size", "current_team_index",
+              "players", "total_players", "current_player")
+# Ключи user_data, которые не относятся к турниру (для переноса старых турниров)
+USER_KEYS = ("history_filter", "history_page", "current_match", "editing", "tournament",
+             "size", "current_team_index", "players", "total_players", "current_player")
+
+# Замки по ключу; замок удаляется, когда его больше никто не ждёт
+class KeyedLocks:
+    def __init__(self):
+        self._locks: Dict[object, asyncio.Lock] = {}
+        self._waiters: Dict[object, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+tournament_locks = KeyedLocks()
+
+def chat_tournaments(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, dict]:
+    return context.chat_data.setdefault("tournaments", {})
+
+# Завершённых турниров держим несколько последних (для /undo); идущие не
+# трогаем — новый турнир просто не начнётся, пока их CHAT_TOURNAMENTS_LIMIT
+def prune_tournaments(tournaments: Dict[str, dict]):
+    finished = sorted((tid for tid, state in tournaments.items() if state.get("history_id")), key=int)
+    for tid in finished[:-TOURNAMENTS_KEEP_FINISHED]:
+        del tournaments[tid]
+
+# Проверяется при /tournament и /random_tournament: сбор команд, начатый
+# раньше, ещё может довести турниров в чате чуть выше лимита
+def chat_is_full(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    tournaments = context.chat_data.get("tournaments") or {}
+    running = sum(1 for state in tournaments.values() if not state.get("history_id"))
+    return running >= CHAT_TOURNAMENTS_LIMIT
+
+TOURNAMENTS_FULL_TEXT = (f"❌ В чате уже {CHAT_TOURNAMENTS_LIMIT} незавершённых турниров.\n"
+                         "Доиграй или отмени один из них: /cancel ответом на его сетку.")
+
+def add_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict) -> dict:
+    tournaments = chat_tournaments(context)
+    prune_tournaments(tournaments)
+    context.chat_data["next_tournament"] = context.chat_data.get("next_tournament", 0) + 1
+    state["id"] = str(context.chat_data["next_tournament"])
+    tournaments[state["id"]] = state
+    context.user_data["tournament"] = [update.effective_chat.id, state["id"]]
+    return state
+
+def start_bracket(update: Update, context: ContextTypes.DEFAULT_TYPE) -> dict:
+    setup = context.user_data
+    state = {
+        "tournament_name": setup["tournament_name"],
+        "teams": setup["teams"],
+        "seed": random.randrange(2 ** 32),
+    }
+    SCHEDULERS[setup.get("format", SingleElimination.key)].create(state)
+    init_result_log(state)
+    for key in SETUP_KEYS:
+        setup.pop(key, None)
+    return add_tournament(update, context, state)
+
+# Турнир, начатый до переноса турниров в чат, лежит в user_data создателя:
+# переносим его в чат и присылаем сетку с новыми кнопками
+async def adopt_legacy_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.callback_query is not None:
+        await update.callback_query.answer()
+    user_data = context.user_data
+    if "bracket" not in user_data:
+        await update.effective_message.reply_text(
+            "❌ Турнир не найден. Начни новый: /tournament <название>")
+        return ConversationHandler.END
+    state = {key: user_data.pop(key) for key in list(user_data) if key not in USER_KEYS}
+    for key in ("current_match", "editing"):
+        user_data.pop(key, None)
+    state.pop("bracket_message", None)
+    add_tournament(update, context, state)
+    await update.effective_message.reply_text("ℹ️ Турнир перенесён в чат: выбери матч кнопкой под новой сеткой.")
+    if not get_scheduler(state).finished():
+        await show_bracket(update, context, state)
+    return ConversationHandler.END
+
+# Турнир, к которому относится команда: по ответу на сетку или приглашение,
+# иначе последний турнир пользователя в этом чате, иначе самый новый
+def find_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+    tournaments = context.chat_data.get("tournaments") or {}
+    reply = update.message.reply_to_message if update.message else None
+    if reply is not None:
+        prompt = context.chat_data.get("result_prompts", {}).get(str(reply.message_id))
+        if prompt is not None and prompt["tournament"] in tournaments:
+            return prompt["tournament"]
+        for tid, state in tournaments.items():
+            if state.get("bracket_message") == [reply.chat_id, reply.message_id]:
+                return tid
+    mine = context.user_data.get("tournament")
+    if mine and mine[0] == update.effective_chat.id and mine[1] in tournaments:
+        return mine[1]
+    return max(tournaments, key=int, default=None)
+
+def match_at(scheduler: Scheduler, stage: int, pos: int) -> Optional[Match]:
+    stages = scheduler.stages
+    if 0 <= stage < len(stages) and 0 <= pos < len(stages[stage]):
+        return stages[stage][pos]
+    return None
+
+# Приглашение ввести счёт. Ожидаемый матч запоминается и за сообщением
+# (ответ на него однозначен даже при нескольких организаторах), и за
+# пользователем — на случай, если счёт пришлют без ответа
+async def ask_result(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict,
+                     stage: int, pos: int, old: Optional[List[int]] = None):
+    scheduler = get_scheduler(state)
+    match = scheduler.stages[stage][pos]
+    title = "Матч за 3-е место" if match.third else f"{scheduler.stage_title(stage)}, матч {pos + 1}"
+    what = "исправленный счёт" if old is not None else "счёт"
+    message = await update.effective_message.reply_text(
+        f"🔢 {update.effective_user.mention_markdown()}, отправь {what} ответом на это сообщение\n"
+        f"{escape_markdown(state['tournament_name'])} — {escape_markdown(title)}\n"
+        "Формат: `3:2` (счёт команды 1 : команда 2)",
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=ForceReply(selective=True, input_field_placeholder="3:2")
+    )
+    pending = {"tournament": state["id"], "match": [stage, pos], "old": old}
+    prompts = context.chat_data.setdefault("result_prompts", {})
+    prompts[str(message.message_id)] = pending
+    while len(prompts) > RESULT_PROMPTS_LIMIT:
+        del prompts[next(iter(prompts))]
+    context.user_data["current_match"] = dict(pending, chat=update.effective_chat.id)
+    context.user_data["tournament"] = [update.effective_chat.id, state["id"]]
+
+def pending_result(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[dict]:
+    reply = update.message.reply_to_message
+    if reply is not None:
+        pending = context.chat_data.get("result_prompts", {}).get(str(reply.message_id))
+        if pending is not None:
+            return pending
+    pending = context.user_data.get("current_match")
+    if isinstance(pending, dict) and pending.get("chat") == update.effective_chat.id:
+        return pending
+    return None
+
+def drop_pending(context: ContextTypes.DEFAULT_TYPE, tid: str, stage: int, pos: int):
+    prompts = context.chat_data.get("result_prompts", {})
+    for key in [key for key, p in prompts.items() if p["tournament"] == tid and p["match"] == [stage, pos]]:
+        del prompts[key]
+    current = context.user_data.get("current_match")
+    if isinstance(current, dict) and current["tournament"] == tid and current["match"] == [stage, pos]:
+        del context.user_data["current_match"]
+
+# ======================
+# Отображение сетки
+# ======================
+
+# Сетка живёт в одном сообщении, которое редактируется по мере ввода
+# результатов. Текст каждого матча и его кнопка кэшируются и
+# перерисовываются только для изменившихся матчей; правка отправляется,
+# только если итоговый текст или кнопки поменялись, а серия быстрых
+# обновлений за BRACKET_EDIT_DELAY сливается в одну правку. Правку
+# отправляет задача приложения: её ошибки уходят в process_error, а
+# Application.stop её дожидается.
+class BracketView:
+    def __init__(self):
+        self.blocks: Dict[Tuple[int, int], str] = {}
+        self.buttons: Dict[Tuple[int, int], Optional[InlineKeyboardButton]] = {}
+        self.stage_visible: Dict[int, bool] = {}
+        self.sent: Optional[tuple] = None
+        self.dirty: set = set()
+        self.flush_task: Optional[asyncio.Task] = None
+        # (bot, state) правки, которая не дошла; отправляется при следующей
+        # правке или при остановке
+        self.unsent: Optional[tuple] = None
+        self.renders = 0
+
+    def invalidate(self, keys):
+        for stage, pos in keys:
+            self.blocks.pop((stage, pos), None)
+            self.buttons.pop((stage, pos), None)
+            self.stage_visible.pop(stage, None)
+
+    def _render_match(self, scheduler: Scheduler, state: dict, stage: int, pos: int):
+        teams = state["teams"]
+        match = scheduler.stages[stage][pos]
+        self.renders += 1
+        if match.bye or (match.t1 is None and match.t2 is None):
+            block = ""
+        else:
+            block = "🥉 **Матч за 3-е место:**\n" if match.third else f"**Матч {pos+1}:**\n"
+            team2_name = team_name(teams, match.t2)
+            if match.played:
+                block += f"{team_name(teams, match.t1)} {match.s1}:{match.s2} {team2_name}\n\n"
+            else:
+                block += f"{team_name(teams, match.t1)} — {team2_name}\n\n"
+        button = None
+        if match.playable:
+            label = "Матч за 3-е место" if match.third else f"{scheduler.stage_title(stage)}, матч {pos+1}"
+            button = InlineKeyboardButton(f"Ввести результат: {label}",
+                                          callback_data=f"match_{state['id']}_{stage}_{pos}")
+        self.blocks[(stage, pos)] = block
+        self.buttons[(stage, pos)] = button
 
-        bracket = generate_bracket(teams)
-        context.user_data["bracket"] = [bracket]
+    # Круговая и швейцарская системы показывают только текущий тур — таблица
+    # и так отражает сыгранное; что не влезло в лимит, обрезается
+    def render(self, scheduler: Scheduler, state: dict, final: bool = False):
+        teams = state["teams"]
+        header = f"**Турнир: {state['tournament_name']}** ({scheduler.title})\n\n"
+        parts = []
+        buttons = []
+        for stage_idx, stage in enumerate(scheduler.stages):
+            visible = self.stage_visible.get(stage_idx)
+            if visible is None:
+                visible = self.stage_visible[stage_idx] = any(m.playable for m in stage)
+            if final:
+                visible = stage_idx == len(scheduler.stages) - 1
+            if not visible or (scheduler.has_table and parts):
+                continue
+            parts.append(f"**{scheduler.stage_title(stage_idx)}**\n\n")
+            for pos in range(len(stage)):
+                if (stage_idx, pos) not in self.blocks:
+                    self._render_match(scheduler, state, stage_idx, pos)
+                parts.append(self.blocks[(stage_idx, pos)])
+                button = self.buttons[(stage_idx, pos)]
+                if button is not None and not final and len(buttons) < BRACKET_MAX_BUTTONS - 1:
+                    buttons.append([button])
+        table = standings_text(teams, state["standings"], BRACKET_TABLE_LIMIT) if scheduler.has_table else ""
+        limit = BRACKET_TEXT_LIMIT - len(header) - len(table) - len(BRACKET_CUT_NOTE)
+        pages = list(paginate_blocks(parts, limit))
+        text = header + (pages[0] if pages else "") + (BRACKET_CUT_NOTE if len(pages) > 1 else "") + table
+        if not final and state.get("results"):
+            buttons.append([InlineKeyboardButton("✏️ Исправить результат", callback_data=f"fixlist_{state['id']}")])
+        return text, InlineKeyboardMarkup(buttons) if buttons else None
 
-        await update.message.reply_text("🎲 Игроки распределены по командам и сетке!")
-        await show_bracket(update, context)
-        return ENTERING_RESULT
+    @staticmethod
+    def signature(text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> tuple:
+        if reply_markup is None:
+            return text, ()
+        return text, tuple(row[0].callback_data for row in reply_markup.inline_keyboard)
 
-# ======================
-# Основная логика турнира
-# ======================
+# Кэш представлений по сообщению сетки; после перезапуска представление
+# один раз строится заново
+bracket_views = LRUCache(1024)
 
-async def show_bracket(update: Update, context: ContextTypes.DEFAULT_TYPE, edit=False):
-    stages = context.user_data["bracket"]
-    current_stage = stages[-1]
+def view_key(state: dict) -> str:
+    chat_id, message_id = state["bracket_message"]
+    return f"{chat_id}:{message_id}"
 
-    # Проверка: все матчи в стадии завершены?
-    if all(m["score1"] is not None for m in current_stage):
-        total_teams = context.user_data["size"]
-        final_match = None
-        third_match = None
-        for m in current_stage:
-            if m.get("is_third_place"):
-                third_match = m
-            else:
-                final_match = m
+def get_bracket_view(state: dict) -> BracketView:
+    key = view_key(state)
+    view = bracket_views.get(key)
+    if view is None:
+        view = BracketView()
+        bracket_views.put(key, view)
+    return view
 
-        if total_teams == 2:
-            winner_name = current_stage[0]["winner"]["name"]
-            msg = f"🏆 **Победитель турнира '{context.user_data['tournament_name']}'**: {winner_name}!\n\n"
-        else:
-            winner_name = final_match["winner"]["name"]
-            msg = f"🏆 **Победитель**: {winner_name}\n"
-            if third_match:
-                third_name = third_match["winner"]["name"]
-                msg += f"🥉 **3-е место**: {third_name}\n"
-            msg += "\n"
+def schedule_bracket_edit(application: Application, state: dict, changed: List[Tuple[int, int]]):
+    view = get_bracket_view(state)
+    view.dirty.update(changed)
+    if view.flush_task is None or view.flush_task.done():
+        view.flush_task = application.create_task(_delayed_bracket_flush(application.bot, state))
 
-        history = load_history()
-        tournament_id = str(int(datetime.now().timestamp()))
-        history[tournament_id] = {
-            "name": context.user_data["tournament_name"],
-            "date": datetime.now().strftime("%d.%m.%Y %H:%M"),
-            "stages": context.user_data["bracket"]
-        }
-        save_history(history)
-        msg += "✅ Турнир сохранён в историю."
-        if edit:
-            await update.callback_query.edit_message_text(msg, parse_mode=ParseMode.MARKDOWN)
-        else:
-            await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+async def _delayed_bracket_flush(bot, state: dict):
+    await asyncio.sleep(BRACKET_EDIT_DELAY)
+    await flush_bracket_view(bot, state)
+
+async def flush_bracket_view(bot, state: dict, final: bool = False):
+    if state.get("bracket_message") is None:
         return
+    view = get_bracket_view(state)
+    if final and view.flush_task is not None and not view.flush_task.done() \
+            and view.flush_task is not asyncio.current_task():
+        view.flush_task.cancel()
+    view.invalidate(view.dirty)
+    view.dirty.clear()
+    text, reply_markup = view.render(get_scheduler(state), state, final)
+    signature = view.signature(text, reply_markup)
+    if signature == view.sent:
+        return
+    chat_id, message_id = state["bracket_message"]
+    view.unsent = (bot, state)
+    try:
+        await bot.edit_message_text(
+            text, chat_id=chat_id, message_id=message_id,
+            parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            # Сообщение удалено или слишком старое — присылаем сетку заново
+            logging.warning("Не удалось обновить сетку: %s", e)
+            message = await bot.send_message(
+                chat_id, text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup
+            )
+            state["bracket_message"] = [message.chat_id, message.message_id]
+            bracket_views.put(view_key(state), view)
+    view.unsent = None
+    view.sent = signature
 
-    full_msg = f"**Турнир: {context.user_data['tournament_name']}**\n\n"
-    for idx, match in enumerate(current_stage):
-        if match.get("is_third_place"):
-            full_msg += "🥉 **Матч за 3-е место:**\n"
-        else:
-            full_msg += f"**Матч {idx+1}:**\n"
-        team2_name = match["team2"]["name"] if match["team2"] else "—"
-        if match["score1"] is not None:
-            full_msg += f"{match['team1']['name']} {match['score1']}:{match['score2']} {team2_name}\n"
+# При остановке: дождаться отложенных правок и повторить не дошедшие
+async def flush_bracket_views(application: Application):
+    views = bracket_views.values()
+    pending = [view.flush_task for view in views if view.flush_task is not None and not view.flush_task.done()]
+    await asyncio.gather(*pending, return_exceptions=True)
+    for view in views:
+        if view.unsent is not None:
+            bot, state = view.unsent
+            try:
+                await flush_bracket_view(bot, state)
+            except Exception:
+                logging.exception("Не удалось обновить сетку при остановке")
+
+async def show_bracket(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict,
+                       changed: Optional[List[Tuple[int, int]]] = None):
+    scheduler = get_scheduler(state)
+    stages = scheduler.stages
+    teams = state["teams"]
+
+    if scheduler.finished():
+        places = scheduler.placements()
+        if len(places) < 3:
+            winner_name = team_name(teams, places[0])
+            msg = f"🏆 **Победитель турнира '{state['tournament_name']}'**: {winner_name}!\n\n"
         else:
-            full_msg += f"{match['team1']['name']} — {team2_name}\n"
-        full_msg += "\n"
+            msg = f"🏆 **Победитель**: {team_name(teams, places[0])}\n"
+            msg += f"🥈 **2-е место**: {team_name(teams, places[1])}\n"
+            msg += f"🥉 **3-е место**: {team_name(teams, places[2])}\n"
+            msg += "\n"
+        if scheduler.has_table:
+            msg += standings_text(teams, state["standings"], BRACKET_TABLE_LIMIT) + "\n\n"
 
-    buttons = []
-    for idx, match in enumerate(current_stage):
-        if match["score1"] is None:
-            label = "Матч за 3-е место" if match.get("is_third_place") else f"Матч {idx+1}"
-            buttons.append([InlineKeyboardButton(f"Ввести результат: {label}", callback_data=f"match_{idx}")])
+        tournament_id = await history_service.new_id()
+        await history_service.put(tournament_id, encode_tournament(
+            state["tournament_name"],
+            datetime.now().strftime(HISTORY_DATE_FORMAT),
+            teams,
+            stages,
+            state.get("seed"),
+            scheduler.key,
+            places,
+            None if state.get("log_base") else state.get("events")
+        ))
+        state["history_id"] = tournament_id
+        msg += "✅ Турнир сохранён в историю. Ошибку в счёте ещё можно исправить: /undo"
+        # Убираем кнопки с сообщения сетки и сразу отправляем итог
+        if state.get("bracket_message") is not None:
+            get_bracket_view(state).dirty.update(changed or [])
+            await flush_bracket_view(context.bot, state, final=True)
+        await update.effective_message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        return
 
-    reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
+    if state.get("bracket_message") is None:
+        view = BracketView()
+        text, reply_markup = view.render(scheduler, state)
+        message = await update.effective_message.reply_text(
+            text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup
+        )
+        state["bracket_message"] = [message.chat_id, message.message_id]
+        view.sent = view.signature(text, reply_markup)
+        bracket_views.put(view_key(state), view)
+        return
 
-    if edit:
-        await update.callback_query.edit_message_text(full_msg, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-    else:
-        await update.message.reply_text(full_msg, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+    schedule_bracket_edit(context.application, state, changed or [])
 
 async def match_result_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    parts = query.data.split("_")
+    if len(parts) != 4:
+        return await adopt_legacy_tournament(update, context)
     await query.answer()
-    match_idx = int(query.data.split("_")[1])
-    context.user_data["current_match_idx"] = match_idx
-    await query.message.reply_text("🔢 Отправь результат в формате: `3:2` (счёт команды 1 : команда 2)")
-    return ENTERING_RESULT
+    tid, stage, pos = parts[1], int(parts[2]), int(parts[3])
+    state = chat_tournaments(context).get(tid)
+    if state is None:
+        await query.message.reply_text("❌ Турнир не найден.")
+        return
+    match = match_at(get_scheduler(state), stage, pos)
+    if match is None or not match.playable:
+        await query.message.reply_text("❌ Этот матч уже сыгран или ещё не определён.")
+        return
+    await ask_result(update, context, state, stage, pos)
 
+# Счёт применяется под замком турнира и только если матч всё ещё в том
+# виде, в каком его выбрали: несыгран (или с тем же счётом при исправлении)
 async def enter_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
+    pending = pending_result(update, context)
+    if pending is None:
+        if SCORE_PATTERN.match(text) and context.chat_data.get("tournaments"):
+            await update.message.reply_text("❌ Сначала выбери матч кнопкой под сеткой.")
+        return
+
     if ":" not in text:
         await update.message.reply_text("❌ Неверный формат! Используй `X:Y`, например `3:1`")
-        return ENTERING_RESULT
+        return
 
     try:
         s1, s2 = map(int, text.split(":"))
@@ -334,80 +3283,228 @@ async def enter_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
             raise ValueError
     except ValueError:
         await update.message.reply_text("❌ Счёт должен содержать неотрицательные целые числа!")
-        return ENTERING_RESULT
-
-    match_idx = context.user_data["current_match_idx"]
-    stages = context.user_data["bracket"]
-    current_stage = stages[-1]
-    match = current_stage[match_idx]
-    match["score1"] = s1
-    match["score2"] = s2
-    match["winner"] = match["team1"] if s1 > s2 else match["team2"]
-
-    total_teams = context.user_data["size"]
-
-    # После полуфиналов (2 матча) в турнире ≥4 → создаём финал + матч за 3-е
-    if len(current_stage) == 2 and all(m["score1"] is not None for m in current_stage) and total_teams >= 4:
-        winners = [m["winner"] for m in current_stage]
-        losers = []
-        for m in current_stage:
-            loser = m["team2"] if m["winner"] == m["team1"] else m["team1"]
-            losers.append(loser)
-        
-        final_match = {
-            "team1": winners[0],
-            "team2": winners[1],
-            "score1": None,
-            "score2": None,
-            "winner": None
-        }
-        third_match = {
-            "team1": losers[0],
-            "team2": losers[1],
-            "score1": None,
-            "score2": None,
-            "winner": None,
-            "is_third_place": True
-        }
-        next_stage = [final_match, third_match]
-        context.user_data["bracket"].append(next_stage)
-        await show_bracket(update, context)
-        return ENTERING_RESULT
-
-    # Проверка завершения всей стадии (включая финал + 3-е место)
-    if all(m["score1"] is not None for m in current_stage):
-        await show_bracket(update, context)
-        return ENTERING_RESULT
-
-    # Обычный переход (8→4 и т.д.)
-    winners = [m["winner"] for m in current_stage if m["winner"]]
-    if len(winners) > 2:
-        next_stage = generate_bracket(winners)
-        context.user_data["bracket"].append(next_stage)
-        await show_bracket(update, context)
-        return ENTERING_RESULT
-
-    await show_bracket(update, context)
-    return ENTERING_RESULT
+        return
+
+    tid, (stage, pos), old = pending["tournament"], pending["match"], pending.get("old")
+    async with tournament_locks.hold((update.effective_chat.id, tid)):
+        state = chat_tournaments(context).get(tid)
+        if state is None:
+            drop_pending(context, tid, stage, pos)
+            await update.message.reply_text("❌ Турнир не найден.")
+            return
+        scheduler = get_scheduler(state)
+        if s1 == s2 and not scheduler.allows_draws:
+            await update.message.reply_text("❌ В плей-офф ничьих не бывает — введи счёт с победителем.")
+            return
+        match = match_at(scheduler, stage, pos)
+        drop_pending(context, tid, stage, pos)
+        if old is None and (match is None or not match.playable):
+            await update.message.reply_text("❌ Этот матч уже сыгран или ещё не определён — выбери матч кнопкой под сеткой.")
+            return
+        if old is not None and (match is None or not match.played or [match.s1, match.s2] != old):
+            await update.message.reply_text("❌ Этот результат уже изменили — выбери его заново через «✏️ Исправить результат».")
+            return
+
+        context.user_data["tournament"] = [update.effective_chat.id, tid]
+        ensure_result_log(state)
+        teams = state["teams"]
+        if old is not None:
+            reopened = await reopen_tournament(state)
+            old, new, dropped = edit_result(state, stage, pos, s1, s2)
+            for entry in [old] + dropped:
+                revert_result_rating(teams, entry)
+            new.append(player_ratings.record_match(teams[new[4]]["players"], teams[new[5]]["players"], s1, s2))
+            text = "✏️ Результат исправлен."
+            if dropped:
+                text += f"\nСброшено зависевших от него результатов: {len(dropped)} — введи их заново."
+            if reopened:
+                text += "\nТурнир снова открыт и убран из истории до завершения."
+            await update.message.reply_text(text)
+            await refresh_bracket(update, context, state)
+            return
+
+        scheduler, entry = log_result(state, stage, pos, s1, s2)
+        entry.append(player_ratings.record_match(teams[entry[4]]["players"], teams[entry[5]]["players"], s1, s2))
+        await show_bracket(update, context, state, scheduler.changed)
+
+# Турнир, начатый до появления журнала результатов: журнал ведётся с
+# текущего состояния, более ранние результаты не отменить. Из посева такой
+# журнал сетку не восстановит (log_base), поэтому в историю идут стадии
+def ensure_result_log(state: dict):
+    if "events" not in state:
+        init_result_log(state)
+        state["log_base"] = True
+
+def revert_result_rating(teams: List[dict], entry: list):
+    if len(entry) > 6:
+        stage, pos, s1, s2, t1, t2, delta = entry[:7]
+        player_ratings.revert(teams[t1]["players"], teams[t2]["players"], s1, s2, delta)
+
+# Правка завершённого турнира снимает его из истории; при повторном
+# завершении он сохранится заново
+async def reopen_tournament(state: dict) -> bool:
+    tid = state.pop("history_id", None)
+    if tid is None:
+        return False
+    await history_service.delete(tid)
+    return True
+
+# После отката меняется произвольная часть сетки — представление строится заново
+async def refresh_bracket(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
+    if state.get("bracket_message") is not None:
+        bracket_views.invalidate(view_key(state))
+    await show_bracket(update, context, state, [])
+
+def result_label(scheduler: Scheduler, teams: List[dict], entry: list) -> str:
+    stage, pos, s1, s2, t1, t2 = entry[:6]
+    match = scheduler.stages[stage][pos]
+    title = "Матч за 3-е место" if match.third else f"{scheduler.stage_title(stage)}, матч {pos + 1}"
+    return f"{title}: {team_name(teams, t1)} {s1}:{s2} {team_name(teams, t2)}"
+
+async def undo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tid = find_tournament(update, context)
+    if tid is None:
+        if "bracket" in context.user_data:
+            return await adopt_legacy_tournament(update, context)
+        await update.message.reply_text("Отменять нечего: в этом чате нет турниров.")
+        return
+    async with tournament_locks.hold((update.effective_chat.id, tid)):
+        state = chat_tournaments(context).get(tid)
+        if state is None:
+            await update.message.reply_text("❌ Турнир не найден.")
+            return
+        ensure_result_log(state)
+        if not state["results"]:
+            await update.message.reply_text("Отменять нечего: результатов ещё нет.")
+            return
+        reopened = await reopen_tournament(state)
+        entry = undo_result(state)
+        revert_result_rating(state["teams"], entry)
+        drop_pending(context, tid, entry[0], entry[1])
+        text = f"↩️ {state['tournament_name']}: отменён результат — {result_label(get_scheduler(state), state['teams'], entry)}"
+        if reopened:
+            text += "\nТурнир снова открыт и убран из истории до завершения."
+        await update.message.reply_text(text)
+        await refresh_bracket(update, context, state)
+
+RESULT_FIX_CHOICES = 20
+
+async def fix_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if "_" not in query.data:
+        return await adopt_legacy_tournament(update, context)
+    await query.answer()
+    tid = query.data.split("_", 1)[1]
+    state = chat_tournaments(context).get(tid)
+    results = (state or {}).get("results") or []
+    if not results:
+        await query.message.reply_text("Исправлять нечего: результатов ещё нет.")
+        return
+    scheduler = get_scheduler(state)
+    keyboard = [
+        [InlineKeyboardButton(result_label(scheduler, state["teams"], entry),
+                              callback_data=f"fix_{tid}_{entry[0]}_{entry[1]}")]
+        for entry in reversed(results[-RESULT_FIX_CHOICES:])
+    ]
+    await query.message.reply_text("Какой результат исправить? (последние сверху)",
+                                   reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def fix_result_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    parts = query.data.split("_")
+    if len(parts) != 4:
+        return await adopt_legacy_tournament(update, context)
+    await query.answer()
+    tid, stage, pos = parts[1], int(parts[2]), int(parts[3])
+    state = chat_tournaments(context).get(tid)
+    match = match_at(get_scheduler(state), stage, pos) if state is not None else None
+    if match is None or not match.played:
+        await query.message.reply_text("❌ Этот результат уже отменён.")
+        return
+    await query.edit_message_text("✏️ Исправляем результат — " + result_label(
+        get_scheduler(state), state["teams"], [stage, pos, match.s1, match.s2, match.t1, match.t2]))
+    await ask_result(update, context, state, stage, pos, [match.s1, match.s2])
 
 # ======================
 # История
 # ======================
 
-async def history_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    history = load_history()
-    if not history:
-        await update.message.reply_text("📁 История турниров пуста.")
-        return
+# Фильтр из аргументов: префикс названия, "с:дд.мм.гггг", "по:дд.мм.гггг"
+def parse_history_filter(args: List[str]) -> dict:
+    words = []
+    history_filter = {"prefix": "", "from": None, "to": None}
+    for arg in args:
+        key, sep, value = arg.partition(":")
+        if sep and key.lower() in ("с", "по"):
+            try:
+                day = datetime.strptime(value, "%d.%m.%Y")
+            except ValueError:
+                raise ValueError(f"❌ Неверная дата: {value}. Используй формат дд.мм.гггг")
+            if key.lower() == "с":
+                history_filter["from"] = day.timestamp()
+            else:
+                history_filter["to"] = day.timestamp() + 24 * 60 * 60 - 1
+        else:
+            words.append(arg)
+    history_filter["prefix"] = " ".join(words)
+    return history_filter
 
+async def render_history_page(history_filter: dict, page: int):
+    index = await history_service.index()
+    tids, total = index.page(page, HISTORY_PAGE_SIZE, history_filter["prefix"],
+                             history_filter["from"], history_filter["to"])
+    if not total:
+        return None, None
+    pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
     buttons = []
-    for tid, data in history.items():
+    for tid in tids:
+        data = index.summaries[tid]
         label = f"{data['name']} ({data['date']})"
         buttons.append([InlineKeyboardButton(label, callback_data=f"view_{tid}")])
 
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅", callback_data=f"hpage_{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("➡", callback_data=f"hpage_{page + 1}"))
+    if nav:
+        buttons.append(nav)
     buttons.append([InlineKeyboardButton("➕ Создать новый турнир", callback_data="new_tournament")])
-    reply_markup = InlineKeyboardMarkup(buttons)
-    await update.message.reply_text("📁 История турниров:", reply_markup=reply_markup)
+    text = f"📁 История турниров (стр. {page + 1}/{pages}, всего {total}):"
+    return text, InlineKeyboardMarkup(buttons)
+
+async def history_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        history_filter = parse_history_filter(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    context.user_data["history_filter"] = history_filter
+    context.user_data["history_page"] = 0
+
+    text, reply_markup = await render_history_page(history_filter, 0)
+    if text is None:
+        await update.message.reply_text("📁 История турниров пуста.")
+        return
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def show_history_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int):
+    query = update.callback_query
+    history_filter = context.user_data.get("history_filter") or parse_history_filter([])
+    text, reply_markup = await render_history_page(history_filter, page)
+    if text is None and page > 0:
+        page = 0
+        text, reply_markup = await render_history_page(history_filter, page)
+    if text is None:
+        await query.edit_message_text("📁 История турниров пуста.")
+        return
+    context.user_data["history_page"] = page
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def history_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await show_history_page(update, context, int(query.data.split("_")[1]))
 
 async def view_tournament_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -419,108 +3516,1380 @@ async def view_tournament_callback(update: Update, context: ContextTypes.DEFAULT
         return
 
     tid = data.split("_", 1)[1]
-    history = load_history()
-    tournament = history.get(tid)
-    if not tournament:
-        await query.edit_message_text("❌ Турнир не найден.")
-        return
+    await show_tournament_page(query, tid, 0)
 
-    msg = f"**{tournament['name']}**\n📅 Дата: {tournament['date']}\n\n"
-    for i, stage in enumerate(tournament["stages"]):
-        msg += f"**Стадия {i + 1}:**\n"
-        for match in stage:
-            team2_name = match["team2"]["name"] if match["team2"] else "—"
-            if match.get("is_third_place"):
-                msg += "🥉 **Матч за 3-е место:**\n"
-            if match["score1"] is not None:
-                msg += f"{match['team1']['name']} {match['score1']}:{match['score2']} {team2_name}\n"
-                msg += f"👥 Участники:\n{format_team(match['team1'])}\n{format_team(match['team2'])}\n\n"
-            else:
-                msg += f"{match['team1']['name']} — {team2_name}\n\n"
+async def show_tournament_page(query, tid: str, page: int):
+    pages = history_service.rendered.get(tid)
+    if pages is None:
+        tournament = await history_service.get(tid)
+        if not tournament:
+            await query.edit_message_text("❌ Турнир не найден.")
+            return
+        pages = render_tournament_pages(tournament)
+        history_service.rendered.put(tid, pages)
+    page = min(max(page, 0), len(pages) - 1)
+
+    buttons = []
+    if len(pages) > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("⬅", callback_data=f"tpage_{tid}_{page - 1}"))
+        nav.append(InlineKeyboardButton(f"стр. {page + 1}/{len(pages)}", callback_data=f"tpage_{tid}_{page}"))
+        if page + 1 < len(pages):
+            nav.append(InlineKeyboardButton("➡", callback_data=f"tpage_{tid}_{page + 1}"))
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(label, callback_data=f"export_{kind}_{tid}")
+                    for kind, (label, _) in EXPORT_KINDS.items()])
+    buttons.append([InlineKeyboardButton("🗑 Удалить турнир", callback_data=f"delete_{tid}")])
+    buttons.append([InlineKeyboardButton("⬅ Назад к списку", callback_data="back_to_history")])
+    reply_markup = InlineKeyboardMarkup(buttons)
 
-    del_button = InlineKeyboardButton("🗑 Удалить турнир", callback_data=f"delete_{tid}")
-    back_button = InlineKeyboardButton("⬅ Назад к списку", callback_data="back_to_history")
-    reply_markup = InlineKeyboardMarkup([[del_button], [back_button]])
+    try:
+        await query.edit_message_text(pages[page], parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
 
-    await query.edit_message_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+async def tournament_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    tid, page = query.data.split("_", 1)[1].rsplit("_", 1)
+    await show_tournament_page(query, tid, int(page))
 
 async def delete_tournament_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     tid = query.data.split("_", 1)[1]
-    history = load_history()
-    if tid in history:
-        del history[tid]
-        save_history(history)
+    if await history_service.delete(tid):
         await query.edit_message_text("✅ Турнир удалён из истории.")
     else:
         await query.edit_message_text("❌ Турнир уже удалён.")
 
 async def back_to_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await history_tournament(update, context)
+    await update.callback_query.answer()
+    await show_history_page(update, context, context.user_data.get("history_page", 0))
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    for key in SETUP_KEYS:
+        context.user_data.pop(key, None)
     await update.message.reply_text("⏹ Создание турнира отменено.")
     return ConversationHandler.END
 
+# /cancel вне сбора команд отменяет идущий турнир чата — тот же, что
+# выбрал бы /undo. Турнир убирается из чата без записи в историю, кнопки
+# с его сетки снимаются
+async def cancel_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tid = find_tournament(update, context)
+    if tid is None:
+        await update.message.reply_text("Отменять нечего: в этом чате нет турниров.")
+        return
+    async with tournament_locks.hold((update.effective_chat.id, tid)):
+        tournaments = chat_tournaments(context)
+        state = tournaments.get(tid)
+        if state is None:
+            await update.message.reply_text("❌ Турнир не найден.")
+            return
+        if state.get("history_id"):
+            await update.message.reply_text(
+                f"Турнир «{state['tournament_name']}» уже завершён и сохранён в историю — "
+                "удалить его можно из /historytournament.")
+            return
+        del tournaments[tid]
+        prompts = context.chat_data.get("result_prompts", {})
+        for key in [key for key, p in prompts.items() if p["tournament"] == tid]:
+            del prompts[key]
+        current = context.user_data.get("current_match")
+        if isinstance(current, dict) and current["tournament"] == tid:
+            del context.user_data["current_match"]
+        if state.get("bracket_message") is not None:
+            view = bracket_views.get(view_key(state))
+            if view is not None and view.flush_task is not None:
+                view.flush_task.cancel()
+            bracket_views.invalidate(view_key(state))
+            chat_id, message_id = state["bracket_message"]
+            try:
+                await context.bot.edit_message_reply_markup(chat_id, message_id, reply_markup=None)
+            except BadRequest as e:
+                logging.warning("Не удалось снять кнопки с сетки: %s", e)
+    await update.message.reply_text(f"⏹ Турнир «{state['tournament_name']}» отменён.")
+
+# ======================
+# Статистика и рейтинг
+# ======================
+
+LEADERBOARD_SIZE = 10
+
+def stat_line_text(line: StatLine) -> str:
+    return (
+        f"🏆 Турниров: {line.tournaments}, побед: {line.titles}, призовых мест: {line.podiums}\n"
+        f"⚔️ Матчи: {line.won}-{line.drawn}-{line.lost} (В-Н-П), "
+        f"счёт {line.scored}:{line.conceded} ({line.scored - line.conceded:+d})"
+    )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("Используй: /stats <имя игрока или название команды>")
+        return
+    if not history_stats.ready:
+        await update.message.reply_text("⏳ Статистика ещё собирается, попробуй через минуту.")
+        return
+    key = PlayerRatings.key(" ".join(context.args))
+    parts = []
+    player = history_stats.players.get(key)
+    if player is not None:
+        rating = f"📈 Рейтинг: {player_ratings.get(player.name):.0f}"
+        parts.append(f"👤 Игрок {player.name}\n{stat_line_text(player)}\n{rating}")
+    team = history_stats.teams.get(key)
+    if team is not None:
+        parts.append(f"👥 Команда {team.name}\n{stat_line_text(team)}")
+    if not parts:
+        await update.message.reply_text("❌ Нет сыгранных турниров с таким игроком или командой.")
+        return
+    await update.message.reply_text("\n\n".join(parts))
+
+async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    kind = "teams" if context.args and context.args[0].lower().startswith("команд") else "players"
+    if not history_stats.ready:
+        await update.message.reply_text("⏳ Статистика ещё собирается, попробуй через минуту.")
+        return
+    leaders = history_stats.leaderboard(kind)[:LEADERBOARD_SIZE]
+    if not leaders:
+        await update.message.reply_text("📁 История турниров пуста.")
+        return
+    title = "👥 Лучшие команды" if kind == "teams" else "👤 Лучшие игроки"
+    lines = [f"{title} (победы, призовые места, выигранные матчи):"]
+    for place, line in enumerate(leaders, 1):
+        lines.append(
+            f"{place}. {line.name} — 🏆{line.titles} 🏅{line.podiums} "
+            f"⚔️{line.won}-{line.drawn}-{line.lost} ({line.scored - line.conceded:+d})"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+# ======================
+# Экспорт
+# ======================
+
+# /export отдаёт турнир из истории картинкой PNG, страницей HTML и таблицей
+# CSV. Отрисовка идёт в пуле процессов (render_export принимает и
+# возвращает только простые данные), готовые файлы кэшируются по id
+# турнира, формату и хэшу записи: правка турнира меняет хэш.
+EXPORT_KINDS = {
+    "png": ("🖼 PNG", "png"),
+    "html": ("🌐 HTML", "html"),
+    "csv": ("📊 CSV", "csv"),
+}
+
+# Сетка и итоги турнира в виде простых данных, общих для всех форматов
+def export_model(record: dict) -> dict:
+    teams, stages = decode_tournament(record)
+    scheduler_cls = SCHEDULERS.get(record.get("format"))
+    if scheduler_cls is not None:
+        scheduler = scheduler_cls({"teams": teams, "bracket": stages, "format": record.get("format")})
+        titles = [scheduler.stage_title(i) for i in range(len(stages))]
+    else:
+        titles = [stage_title(stages, i) for i in range(len(stages))]
+    model_stages = []
+    for i, stage in enumerate(stages):
+        matches = []
+        for pos, match in enumerate(stage):
+            if match.bye or (match.t1 is None and match.t2 is None):
+                matches.append(None)
+                continue
+            matches.append({
+                "pos": pos,
+                "third": match.third,
+                "t1": team_name(teams, match.t1),
+                "t2": team_name(teams, match.t2),
+                "p1": teams[match.t1]["players"] if match.t1 is not None else [],
+                "p2": teams[match.t2]["players"] if match.t2 is not None else [],
+                "s1": match.s1,
+                "s2": match.s2,
+                "winner": 1 if match.w is not None and match.w == match.t1 else 2 if match.w is not None else 0,
+            })
+        model_stages.append({"title": titles[i], "matches": matches})
+    standings = []
+    if scheduler_cls is not None and scheduler_cls.has_table:
+        table = compute_standings(len(teams), stages)
+        standings = [[teams[t]["name"]] + table[t] for t in ranking(table)]
+    return {
+        "name": record["name"],
+        "date": record["date"],
+        "format": scheduler_cls.title if scheduler_cls is not None else SingleElimination.title,
+        "tree": scheduler_cls is None or scheduler_cls is SingleElimination,
+        "stages": model_stages,
+        "places": [teams[t]["name"] for t in record_places(record, stages)],
+        "standings": standings,
+    }
+
+def export_csv(model: dict) -> bytes:
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter=";")
+    writer.writerow(["Стадия", "Матч", "Команда 1", "Команда 2", "Счёт 1", "Счёт 2", "Победитель",
+                     "Участники 1", "Участники 2"])
+    for stage in model["stages"]:
+        for match in stage["matches"]:
+            if match is None:
+                continue
+            winner = match["t1"] if match["winner"] == 1 else match["t2"] if match["winner"] == 2 else ""
+            writer.writerow([
+                stage["title"], "3-е место" if match["third"] else match["pos"] + 1,
+                match["t1"], match["t2"],
+                "" if match["s1"] is None else match["s1"], "" if match["s2"] is None else match["s2"],
+                winner, ", ".join(match["p1"]), ", ".join(match["p2"]),
+            ])
+    # BOM — чтобы Excel сразу открыл файл в UTF-8
+    return out.getvalue().encode("utf-8-sig")
+
+HTML_STYLE = """
+body{font-family:system-ui,sans-serif;margin:24px;color:#1e1e28;background:#fff}
+h1{margin:0 0 4px}.meta{color:#667;margin-bottom:20px}
+.bracket{display:flex;gap:24px;overflow-x:auto;align-items:stretch}
+.stage{display:flex;flex-direction:column;justify-content:space-around;min-width:220px}
+.stage h2{font-size:14px;color:#28408c;margin:0 0 8px}
+.match{border:1px solid #a0a6b4;border-radius:6px;background:#f3f4f8;margin:6px 0}
+.match.third{background:#fff5e1}
+.team{display:flex;justify-content:space-between;padding:4px 8px;gap:12px}
+.team+.team{border-top:1px solid #dde}
+.win{font-weight:600;color:#14783c}.empty{visibility:hidden}
+table{border-collapse:collapse;margin-top:24px}td,th{border:1px solid #ccd;padding:4px 10px;text-align:right}
+td:nth-child(2),th:nth-child(2){text-align:left}
+"""
+
+def export_html(model: dict) -> bytes:
+    esc = html.escape
+    parts = [
+        "<!DOCTYPE html><html lang=\"ru\"><head><meta charset=\"utf-8\">",
+        f"<title>{esc(model['name'])}</title><style>{HTML_STYLE}</style></head><body>",
+        f"<h1>{esc(model['name'])}</h1>",
+        f"<div class=\"meta\">{esc(model['date'])} · {esc(model['format'])}</div>",
+    ]
+    if model["places"]:
+        medals = ["🏆", "🥈", "🥉"]
+        parts.append("<p>" + " &nbsp; ".join(f"{medal} {esc(name)}"
+                                               for medal, name in zip(medals, model["places"])) + "</p>")
+    parts.append("<div class=\"bracket\">")
+    for stage in model["stages"]:
+        parts.append(f"<div class=\"stage\"><h2>{esc(stage['title'])}</h2>")
+        for match in stage["matches"]:
+            if match is None:
+                parts.append("<div class=\"match empty\"><div class=\"team\">&nbsp;</div>"
+                             "<div class=\"team\">&nbsp;</div></div>")
+                continue
+            parts.append(f"<div class=\"match{' third' if match['third'] else ''}\">")
+            for side in (1, 2):
+                score = match[f"s{side}"]
+                title = esc(", ".join(match[f"p{side}"]))
+                css = " win" if match["winner"] == side else ""
+                parts.append(f"<div class=\"team{css}\" title=\"{title}\"><span>{esc(match[f't{side}'])}</span>"
+                             f"<span>{'' if score is None else score}</span></div>")
+            parts.append("</div>")
+        parts.append("</div>")
+    parts.append("</div>")
+    if model["standings"]:
+        parts.append("<table><tr><th>#</th><th>Команда</th><th>О</th><th>В</th><th>Н</th><th>П</th>"
+                     "<th>Мячи</th></tr>")
+        for place, (name, pts, wins, draws, losses, scored, conceded) in enumerate(model["standings"], 1):
+            parts.append(f"<tr><td>{place}</td><td>{esc(name)}</td><td>{pts}</td><td>{wins}</td>"
+                         f"<td>{draws}</td><td>{losses}</td><td>{scored}:{conceded}</td></tr>")
+        parts.append("</table>")
+    parts.append("</body></html>")
+    return "".join(parts).encode("utf-8")
+
+# Растровый шрифт 5×7 (строка — 7 байт в hex, старший из 5 бит слева).
+# Строчные буквы рисуются заглавными, незнакомые символы — рамкой.
+PNG_FONT = {
+    " ": "00000000000000", "0": "0E11131519110E", "1": "040C040404040E", "2": "0E11010204081F",
+    "3": "1F02040201110E", "4": "02060A121F0202", "5": "1F101E0101110E", "6": "0608101E11110E",
+    "7": "1F010204080808", "8": "0E11110E11110E", "9": "0E11110F01020C", "A": "0E11111F111111",
+    "B": "1E11111E11111E", "C": "0E11101010110E", "D": "1C12111111121C", "E": "1F10101E10101F",
+    "F": "1F10101E101010", "G": "0E11101711110F", "H": "1111111F111111", "I": "0E04040404040E",
+    "J": "0702020202120C", "K": "11121418141211", "L": "1010101010101F", "M": "111B1515111111",
+    "N": "11111915131111", "O": "0E11111111110E", "P": "1E11111E101010", "Q": "0E11111115120D",
+    "R": "1E11111E141211", "S": "0F10100E01011E", "T": "1F040404040404", "U": "1111111111110E",
+    "V": "11111111110A04", "W": "1111111515150A", "X": "11110A040A1111", "Y": "11110A04040404",
+    "Z": "1F01020408101F", "Б": "1F10101E11111E", "Г": "1F101010101010", "Д": "060A0A0A0A1F11",
+    "Ж": "1515150E151515", "З": "0E11010601110E", "И": "11111315191111", "Й": "0A041113151911",
+    "Л": "07090909090911", "П": "1F111111111111", "У": "1111110F01110E", "Ф": "040E1515150E04",
+    "Ц": "12121212121F01", "Ч": "1111110F010101", "Ш": "1515151515151F", "Щ": "15151515151F01",
+    "Ъ": "1808080E09090E", "Ы": "11111119151519", "Ь": "1010101E11111E", "Э": "0E11010701110E",
+    "Ю": "1215151D151512", "Я": "0F11110F050911", "Ё": "0A1F101E10101F", "-": "0000001F000000",
+    ":": "000C0C000C0C00", ".": "00000000000C0C", ",": "000000000C0408", "!": "04040404040004",
+    "?": "0E110102040004", "(": "02040808080402", ")": "08040202020408", "/": "01010204081010",
+    "#": "0A0A1F0A1F0A0A", "+": "0004041F040400", "_": "0000000000001F", "'": "04040800000000",
+    "\"": "0A0A0000000000", "&": "0C12140815120D", "*": "0004150E150400", "=": "00001F001F0000",
+    "<": "02040810080402", ">": "08040201020408", "@": "0E11171517100F", "%": "18190204081303",
+}
+PNG_FONT_ALIASES = {"А": "A", "В": "B", "Е": "E", "К": "K", "М": "M", "Н": "H", "О": "O", "Р": "P",
+                    "С": "C", "Т": "T", "Х": "X", "—": "-", "–": "-", "«": "\"", "»": "\"", "№": "#"}
+PNG_UNKNOWN = "1F11111111111F"
+PNG_SCALE = 2
+PNG_CHAR = 6 * PNG_SCALE
+PNG_LINE = 7 * PNG_SCALE
+# Палитра: фон, заливка матча, рамка, текст, победитель, линии, заголовок, матч за 3-е место
+PNG_PALETTE = [(255, 255, 255), (243, 244, 248), (160, 166, 180), (30, 30, 40),
+               (20, 120, 60), (120, 126, 140), (40, 64, 140), (255, 245, 225)]
+BG, FILL, BORDER, TEXT, WIN, LINE, TITLE, THIRD = range(8)
+
+@lru_cache(maxsize=None)
+def png_glyph(char: str) -> Tuple[Tuple[int, int], ...]:
+    char = char.upper()
+    rows = PNG_FONT.get(PNG_FONT_ALIASES.get(char, char), PNG_UNKNOWN)
+    return tuple((x, y) for y in range(7) for x in range(5) if int(rows[2 * y:2 * y + 2], 16) & (16 >> x))
+
+# Холст с палитрой: строка — bytearray индексов цветов
+class Canvas:
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.rows = [bytearray(width) for _ in range(height)]
+
+    def rect(self, x: int, y: int, w: int, h: int, color: int):
+        x0, x1 = max(x, 0), min(x + w, self.width)
+        if x1 <= x0:
+            return
+        fill = bytes([color]) * (x1 - x0)
+        for row in self.rows[max(y, 0):max(min(y + h, self.height), 0)]:
+            row[x0:x1] = fill
+
+    def frame(self, x: int, y: int, w: int, h: int, color: int):
+        self.rect(x, y, w, 1, color)
+        self.rect(x, y + h - 1, w, 1, color)
+        self.rect(x, y, 1, h, color)
+        self.rect(x + w - 1, y, 1, h, color)
+
+    def text(self, x: int, y: int, text: str, color: int, limit: Optional[int] = None):
+        if limit is not None and len(text) > limit:
+            text = text[:limit - 1] + "."
+        for i, char in enumerate(text):
+            left = x + i * PNG_CHAR
+            for gx, gy in png_glyph(char):
+                self.rect(left + gx * PNG_SCALE, y + gy * PNG_SCALE, PNG_SCALE, PNG_SCALE, color)
+
+    def png(self, palette: List[Tuple[int, int, int]]) -> bytes:
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+        raw = b"".join(b"\x00" + bytes(row) for row in self.rows)
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 3, 0, 0, 0)
+        return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+                + chunk(b"PLTE", b"".join(bytes(color) for color in palette))
+                + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+PNG_NAME_CHARS = 18
+PNG_MARGIN = 24
+PNG_BOX_W = (PNG_NAME_CHARS + 4) * PNG_CHAR + 12
+PNG_BOX_H = 2 * PNG_LINE + 18
+PNG_GAP_X = 40
+PNG_GAP_Y = 12
+
+# Стадии — колонки, матчи равномерно по высоте: в олимпийской сетке это
+# и есть дерево (стадия вдвое короче предыдущей), его матчи соединяются линиями
+def export_png(model: dict) -> bytes:
+    stages = model["stages"]
+    rows = max([len(stage["matches"]) for stage in stages] + [1])
+    header = PNG_MARGIN + 4 * (PNG_LINE + 8) + 8
+    column_h = rows * (PNG_BOX_H + PNG_GAP_Y)
+    table_w = (PNG_NAME_CHARS + 16) * PNG_CHAR if model["standings"] else 0
+    table_h = (len(model["standings"]) + 2) * (PNG_LINE + 8)
+    width = 2 * PNG_MARGIN + len(stages) * (PNG_BOX_W + PNG_GAP_X) + table_w
+    width = max(width, 2 * PNG_MARGIN + PNG_CHAR * (len(model["name"]) + 2))
+    height = header + max(column_h, table_h) + PNG_MARGIN
+    canvas = Canvas(width, height)
+
+    canvas.text(PNG_MARGIN, PNG_MARGIN, model["name"], TITLE)
+    canvas.text(PNG_MARGIN, PNG_MARGIN + PNG_LINE + 8, f"{model['date']}  {model['format']}", TEXT)
+    if model["places"]:
+        canvas.text(PNG_MARGIN, PNG_MARGIN + 2 * (PNG_LINE + 8),
+                    "  ".join(f"{i}. {name}" for i, name in enumerate(model["places"], 1)), WIN)
+
+    centers = []
+    for col, stage in enumerate(stages):
+        x = PNG_MARGIN + col * (PNG_BOX_W + PNG_GAP_X)
+        canvas.text(x, header - PNG_LINE - 8, stage["title"], TITLE, PNG_BOX_W // PNG_CHAR)
+        slot = column_h / max(len(stage["matches"]), 1)
+        stage_centers = []
+        for pos, match in enumerate(stage["matches"]):
+            center = header + int((pos + 0.5) * slot)
+            stage_centers.append(center)
+            if match is None:
+                continue
+            y = center - PNG_BOX_H // 2
+            canvas.rect(x, y, PNG_BOX_W, PNG_BOX_H, THIRD if match["third"] else FILL)
+            canvas.frame(x, y, PNG_BOX_W, PNG_BOX_H, BORDER)
+            for side in (1, 2):
+                ty = y + 6 + (side - 1) * (PNG_LINE + 6)
+                color = WIN if match["winner"] == side else TEXT
+                canvas.text(x + 6, ty, match[f"t{side}"], color, PNG_NAME_CHARS)
+                score = match[f"s{side}"]
+                if score is not None:
+                    label = str(score)
+                    canvas.text(x + PNG_BOX_W - 6 - len(label) * PNG_CHAR, ty, label, color)
+        centers.append(stage_centers)
+
+    if model["tree"]:
+        for col in range(1, len(stages)):
+            x0 = PNG_MARGIN + col * (PNG_BOX_W + PNG_GAP_X) - PNG_GAP_X
+            for pos, match in enumerate(stages[col]["matches"]):
+                if match is None or match["third"]:
+                    continue
+                for child in (2 * pos, 2 * pos + 1):
+                    if child < len(centers[col - 1]) and stages[col - 1]["matches"][child] is not None:
+                        cy = centers[col - 1][child]
+                        canvas.rect(x0, cy, PNG_GAP_X // 2, 2, LINE)
+                        top, bottom = sorted((cy, centers[col][pos]))
+                        canvas.rect(x0 + PNG_GAP_X // 2, top, 2, bottom - top + 2, LINE)
+                canvas.rect(x0 + PNG_GAP_X // 2, centers[col][pos], PNG_GAP_X // 2, 2, LINE)
+
+    if model["standings"]:
+        x = PNG_MARGIN + len(stages) * (PNG_BOX_W + PNG_GAP_X)
+        canvas.text(x, header - PNG_LINE - 8, "Таблица", TITLE)
+        for place, (name, pts, wins, draws, losses, scored, conceded) in enumerate(model["standings"], 1):
+            y = header + (place - 1) * (PNG_LINE + 8)
+            canvas.text(x, y, f"{place}. {name}"[:PNG_NAME_CHARS + 4], WIN if place <= 3 else TEXT)
+            canvas.text(x + (PNG_NAME_CHARS + 5) * PNG_CHAR, y, f"{pts} {wins}-{draws}-{losses}", TEXT)
+    return canvas.png(PNG_PALETTE)
+
+EXPORT_RENDERERS = {"png": export_png, "html": export_html, "csv": export_csv}
+
+# Точка входа для пула процессов
+def render_export(record: dict, kind: str) -> bytes:
+    return EXPORT_RENDERERS[kind](export_model(record))
+
+def record_digest(record: dict) -> str:
+    payload = json.dumps(record, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+# Пул процессов создаётся при первом экспорте. Одинаковые запросы, пришедшие
+# во время отрисовки, ждут один и тот же результат.
+class ExportService:
+    def __init__(self, workers: int = EXPORT_WORKERS, cache_size: int = EXPORT_CACHE_SIZE):
+        self.workers = workers
+        self.cache = LRUCache(cache_size)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _executor(self) -> Optional[ProcessPoolExecutor]:
+        if self._pool is None and self.workers > 0:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def render(self, tid: str, record: dict, kind: str) -> bytes:
+        key = f"{tid}:{kind}:{record_digest(record)}"
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        future = self._inflight.get(key)
+        if future is None:
+            started = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            future = asyncio.ensure_future(loop.run_in_executor(self._executor(), render_export, record, kind))
+            self._inflight[key] = future
+            try:
+                data = await future
+            finally:
+                del self._inflight[key]
+            if metrics.enabled:
+                metrics.observe("bot_export_seconds", "kind", kind, time.perf_counter() - started)
+            self.cache.put(key, data)
+            return data
+        return await asyncio.shield(future)
+
+    async def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+export_service = ExportService()
+
+def export_filename(name: str, kind: str) -> str:
+    slug = re.sub(r"[^\w\-]+", "_", name).strip("_")[:40] or "tournament"
+    return f"{slug}.{EXPORT_KINDS[kind][1]}"
+
+async def send_export(message, tid: str, kinds: List[str]):
+    record = await history_service.get(tid)
+    if record is None:
+        await message.reply_text("❌ Турнир не найден в истории.")
+        return
+    for kind in kinds:
+        data = await export_service.render(tid, record, kind)
+        await message.reply_document(document=data, filename=export_filename(record["name"], kind))
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args or []
+    kinds = [arg.lower() for arg in args if arg.lower() in EXPORT_KINDS]
+    ids = [arg for arg in args if arg.lower() not in EXPORT_KINDS]
+    tid = ids[0] if ids else None
+    if tid is None:
+        # Без id — последний завершённый турнир этого чата
+        found = find_tournament(update, context)
+        state = chat_tournaments(context).get(found) if found is not None else None
+        tid = state.get("history_id") if state else None
+    if tid is None:
+        await update.message.reply_text(
+            "Используй: /export <id> [png|html|csv]\n"
+            "Без id выгружается последний завершённый турнир этого чата. "
+            "Выгрузить можно и кнопками на карточке турнира в /historytournament."
+        )
+        return
+    await send_export(update.message, tid, kinds or list(EXPORT_KINDS))
+
+async def export_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, kind, tid = query.data.split("_", 2)
+    if kind not in EXPORT_KINDS:
+        return
+    await send_export(query.message, tid, [kind])
+
+# ======================
+# Сохранение состояния
+# ======================
+
+def _encode_state_value(value):
+    if isinstance(value, Match):
+        return {"__match__": value.to_list()}
+    raise TypeError(f"Не умею сохранять {type(value).__name__}")
+
+def _decode_state_value(obj: dict):
+    if "__match__" in obj:
+        return Match.from_list(obj["__match__"])
+    return obj
+
+# Списки и словари раскладываются на строки по элементам
+# ("tournaments/2/bracket/0/3" — матч 3 стадии 0 турнира 2; "…/#" — длина
+# списка, "…/{" — ключи словаря), остальное хранится как JSON. Ключи
+# словарей с "_" в начале живут только в памяти и не сохраняются
+def flatten_state(path: str, value, out: Dict[str, str]):
+    if isinstance(value, list):
+        out[path + "/#"] = str(len(value))
+        for i, item in enumerate(value):
+            flatten_state(f"{path}/{i}", item, out)
+    elif isinstance(value, dict) and value and all(
+            isinstance(key, str) and "/" not in key and key not in ("#", "{") for key in value):
+        keys = [key for key in value if not key.startswith("_")]
+        out[path + "/{"] = json.dumps(keys, ensure_ascii=False)
+        for key in keys:
+            flatten_state(f"{path}/{key}", value[key], out)
+    else:
+        out[path] = json.dumps(value, ensure_ascii=False, default=_encode_state_value)
+
+def unflatten_state(rows: Dict[str, str]) -> dict:
+    def build(path: str):
+        if path + "/#" in rows:
+            return [build(f"{path}/{i}") for i in range(int(rows[path + "/#"]))]
+        if path + "/{" in rows:
+            return {key: build(f"{path}/{key}") for key in json.loads(rows[path + "/{"])}
+        return json.loads(rows[path], object_hook=_decode_state_value)
+
+    keys = {path.split("/", 1)[0] for path in rows}
+    return {key: build(key) for key in keys}
+
+# Персистентность PTB поверх SQLite. Хранится не весь словарь целиком, а
+# отдельные строки: при каждом сбросе пишутся только изменившиеся ключи и
+# матчи. Запись идёт одной транзакцией в фоновом потоке, частота сброса
+# задаётся PERSISTENCE_INTERVAL.
+class SqlitePersistence(BasePersistence):
+    def __init__(self, path: str = PERSISTENCE_FILE, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self._written: Dict[Tuple[str, int], Dict[str, str]] = {}
+        # (SQL, параметры, правка _written): правка — (kind, owner, путь,
+        # значение), значение None — строка удалена, путь None — удалён
+        # владелец; у разговоров правки нет
+        self._pending: List[Tuple[str, tuple, Optional[tuple]]] = []
+        self._commit_task: Optional[asyncio.Future] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS data (kind TEXT NOT NULL, owner INTEGER NOT NULL, "
+                "path TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (kind, owner, path))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, "
+                "state TEXT NOT NULL, PRIMARY KEY (name, key))"
+            )
+            self._db.commit()
+        return self._db
+
+    async def _run(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _write(self, pending: List[Tuple[str, tuple, Optional[tuple]]]):
+        db = self._connect()
+        with db:
+            for sql, params, _ in pending:
+                db.execute(sql, params)
+
+    async def _commit(self):
+        # Все update_* одного прохода PTB запускаются разом — собираем их
+        # изменения в общую транзакцию
+        if self._commit_task is None:
+            self._commit_task = asyncio.ensure_future(self._commit_pending())
+        await asyncio.shield(self._commit_task)
+
+    # _written меняется только после успешной транзакции. Если запись не
+    # удалась, строки данных снова найдутся сравнением при следующем
+    # сбросе, а разговоры и удаления владельцев возвращаются в очередь
+    async def _commit_pending(self):
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, []
+        self._commit_task = None
+        if not pending:
+            return
+        try:
+            await self._run(self._write, pending)
+        except Exception:
+            self._pending[:0] = [item for item in pending if item[2] is None or item[2][2] is None]
+            raise
+        for _, _, change in pending:
+            if change is None:
+                continue
+            kind, owner, path, value = change
+            if path is None:
+                self._written.pop((kind, owner), None)
+            elif value is None:
+                self._written.get((kind, owner), {}).pop(path, None)
+            else:
+                self._written.setdefault((kind, owner), {})[path] = value
+
+    def _load_data(self, kind: str) -> dict:
+        rows: Dict[int, Dict[str, str]] = {}
+        for owner, path, value in self._connect().execute(
+                "SELECT owner, path, value FROM data WHERE kind = ?", (kind,)):
+            rows.setdefault(owner, {})[path] = value
+        for owner, owner_rows in rows.items():
+            self._written[(kind, owner)] = dict(owner_rows)
+        return {owner: unflatten_state(owner_rows) for owner, owner_rows in rows.items()}
+
+    async def _update_data(self, kind: str, owner: int, data: dict):
+        rows: Dict[str, str] = {}
+        for key, value in data.items():
+            flatten_state(key, value, rows)
+        written = self._written.get((kind, owner), {})
+        for path, value in rows.items():
+            if written.get(path) != value:
+                self._pending.append((
+                    "INSERT OR REPLACE INTO data (kind, owner, path, value) VALUES (?, ?, ?, ?)",
+                    (kind, owner, path, value), (kind, owner, path, value)
+                ))
+        for path in [path for path in written if path not in rows]:
+            self._pending.append((
+                "DELETE FROM data WHERE kind = ? AND owner = ? AND path = ?",
+                (kind, owner, path), (kind, owner, path, None)
+            ))
+        await self._commit()
+
+    async def _drop_data(self, kind: str, owner: int):
+        self._pending.append((
+            "DELETE FROM data WHERE kind = ? AND owner = ?", (kind, owner), (kind, owner, None, None)
+        ))
+        await self._commit()
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return await self._run(self._load_data, "user")
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return await self._run(self._load_data, "chat")
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await self._run(lambda: self._connect().execute(
+            "SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall())
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        if new_state is None:
+            self._pending.append((
+                "DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(list(key))), None
+            ))
+        else:
+            self._pending.append((
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                (name, json.dumps(list(key)), json.dumps(new_state)), None
+            ))
+        await self._commit()
+
+    async def update_user_data(self, user_id: int, data: dict):
+        await self._update_data("user", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        await self._update_data("chat", chat_id, data)
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        await self._drop_data("user", user_id)
+
+    async def drop_chat_data(self, chat_id: int):
+        await self._drop_data("chat", chat_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def flush(self):
+        if self._commit_task is not None:
+            await self._commit_task
+        if self._pending:
+            await self._commit_pending()
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+
+# ======================
+# Исходящие сообщения
+# ======================
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = 0.0
+
+    def _refill(self, now: float):
+        if self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до свободного токена."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+# Все запросы бота проходят через этот ограничитель: общий и початовый
+# токен-бакеты, повтор после RetryAfter и схлопывание правок одного
+# сообщения. Запросы одного чата уходят по очереди; если пока правка ждёт
+# своей очереди, пришла более новая правка того же сообщения, старая не
+# отправляется вовсе и сразу возвращает True, как это делает Telegram.
+class OutboundDispatcher(BaseRateLimiter[int]):
+    COALESCED_ENDPOINTS = frozenset({"editMessageText", "editMessageReplyMarkup"})
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 group_rate: float = OUTBOUND_GROUP_RATE, chat_burst: int = OUTBOUND_CHAT_BURST,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._global_blocked_until = 0.0
+        self._chats: Dict[object, TokenBucket] = {}
+        self._chat_locks: Dict[object, asyncio.Lock] = {}
+        self._chat_waiters: Dict[object, int] = {}
+        self._blocked_until: Dict[object, float] = {}
+        self._latest_edit: Dict[tuple, int] = {}
+        self._edit_counter = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        logging.info("Исходящие: отправлено %d, схлопнуто правок %d, повторов %d",
+                     self.sent, self.coalesced, self.retries)
+
+    def _bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные id и @username — группы и каналы
+            group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_rate if group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+            # Редко пишущие чаты не копим: полные бакеты ничего не помнят
+            if len(self._chats) > 4096:
+                for key in [k for k, b in self._chats.items()
+                            if b.full(now) and k not in self._chat_locks]:
+                    del self._chats[key]
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        if chat_id is None:
+            return await self._send(None, None, endpoint, callback, args, kwargs, max_retries)
+
+        edit_key = None
+        if endpoint in self.COALESCED_ENDPOINTS and data.get("message_id") is not None:
+            self._edit_counter += 1
+            edit_key = (endpoint, chat_id, data["message_id"])
+            self._latest_edit[edit_key] = generation = self._edit_counter
+
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                return await self._send(chat_id, (edit_key, generation) if edit_key else None,
+                                        endpoint, callback, args, kwargs, max_retries)
+        finally:
+            self._chat_waiters[chat_id] -= 1
+            if not self._chat_waiters[chat_id]:
+                del self._chat_waiters[chat_id]
+                del self._chat_locks[chat_id]
+            if edit_key and self._latest_edit.get(edit_key) == generation:
+                del self._latest_edit[edit_key]
+
+    def _superseded(self, edit) -> bool:
+        return edit is not None and self._latest_edit.get(edit[0]) != edit[1]
+
+    async def _send(self, chat_id, edit, endpoint, callback, args, kwargs, max_retries):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            while True:
+                if self._superseded(edit):
+                    self.coalesced += 1
+                    return True
+                now = loop.time()
+                wait = max(self._global.delay(now), self._global_blocked_until - now)
+                if chat_id is not None:
+                    wait = max(wait, self._bucket(chat_id, now).delay(now),
+                               self._blocked_until.get(chat_id, 0.0) - now)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self._global.take(now)
+            if chat_id is not None:
+                self._chats[chat_id].take(now)
+            started = time.perf_counter() if metrics.enabled else 0.0
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    logging.error("Флуд-контроль: запрос не отправлен после %d повторов", attempt)
+                    raise
+                attempt += 1
+                self.retries += 1
+                if metrics.enabled:
+                    metrics.inc("bot_telegram_retries_total")
+                until = loop.time() + float(e.retry_after) + 0.1
+                if chat_id is None:
+                    self._global_blocked_until = max(self._global_blocked_until, until)
+                else:
+                    self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0.0), until)
+                logging.info("Флуд-контроль, повтор через %s с", e.retry_after)
+                continue
+            self.sent += 1
+            if metrics.enabled:
+                metrics.observe("bot_telegram_api_seconds", "method", endpoint,
+                                time.perf_counter() - started)
+            if chat_id is not None and self._blocked_until.get(chat_id, 0.0) <= loop.time():
+                self._blocked_until.pop(chat_id, None)
+            return result
+
+# ======================
+# Webhook
+# ======================
+
+# Обновления (и при webhook, и при polling) обрабатываются параллельно, но
+# внутри одного чата — строго по порядку поступления: у каждого чата свой замок. Счётчик pending
+# охватывает весь путь от приёма до конца обработки и нужен серверу
+# для обратного давления.
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+        self.pending = 0
+        self._drained: Optional[asyncio.Event] = None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def accepted(self):
+        self.pending += 1
+
+    def _done(self):
+        self.pending = max(0, self.pending - 1)
+        if self._drained is not None:
+            self._drained.set()
+
+    async def wait_for_capacity(self, limit: int, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.pending >= limit:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            self._drained = self._drained or asyncio.Event()
+            self._drained.clear()
+            try:
+                await asyncio.wait_for(self._drained.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def do_process_update(self, update: object, coroutine):
+        await coroutine
+
+    # Замок чата берётся до общего семафора, чтобы очередь одного
+    # активного чата не занимала слоты, нужные остальным
+    async def process_update(self, update: object, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        try:
+            if chat is None:
+                await super().process_update(update, coroutine)
+                return
+            lock = self._chat_locks.setdefault(chat.id, asyncio.Lock())
+            self._chat_waiters[chat.id] = self._chat_waiters.get(chat.id, 0) + 1
+            try:
+                async with lock:
+                    await super().process_update(update, coroutine)
+            finally:
+                self._chat_waiters[chat.id] -= 1
+                if not self._chat_waiters[chat.id]:
+                    del self._chat_waiters[chat.id]
+                    del self._chat_locks[chat.id]
+        finally:
+            if isinstance(update, Update):
+                self._done()
+
+
+# Минимальный HTTP/1.1-сервер на asyncio без сторонних зависимостей:
+# разбирает запросы (с keep-alive) и отдаёт их в _handle_request,
+# который возвращает (статус, доп. заголовки, тело). До чтения тела
+# запрос проходит _check_request и ограничение max_body, чтобы чужие
+# запросы не заставляли сервер буферизовать их целиком; чтение заголовков
+# и тела ограничено request_timeout, простой между запросами — idle_timeout
+class HttpServer:
+    name = "HTTP"
+    max_body = 64 * 1024
+    max_headers = 100
+
+    def __init__(self, host: str, port: int, request_timeout: float = HTTP_REQUEST_TIMEOUT,
+                 idle_timeout: float = HTTP_IDLE_TIMEOUT, ssl_context: Optional[ssl.SSLContext] = None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.request_timeout = request_timeout
+        self.idle_timeout = idle_timeout
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.Task] = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  ssl=self.ssl_context)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info("%s слушает %s:%d%s", self.name, self.host, self.port, " (TLS)" if self.ssl_context else "")
+
+    # Открытые соединения закрываются сами, а не отменяются вместе с циклом
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_head(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, dict]]:
+        request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not request_line:
+            return None
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        async with asyncio.timeout(self.request_timeout):
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                if len(headers) >= self.max_headers:
+                    raise ValueError("слишком много заголовков")
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: str, extra: str, content: bytes, keep_alive: bool):
+        response = f"HTTP/1.1 {status}\r\nContent-Length: {len(content)}\r\n{extra}"
+        response += "Connection: keep-alive\r\n\r\n" if keep_alive else "Connection: close\r\n\r\n"
+        writer.write(response.encode("latin-1") + content)
+        await writer.drain()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                head = await self._read_head(reader)
+                if head is None:
+                    break
+                method, target, headers = head
+                keep_alive = headers.get("connection", "").lower() != "close"
+                # Непрочитанное тело остаётся в сокете, поэтому после отказа
+                # до чтения тела соединение закрывается
+                rejection = self._check_request(method, target, headers)
+                if rejection is None and "transfer-encoding" in headers:
+                    rejection = "411 Length Required", "", b""
+                if rejection is None:
+                    try:
+                        length = int(headers.get("content-length", "0"))
+                    except ValueError:
+                        length = -1
+                    if length < 0:
+                        rejection = "400 Bad Request", "", b""
+                    elif length > self.max_body:
+                        rejection = "413 Payload Too Large", "", b""
+                if rejection is not None:
+                    await self._respond(writer, *rejection, keep_alive=False)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), self.request_timeout)
+                try:
+                    status, extra, content = await self._handle_request(method, target, headers, body)
+                except Exception:
+                    logging.exception("%s: ошибка обработки запроса %s %s", self.name, method, target)
+                    status, extra, content = "500 Internal Server Error", "", b""
+                await self._respond(writer, status, extra, content, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.CancelledError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    # Проверка по строке запроса и заголовкам, до чтения тела: ответ
+    # (статус, доп. заголовки, тело), чтобы отказать, или None
+    def _check_request(self, method: str, target: str, headers: dict) -> Optional[Tuple[str, str, bytes]]:
+        return None
+
+    async def _handle_request(self, method: str, target: str, headers: dict, body: bytes) -> Tuple[str, str, bytes]:
+        raise NotImplementedError
+
+
+# Webhook: принимает POST с обновлением, проверяет секрет и кладёт
+# обновление в очередь приложения. Если в работе уже max_pending
+# обновлений, сервер немного ждёт и затем отвечает 429 — Telegram
+# повторит доставку позже.
+class WebhookServer(HttpServer):
+    name = "Webhook"
+
+    def __init__(self, application: Application, host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 max_pending: int = WEBHOOK_MAX_PENDING, backpressure_timeout: float = 5.0,
+                 max_body: int = WEBHOOK_MAX_BODY, ssl_context: Optional[ssl.SSLContext] = None):
+        super().__init__(host, port, ssl_context=ssl_context)
+        self.max_body = max_body
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.max_pending = max_pending
+        self.backpressure_timeout = backpressure_timeout
+
+    @property
+    def processor(self) -> Optional[PerChatUpdateProcessor]:
+        processor = self.application.update_processor
+        return processor if isinstance(processor, PerChatUpdateProcessor) else None
+
+    def _check_request(self, method: str, target: str, headers: dict) -> Optional[Tuple[str, str, bytes]]:
+        if method != "POST" or target.split("?", 1)[0] != self.path:
+            return "404 Not Found", "", b""
+        if self.secret and not hmac.compare_digest(
+                headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1"), self.secret.encode("utf-8")):
+            return "403 Forbidden", "", b""
+        return None
+
+    async def _handle_request(self, method: str, target: str, headers: dict, body: bytes) -> Tuple[str, str, bytes]:
+        # Тело обязано быть JSON-объектом обновления; всё остальное — 400
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+                raise ValueError("обновление должно быть объектом с update_id")
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return "400 Bad Request", "", b""
+        processor = self.processor
+        if processor is not None:
+            if not await processor.wait_for_capacity(self.max_pending, self.backpressure_timeout):
+                return "429 Too Many Requests", "Retry-After: 1\r\n", b""
+            processor.accepted()
+        await self.application.update_queue.put(update)
+        return "200 OK", "", b""
+
+# Эндпоинт для Prometheus на том же минимальном HTTP-сервере
+class MetricsServer(HttpServer):
+    name = "Metrics"
+    max_body = 0
+
+    def _check_request(self, method: str, target: str, headers: dict) -> Optional[Tuple[str, str, bytes]]:
+        if method != "GET" or target.split("?", 1)[0] != "/metrics":
+            return "404 Not Found", "", b""
+        return None
+
+    async def _handle_request(self, method: str, target: str, headers: dict, body: bytes) -> Tuple[str, str, bytes]:
+        return ("200 OK", "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n",
+                metrics.render().encode("utf-8"))
+
+# Запускает эндпоинт и периодическую сводку в лог, если они включены
+class MetricsReporter:
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT,
+                 log_interval: float = METRICS_LOG_INTERVAL):
+        self.server = MetricsServer(host, port) if port > 0 else None
+        self.log_interval = log_interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.server is not None:
+            await self.server.start()
+        if self.log_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._log_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.server is not None:
+            await self.server.stop()
+        if metrics.enabled:
+            logging.info("Метрики: %s", metrics.summary())
+
+    async def _log_loop(self):
+        while True:
+            await asyncio.sleep(self.log_interval)
+            logging.info("Метрики: %s", metrics.summary())
+
+metrics_reporter = MetricsReporter()
+
+def webhook_ssl_context() -> Optional[ssl.SSLContext]:
+    if not WEBHOOK_CERT:
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY or None)
+    return context
+
+async def run_webhook(application: Application):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    server = WebhookServer(application, ssl_context=webhook_ssl_context())
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start()
+        certificate = open(WEBHOOK_CERT, "rb") if WEBHOOK_SELF_SIGNED else None
+        try:
+            await application.bot.set_webhook(
+                WEBHOOK_URL, certificate=certificate, secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        finally:
+            if certificate is not None:
+                certificate.close()
+        await application.start()
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
 # ======================
 # Запуск
 # ======================
 
-def main():
-    TOKEN = os.environ.get("BOT_TOKEN")
-    if not TOKEN:
-        raise ValueError("❌ Переменная окружения BOT_TOKEN не установлена!")
+async def start_history(application: Application):
+    await history_service.start()
+    aggregates_loader.start()
+
+async def stop_history(application: Application):
+    logging.info("Кэш истории: %s", history_service.cache_stats())
+    await aggregates_loader.stop()
+    await save_history_aggregates()
+    await history_service.stop()
+
+async def start_services(application: Application):
+    await start_history(application)
+    await metrics_reporter.start()
 
-    application = Application.builder().token(TOKEN).build()
+async def stop_services(application: Application):
+    await metrics_reporter.stop()
+    await export_service.stop()
+    await stop_history(application)
+
+# Собирает приложение со всеми обработчиками; request позволяет подменить
+# транспорт Bot API (так делает bench.py)
+def build_application(token: str, request: Optional[BaseRequest] = None) -> Application:
+    builder = (
+        Application.builder()
+        .token(token)
+        .persistence(SqlitePersistence())
+        .rate_limiter(OutboundDispatcher())
+        .post_init(start_services)
+        .post_stop(flush_bracket_views)
+        .post_shutdown(stop_services)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    # Чаты обрабатываются параллельно в обоих режимах: иначе ожидание лимита
+    # отправки в одной группе (до ~3 с на ответ) задерживало бы все чаты
+    builder = builder.concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # После старта сетки диалог закрывается: турнир живёт в чате, и ввод
+    # результатов обрабатывается общими обработчиками ниже. Диалог, застрявший
+    # в ENTERING_RESULT, на первом же обновлении переносит турнир в чат.
+    legacy_result_handlers = [
+        CallbackQueryHandler(adopt_legacy_tournament),
+        MessageHandler(filters.ALL, adopt_legacy_tournament)
+    ]
 
     # Обычный турнир
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("tournament", start_tournament)],
         states={
-            SELECT_SIZE: [CallbackQueryHandler(select_size, pattern="^size_")],
-            COLLECTING_TEAMS: [MessageHandler(filters.TEXT & ~filters.COMMAND, collect_teams)],
-            ENTERING_RESULT: [
-                CallbackQueryHandler(match_result_callback, pattern="^match_"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, enter_result)
-            ]
+            SELECT_SIZE: [
+                CallbackQueryHandler(select_size, pattern="^size_"),
+                CallbackQueryHandler(select_format, pattern="^fmt_"),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, select_size_text),
+                MessageHandler(filters.Document.ALL, select_size_document)
+            ],
+            COLLECTING_TEAMS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, collect_teams),
+                MessageHandler(filters.Document.ALL, collect_teams_document)
+            ],
+            # Диалоги, сохранённые до переноса турниров в чат
+            ENTERING_RESULT: legacy_result_handlers
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="tournament",
+        persistent=True
     )
 
     # Рандом-турнир
     random_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("random_tournament", start_random_tournament)],
         states={
-            SELECT_RANDOM_SIZE: [CallbackQueryHandler(select_random_size, pattern="^random_")],
-            COLLECTING_RANDOM_PLAYERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, collect_random_players)],
-            ENTERING_RESULT: [
-                CallbackQueryHandler(match_result_callback, pattern="^match_"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, enter_result)
-            ]
+            SELECT_RANDOM_SIZE: [
+                CallbackQueryHandler(select_random_size, pattern="^random_"),
+                CallbackQueryHandler(select_random_format, pattern="^rfmt_"),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, select_random_size_text),
+                MessageHandler(filters.Document.ALL, select_random_size_document)
+            ],
+            COLLECTING_RANDOM_PLAYERS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, collect_random_players),
+                MessageHandler(filters.Document.ALL, collect_random_players_document)
+            ],
+            # Диалоги, сохранённые до переноса турниров в чат
+            ENTERING_RESULT: legacy_result_handlers
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="random_tournament",
+        persistent=True
     )
 
+    # Диалоги регистрируются первыми: иначе /tournament и /random_tournament
+    # перехватываются обычными командами и диалог не запускается
+    application.add_handler(conv_handler)
+    application.add_handler(random_conv_handler)
+
     application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("tournament", start_tournament))
-    application.add_handler(CommandHandler("random_tournament", start_random_tournament))
     application.add_handler(CommandHandler("historytournament", history_tournament))
-    application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("leaderboard", leaderboard_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("cancel", cancel_tournament))
 
-    application.add_handler(conv_handler)
-    application.add_handler(random_conv_handler)
+    # Ввод результатов: любой участник чата, турнир и матч — из кнопки или ответа
+    application.add_handler(CallbackQueryHandler(match_result_callback, pattern="^match_"))
+    application.add_handler(CallbackQueryHandler(fix_list_callback, pattern="^fixlist"))
+    application.add_handler(CallbackQueryHandler(fix_result_callback, pattern="^fix_"))
+    application.add_handler(CommandHandler("undo", undo_command))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, enter_result))
 
     application.add_handler(CallbackQueryHandler(view_tournament_callback, pattern="^view_"))
     application.add_handler(CallbackQueryHandler(delete_tournament_callback, pattern="^delete_"))
     application.add_handler(CallbackQueryHandler(back_to_history, pattern="^back_to_history"))
+    application.add_handler(CallbackQueryHandler(history_page_callback, pattern="^hpage_"))
+    application.add_handler(CallbackQueryHandler(tournament_page_callback, pattern="^tpage_"))
+    application.add_handler(CallbackQueryHandler(export_callback, pattern="^export_"))
     application.add_handler(CallbackQueryHandler(
         lambda u, c: u.callback_query.message.reply_text("Используй: /tournament <название> или /random_tournament <название>"),
         pattern="^new_tournament"
     ))
 
+    # Обёртки ставятся только при включённых метриках, иначе накладных расходов нет
+    if metrics.enabled:
+        instrument_application(application)
+    return application
+
+def main():
+    TOKEN = os.environ.get("BOT_TOKEN")
+    if not TOKEN:
+        raise ValueError("❌ Переменная окружения BOT_TOKEN не установлена!")
+
+    if BOT_MODE not in ("polling", "webhook"):
+        raise ValueError(f"❌ Неизвестный режим BOT_MODE: {BOT_MODE}")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise ValueError("❌ Для режима webhook нужна переменная WEBHOOK_URL!")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL.startswith("https://"):
+        raise ValueError("❌ Telegram доставляет webhook только по HTTPS: WEBHOOK_URL должен начинаться с https://")
+    if not 1 <= WEBHOOK_MAX_CONNECTIONS <= 100:
+        raise ValueError("❌ WEBHOOK_MAX_CONNECTIONS должен быть от 1 до 100")
+    if WEBHOOK_SELF_SIGNED and not WEBHOOK_CERT:
+        raise ValueError("❌ WEBHOOK_SELF_SIGNED требует WEBHOOK_CERT")
+
+    application = build_application(TOKEN)
+
     print("✅ Бот запущен!")
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
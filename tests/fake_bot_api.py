@@ -0,0 +1,118 @@
+"""Поддельный Bot API для тестов и bench.py: транспорт ExtBot без сети."""
+import asyncio
+import json
+import random
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+# Транспорт для ExtBot: отвечает как Bot API и запоминает последнее
+# состояние каждого сообщения (текст и кнопки). На отправку и правки
+# отвечает 429 Too Many Requests с вероятностью flood или, по очереди,
+# force_flood раз подряд; log — все запросы со временем цикла
+class FakeBotAPI(BaseRequest):
+    FLOOD_ENDPOINTS = frozenset({"sendMessage", "editMessageText", "editMessageReplyMarkup"})
+
+    def __init__(self, latency: float = 0.0, flood: float = 0.0, seed: int = 0, retry_after: int = 1):
+        self.latency = latency
+        self.flood = flood
+        self.force_flood = 0
+        self.retry_after = retry_after
+        self.flooded = 0
+        self._rng = random.Random(seed)
+        self.calls: Dict[str, int] = {}
+        self.log: List[Tuple[float, str, dict]] = []
+        self.chats: Dict[int, Dict[int, dict]] = {}
+        self._events: Dict[int, asyncio.Event] = {}
+        self._next_id = 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    def _event(self, chat_id: int) -> asyncio.Event:
+        event = self._events.get(chat_id)
+        if event is None:
+            event = self._events[chat_id] = asyncio.Event()
+        return event
+
+    def _store(self, chat_id: int, message_id: int, params: dict) -> dict:
+        messages = self.chats.setdefault(chat_id, {})
+        message = messages.get(message_id) or {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": BOT_USER, "text": "",
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "reply_markup" in params or "text" in params:
+            markup = params.get("reply_markup")
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            if markup and "inline_keyboard" in markup:
+                message["reply_markup"] = markup
+            else:
+                message.pop("reply_markup", None)
+        messages[message_id] = message
+        self._event(chat_id).set()
+        return message
+
+    def _flooding(self, endpoint: str) -> bool:
+        if endpoint not in self.FLOOD_ENDPOINTS:
+            return False
+        if self.force_flood:
+            self.force_flood -= 1
+            return True
+        return bool(self.flood) and self._rng.random() < self.flood
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        endpoint = url.rsplit("/", 1)[1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data is not None else {}
+        self.log.append((asyncio.get_running_loop().time(), endpoint, dict(params)))
+        if self._flooding(endpoint):
+            self.flooded += 1
+            return 429, json.dumps({"ok": False, "error_code": 429,
+                                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                                    "parameters": {"retry_after": self.retry_after}}).encode("utf-8")
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint == "sendMessage":
+            self._next_id += 1
+            result = self._store(int(params["chat_id"]), self._next_id, params)
+        elif endpoint in ("editMessageText", "editMessageReplyMarkup"):
+            # Правка клавиатуры без reply_markup снимает кнопки
+            params = {"reply_markup": None, **params} if endpoint == "editMessageReplyMarkup" else params
+            result = self._store(int(params["chat_id"]), int(params["message_id"]), params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+    def messages(self, chat_id: int) -> List[dict]:
+        return list(self.chats.get(chat_id, {}).values())
+
+    async def wait(self, chat_id: int, predicate: Callable[[], bool], timeout: float = 120.0):
+        deadline = time.perf_counter() + timeout
+        while not predicate():
+            event = self._event(chat_id)
+            event.clear()
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f"чат {chat_id}: не дождались ответа бота")
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,103 @@
+import pytest
+
+import main
+
+
+def play_out(stages, winner=min):
+    """Играет все доступные матчи: побеждает команда, которую выбирает winner."""
+    while True:
+        playable = [(stage, pos) for stage, matches in enumerate(stages)
+                    for pos, match in enumerate(matches) if match.playable]
+        if not playable:
+            return
+        for stage, pos in playable:
+            match = stages[stage][pos]
+            first_wins = winner(match.t1, match.t2) == match.t1
+            main.record_result(stages, stage, pos, *((2, 1) if first_wins else (1, 2)))
+
+
+@pytest.mark.parametrize("size, expected", [
+    (1, [1]),
+    (2, [1, 2]),
+    (4, [1, 4, 2, 3]),
+    (8, [1, 8, 4, 5, 2, 7, 3, 6]),
+    (16, [1, 16, 8, 9, 4, 13, 5, 12, 2, 15, 7, 10, 3, 14, 6, 11]),
+])
+def test_seed_positions_order(size, expected):
+    assert main.seed_positions(size) == expected
+
+
+@pytest.mark.parametrize("size", [2 ** k for k in range(1, 9)])
+def test_seed_positions_pair_strong_with_weak(size):
+    positions = main.seed_positions(size)
+    assert sorted(positions) == list(range(1, size + 1))
+    assert all(positions[i] + positions[i + 1] == size + 1 for i in range(0, size, 2))
+
+
+@pytest.mark.parametrize("n", range(2, 66))
+def test_bracket_shape_and_byes(n):
+    teams = list(range(n))
+    stages = main.build_bracket(teams, seeding=teams)
+    size = max(2, 1 << (n - 1).bit_length())
+
+    assert [len([m for m in matches if not m.third]) for matches in stages] == \
+        [size >> k for k in range(1, size.bit_length())]
+    assert any(m.third for m in stages[-1]) == (n >= 4)
+
+    first = stages[0]
+    placed = [t for m in first for t in (m.t1, m.t2) if t is not None]
+    assert sorted(placed) == teams
+    byes = [m for m in first if m.bye]
+    assert len(byes) == size - n
+    # Проходы без игры достаются верхним посевам и сразу продвигают их дальше
+    assert sorted(m.t1 for m in byes) == list(range(size - n))
+    assert all(m.t2 is None and m.w == m.t1 for m in byes)
+    assert all(m.t1 is not None for m in first)
+    if len(stages) > 1:
+        advanced = {t for m in stages[1] for t in (m.t1, m.t2) if t is not None}
+        assert {m.t1 for m in byes} <= advanced
+
+
+@pytest.mark.parametrize("n", range(2, 66))
+def test_favourites_reach_the_final_and_third_place(n):
+    teams = list(range(n))
+    stages = main.build_bracket(teams, seeding=teams)
+    play_out(stages)
+
+    assert main.bracket_finished(stages)
+    final = stages[-1][0]
+    assert (final.w, final.loser) == (0, 1)
+    if n >= 4:
+        third = stages[-1][1]
+        semifinal_losers = {m.loser for m in stages[-2]}
+        assert {third.t1, third.t2} == semifinal_losers == {2, 3}
+        assert third.w == 2
+
+
+def test_underdog_path_updates_final_and_third_place():
+    teams = list(range(8))
+    stages = main.build_bracket(teams, seeding=teams)
+    play_out(stages, winner=max)
+
+    final, third = stages[-1]
+    assert (final.w, final.loser) == (7, 6)
+    assert {third.t1, third.t2} == {5, 4} and third.w == 5
+
+
+def test_random_seeding_is_reproducible():
+    teams = list(range(13))
+    first = [[m.to_list() for m in matches] for matches in main.build_bracket(teams, seed=42)]
+    second = [[m.to_list() for m in matches] for matches in main.build_bracket(teams, seed=42)]
+    assert first == second
+
+
+def test_record_result_is_not_finished_before_third_place():
+    teams = list(range(4))
+    stages = main.build_bracket(teams, seeding=teams)
+    main.record_result(stages, 0, 0, 3, 0)
+    main.record_result(stages, 0, 1, 3, 0)
+    main.record_result(stages, 1, 0, 1, 0)
+    assert not main.bracket_finished(stages)
+    main.record_result(stages, 1, 1, 0, 2)
+    assert main.bracket_finished(stages)
+    assert stages[-1][1].w == 2
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+from telegram.error import NetworkError
+from telegram.ext import ApplicationBuilder
+
+import main
+from fake_bot_api import FakeBotAPI
+
+
+# Представления общие для модуля: у каждого теста свои
+@pytest.fixture(autouse=True)
+def fresh_views(monkeypatch):
+    monkeypatch.setattr(main, "bracket_views", main.LRUCache(1024))
+
+
+def tournament(bot_message) -> dict:
+    state = {"id": "1", "tournament_name": "Кубок", "seed": 1,
+             "teams": [{"name": f"T{i}", "players": [f"p{i}"]} for i in range(4)]}
+    main.SingleElimination.create(state)
+    main.init_result_log(state)
+    state["bracket_message"] = [bot_message.chat_id, bot_message.message_id]
+    return state
+
+
+async def started_application(api: FakeBotAPI):
+    application = ApplicationBuilder().token("1:TEST").updater(None).request(api).get_updates_request(api).build()
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(context.error)
+
+    application.add_error_handler(on_error)
+    await application.initialize()
+    await application.start()
+    return application, errors
+
+
+def test_pending_edit_is_sent_before_stop_completes(monkeypatch):
+    monkeypatch.setattr(main, "BRACKET_EDIT_DELAY", 0.3)
+
+    async def scenario():
+        api = FakeBotAPI()
+        application, errors = await started_application(api)
+        try:
+            message = await application.bot.send_message(5, "сетка")
+            state = tournament(message)
+            scheduler, _ = main.log_result(state, 0, 0, 2, 1)
+            main.schedule_bracket_edit(application, state, scheduler.changed)
+        finally:
+            await application.stop()
+        await application.shutdown()
+        return api.chats[5][message.message_id]["text"], errors
+
+    text, errors = asyncio.run(scenario())
+    assert "2:1" in text
+    assert errors == []
+
+
+def test_failed_edit_is_reported_and_resent_on_stop(monkeypatch):
+    monkeypatch.setattr(main, "BRACKET_EDIT_DELAY", 0.01)
+
+    async def scenario():
+        api = FakeBotAPI()
+        application, errors = await started_application(api)
+        try:
+            message = await application.bot.send_message(5, "сетка")
+            state = tournament(message)
+            real_request = api.do_request
+            failures = 1
+
+            async def flaky(url, method, request_data=None, **kwargs):
+                nonlocal failures
+                if url.endswith("/editMessageText") and failures:
+                    failures -= 1
+                    raise NetworkError("соединение разорвано")
+                return await real_request(url, method, request_data, **kwargs)
+
+            api.do_request = flaky
+            scheduler, _ = main.log_result(state, 0, 0, 2, 1)
+            main.schedule_bracket_edit(application, state, scheduler.changed)
+            view = main.get_bracket_view(state)
+            await asyncio.gather(view.flush_task, return_exceptions=True)
+            await asyncio.sleep(0)
+            assert view.unsent is not None
+            assert api.chats[5][message.message_id]["text"] == "сетка"
+        finally:
+            await application.stop()
+        await main.flush_bracket_views(application)
+        await application.shutdown()
+        return api.chats[5][message.message_id]["text"], errors, view.unsent
+
+    text, errors, unsent = asyncio.run(scenario())
+    assert [type(error) for error in errors] == [NetworkError]
+    assert "2:1" in text
+    assert unsent is None
@@ -0,0 +1,111 @@
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import main
+
+
+def make_tid(moment: datetime) -> str:
+    return str(int(moment.timestamp() * 1000) * 1000)
+
+
+def record(tid: str) -> dict:
+    return {"name": f"Турнир {tid[-6:]}", "date": "31.01.2025 23:30", "teams": []}
+
+
+@pytest.fixture
+def set_tz(monkeypatch):
+    def apply(name: str):
+        monkeypatch.setenv("TZ", name)
+        time.tzset()
+
+    yield apply
+    monkeypatch.undo()
+    time.tzset()
+
+
+# Турнир у границы месяца: в UTC это январь, в Москве уже февраль
+EDGE_TID = make_tid(datetime(2025, 1, 31, 23, 30, tzinfo=timezone.utc))
+
+
+def test_tid_month_ignores_host_timezone(set_tz):
+    set_tz("UTC")
+    utc_month = main.tid_month(EDGE_TID)
+    set_tz("Europe/Moscow")
+    assert main.tid_month(EDGE_TID) == utc_month == "2025-01"
+
+
+def test_sharded_store_survives_timezone_change(workdir, set_tz):
+    set_tz("UTC")
+    store = main.ShardedHistoryStore(str(workdir / "history"))
+    store.put(EDGE_TID, record(EDGE_TID))
+    store.close()
+
+    set_tz("Europe/Moscow")
+    store = main.ShardedHistoryStore(str(workdir / "history"))
+    assert EDGE_TID in store.summaries()
+    assert store.get(EDGE_TID)["name"] == record(EDGE_TID)["name"]
+    assert store.delete(EDGE_TID) is True
+    assert EDGE_TID not in store.summaries()
+    store.close()
+
+
+# Старые версии раскладывали турниры по местному времени: такие записи
+# должны открываться и удаляться там, где лежат
+def test_sharded_store_finds_records_in_local_time_shard(workdir, set_tz):
+    set_tz("Europe/Moscow")
+    directory = workdir / "history"
+    directory.mkdir()
+    legacy = main.LogHistoryStore(str(directory / "2025-02.log"))
+    legacy.put(EDGE_TID, record(EDGE_TID))
+    legacy.close()
+
+    store = main.ShardedHistoryStore(str(directory))
+    assert store.get(EDGE_TID) is not None
+    store.put(EDGE_TID, dict(record(EDGE_TID), name="Переименован"))
+    assert store.summaries()[EDGE_TID]["name"] == "Переименован"
+    assert store.delete(EDGE_TID) is True
+    assert store.get(EDGE_TID) is None
+    assert EDGE_TID not in store.summaries()
+    store.close()
+    assert not (directory / "2025-01.log").exists()
+
+
+def test_compaction_keeps_records_reachable(workdir, set_tz):
+    set_tz("UTC")
+    store = main.ShardedHistoryStore(str(workdir / "history"))
+    store.put(EDGE_TID, record(EDGE_TID))
+    assert store.compact("2025-03") == 0
+    store.close()
+
+    set_tz("America/New_York")
+    store = main.ShardedHistoryStore(str(workdir / "history"))
+    assert store.get(EDGE_TID) is not None
+    assert store.delete(EDGE_TID) is True
+    assert EDGE_TID not in store.summaries()
+    store.close()
+
+
+def test_log_store_skips_corrupt_lines(workdir):
+    path = workdir / "journal.log"
+    good = main.LogHistoryStore(str(path))
+    good.put("1", record("1"))
+    good.close()
+    with open(path, "ab") as f:
+        f.write(b'{"op": "put", "id": "2"}\t{"name": "x"}\n')  # заголовок без name/date
+        f.write(b'[1, 2]\t{}\n')
+        f.write(b'{"op": "put", "id": [3], "name": "a", "date": "b"}\t{}\n')
+        f.write(b'not json at all\n')
+    tail = main.LogHistoryStore(str(path))
+    tail.put("4", record("4"))
+    tail.close()
+    with open(path, "ab") as f:
+        f.write(b'{"op": "put", "id": "5", "na')  # недописанная строка
+    size_before_tail = path.stat().st_size - len(b'{"op": "put", "id": "5", "na')
+
+    store = main.LogHistoryStore(str(path))
+    assert sorted(store.summaries()) == ["1", "4"]
+    assert store.get("4")["name"] == record("4")["name"]
+    assert path.stat().st_size == size_before_tail
+    store.close()
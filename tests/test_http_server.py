@@ -0,0 +1,125 @@
+import asyncio
+import json
+import shutil
+import ssl
+import subprocess
+
+import pytest
+from telegram.ext import ApplicationBuilder
+
+import main
+
+SECRET = "s3cret"
+
+
+async def start_webhook(**kwargs) -> main.WebhookServer:
+    application = ApplicationBuilder().token("1:TEST").updater(None).build()
+    server = main.WebhookServer(application, host="127.0.0.1", port=0, path="/hook", secret=SECRET, **kwargs)
+    await server.start()
+    return server
+
+
+async def request(port: int, head: str, body: bytes = b"") -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+        return await asyncio.wait_for(reader.read(), 5)
+    finally:
+        writer.close()
+
+
+def post_head(path: str, length: int, secret: str = SECRET) -> str:
+    return (f"POST {path} HTTP/1.1\r\nHost: x\r\nContent-Length: {length}\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n\r\n")
+
+
+def test_rejects_unknown_path_and_bad_secret_without_reading_body():
+    async def scenario():
+        server = await start_webhook()
+        try:
+            # Тело не отправляется: ответ должен прийти по одним заголовкам
+            huge = 64 * 1024 * 1024
+            assert (await request(server.port, post_head("/other", huge))).startswith(b"HTTP/1.1 404")
+            assert (await request(server.port, post_head("/hook", huge, "wrong"))).startswith(b"HTTP/1.1 403")
+            assert (await request(server.port, post_head("/hook", huge))).startswith(b"HTTP/1.1 413")
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_accepts_update_and_rejects_bad_body():
+    async def scenario():
+        server = await start_webhook()
+        try:
+            body = json.dumps({"update_id": 7}).encode()
+            response = await request(server.port, post_head("/hook", len(body)).replace("\r\n\r\n", "\r\nConnection: close\r\n\r\n"), body)
+            assert response.startswith(b"HTTP/1.1 200")
+            assert (await server.application.update_queue.get()).update_id == 7
+            response = await request(server.port, post_head("/hook", 2).replace("\r\n\r\n", "\r\nConnection: close\r\n\r\n"), b"[]")
+            assert response.startswith(b"HTTP/1.1 400")
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_closes_idle_and_stalled_connections():
+    async def scenario():
+        server = await start_webhook()
+        server.idle_timeout = 0.2
+        server.request_timeout = 0.2
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            assert await asyncio.wait_for(reader.read(), 2) == b""
+            writer.close()
+            # Обещано 10 байт тела, пришло 3
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(post_head("/hook", 10).encode() + b"{}\n")
+            assert await asyncio.wait_for(reader.read(), 2) == b""
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stop_closes_open_keep_alive_connections():
+    async def scenario():
+        server = await start_webhook()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        body = json.dumps({"update_id": 1}).encode()
+        writer.write(post_head("/hook", len(body)).encode() + body)
+        assert (await reader.readuntil(b"\r\n\r\n")).startswith(b"HTTP/1.1 200")
+        await asyncio.wait_for(server.stop(), 2)
+        assert await asyncio.wait_for(reader.read(), 2) == b""
+        writer.close()
+
+    asyncio.run(scenario())
+
+
+def test_serves_tls_with_configured_certificate(workdir, monkeypatch):
+    openssl = shutil.which("openssl")
+    if openssl is None:
+        pytest.skip("нужен openssl, чтобы выпустить сертификат")
+    subprocess.run([openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", "key.pem", "-out", "cert.pem"],
+                   check=True, capture_output=True)
+    monkeypatch.setattr(main, "WEBHOOK_CERT", str(workdir / "cert.pem"))
+    monkeypatch.setattr(main, "WEBHOOK_KEY", str(workdir / "key.pem"))
+
+    async def scenario():
+        server = await start_webhook(ssl_context=main.webhook_ssl_context())
+        try:
+            client = ssl.create_default_context(cafile=str(workdir / "cert.pem"))
+            client.check_hostname = False
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port, ssl=client)
+            body = json.dumps({"update_id": 3}).encode()
+            writer.write(post_head("/hook", len(body)).replace("\r\n\r\n", "\r\nConnection: close\r\n\r\n").encode() + body)
+            assert (await asyncio.wait_for(reader.read(), 5)).startswith(b"HTTP/1.1 200")
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
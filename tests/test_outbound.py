@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+import main
+from fake_bot_api import FakeBotAPI
+
+FAST = dict(global_rate=1e6, chat_rate=1e6, group_rate=1e6, chat_burst=10 ** 6)
+
+
+async def make_bot(api: FakeBotAPI, **limits) -> ExtBot:
+    bot = ExtBot("1:TEST", request=api, get_updates_request=FakeBotAPI(),
+                 rate_limiter=main.OutboundDispatcher(**{**FAST, **limits}))
+    await bot.initialize()
+    return bot
+
+
+def sends(api: FakeBotAPI, chat_id=None):
+    return [(at, params) for at, endpoint, params in api.log
+            if endpoint == "sendMessage" and (chat_id is None or int(params["chat_id"]) == chat_id)]
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = main.TokenBucket(2.0, 3)
+    for _ in range(3):
+        assert bucket.delay(100.0) == 0.0
+        bucket.take(100.0)
+    assert bucket.delay(100.0) == pytest.approx(0.5)
+    assert bucket.delay(100.5) == 0.0
+    assert bucket.full(102.0)
+
+
+def test_requests_of_one_chat_keep_their_order():
+    async def scenario():
+        api = FakeBotAPI(latency=0.002)
+        bot = await make_bot(api)
+        await asyncio.gather(*(bot.send_message(chat, f"{chat}:{i}") for i in range(20) for chat in (5, -7)))
+        for chat in (5, -7):
+            assert [params["text"] for _, params in sends(api, chat)] == [f"{chat}:{i}" for i in range(20)]
+        await bot.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_per_chat_and_group_rates():
+    async def scenario():
+        api = FakeBotAPI()
+        bot = await make_bot(api, chat_rate=20, group_rate=10, chat_burst=1)
+        await asyncio.gather(*(bot.send_message(chat, str(i)) for i in range(6) for chat in (5, -5)))
+        for chat, rate in ((5, 20), (-5, 10)):
+            times = [at for at, _ in sends(api, chat)]
+            gaps = [b - a for a, b in zip(times, times[1:])]
+            assert min(gaps) >= 1 / rate - 0.01
+        await bot.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_global_rate_spans_all_chats():
+    async def scenario():
+        api = FakeBotAPI()
+        bot = await make_bot(api, global_rate=20)
+        await asyncio.gather(*(bot.send_message(chat, "x") for chat in range(1, 31)))
+        times = [at for at, _ in sends(api)]
+        # Ёмкость общего бакета — 20 запросов, включая getMe; остальные идут по 20 в секунду
+        assert max(times) - min(times) >= (31 - 20) / 20 - 0.05
+        for start in times:
+            assert sum(start <= at < start + 0.25 for at in times) <= 20 + 0.25 * 20 + 1
+        await bot.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_blocks_only_that_chat():
+    async def scenario():
+        api = FakeBotAPI()
+        dispatcher_bot = await make_bot(api)
+        loop = asyncio.get_running_loop()
+        api.force_flood = 1
+        started = loop.time()
+        flooded = asyncio.ensure_future(dispatcher_bot.send_message(5, "после паузы"))
+        await asyncio.sleep(0.05)
+        await dispatcher_bot.send_message(6, "другой чат")
+        assert loop.time() - started < 0.5
+        message = await flooded
+        assert message.text == "после паузы"
+        assert loop.time() - started >= 1.0
+        assert api.flooded == 1
+        assert dispatcher_bot.rate_limiter.retries == 1
+        assert [params["text"] for _, params in sends(api, 5)] == ["после паузы"] * 2
+        await dispatcher_bot.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def scenario():
+        api = FakeBotAPI()
+        bot = await make_bot(api, max_retries=1)
+        api.force_flood = 2
+        with pytest.raises(RetryAfter):
+            await bot.send_message(5, "не дойдёт")
+        assert api.flooded == 2
+        await bot.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_queued_edits_of_one_message_coalesce():
+    async def scenario():
+        api = FakeBotAPI()
+        bot = await make_bot(api, chat_rate=5, chat_burst=1)
+        message = await bot.send_message(5, "v0")
+        results = await asyncio.gather(*(bot.edit_message_text(f"v{i}", 5, message.message_id) for i in range(1, 5)))
+        edits = [params["text"] for _, endpoint, params in api.log if endpoint == "editMessageText"]
+        # Все правки ждут бакета чата после отправки; уходит только последняя
+        assert edits == ["v4"]
+        assert results[:3] == [True, True, True]
+        assert bot.rate_limiter.coalesced == 3
+        assert api.chats[5][message.message_id]["text"] == "v4"
+        await bot.shutdown()
+
+    asyncio.run(scenario())
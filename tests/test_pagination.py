@@ -0,0 +1,38 @@
+import main
+
+LIMIT = 200
+CONTINUED = "**Кубок** (продолжение)\n\n"
+
+
+def words(text: str) -> list:
+    return text.replace("**", "").split()
+
+
+def test_long_line_is_split_within_limit():
+    names = ", ".join(f"Игрок{i}" for i in range(200))
+    blocks = ["**Матч 1:**\n", f"👥 Участники: {names}\n\n", "**Матч 2:**\nA — B\n\n"]
+    pages = list(main.paginate_blocks(blocks, LIMIT, CONTINUED))
+    assert len(pages) > 1
+    assert all(len(page) <= LIMIT for page in pages)
+    text = "".join(page[len(CONTINUED):] if i else page for i, page in enumerate(pages))
+    assert words(text) == words("".join(blocks))
+
+
+def test_line_without_spaces_is_cut_hard():
+    blocks = ["x" * 1000 + "\n"]
+    pages = list(main.paginate_blocks(blocks, LIMIT, CONTINUED))
+    assert all(len(page) <= LIMIT for page in pages)
+    assert "".join(page.replace(CONTINUED, "") for page in pages).replace("\n", "") == "x" * 1000
+
+
+def test_split_keeps_bold_balanced():
+    line = "**" + " ".join(f"Команда{i}" for i in range(100)) + "**"
+    pieces = main.split_long_line(line, 60)
+    assert len(pieces) > 1
+    assert all(len(piece) <= 60 for piece in pieces)
+    assert all(piece.count("**") % 2 == 0 for piece in pieces)
+
+
+def test_short_blocks_are_untouched():
+    blocks = ["a\n\n", "b\n\n"]
+    assert list(main.paginate_blocks(blocks, LIMIT, CONTINUED)) == ["a\n\nb\n\n"]
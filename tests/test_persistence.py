@@ -0,0 +1,89 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+
+
+def load(path) -> dict:
+    async def scenario():
+        persistence = main.SqlitePersistence(str(path))
+        try:
+            return await persistence.get_chat_data()
+        finally:
+            await persistence.flush()
+
+    return asyncio.run(scenario())
+
+
+def test_failed_write_is_retried_on_next_flush(workdir, monkeypatch):
+    path = workdir / "state.db"
+
+    async def scenario():
+        persistence = main.SqlitePersistence(str(path))
+        await persistence.get_chat_data()
+        await persistence.update_chat_data(1, {"tournaments": {"1": {"name": "Кубок", "results": [[0, 0, 2, 1]]}}})
+        await persistence.update_conversation("setup", (1, 2), 3)
+
+        real_write = persistence._write
+
+        def failing_write(pending):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        monkeypatch.setattr(persistence, "_write", failing_write)
+        with pytest.raises(sqlite3.OperationalError):
+            await persistence.update_chat_data(1, {"tournaments": {"1": {"name": "Кубок 2", "results": []}}})
+        with pytest.raises(sqlite3.OperationalError):
+            await persistence.update_conversation("setup", (1, 2), 4)
+        with pytest.raises(sqlite3.OperationalError):
+            await persistence.drop_chat_data(7)
+        monkeypatch.setattr(persistence, "_write", real_write)
+
+        # Те же данные: сравнение с записанным должно снова найти изменения
+        await persistence.update_chat_data(1, {"tournaments": {"1": {"name": "Кубок 2", "results": []}}})
+        conversations = await persistence.get_conversations("setup")
+        await persistence.flush()
+        return conversations
+
+    assert asyncio.run(scenario()) == {(1, 2): 4}
+    assert load(path) == {1: {"tournaments": {"1": {"name": "Кубок 2", "results": []}}}}
+
+
+def test_only_changed_rows_are_written(workdir):
+    path = workdir / "state.db"
+
+    async def scenario():
+        persistence = main.SqlitePersistence(str(path))
+        await persistence.get_chat_data()
+        data = {"tournaments": {"1": {"name": "Кубок", "results": [[0, 0, 2, 1]]}}}
+        await persistence.update_chat_data(1, data)
+        written = []
+        real_write = persistence._write
+        persistence._write = lambda pending: (written.extend(pending), real_write(pending))
+        data["tournaments"]["1"]["results"].append([0, 1, 0, 3])
+        await persistence.update_chat_data(1, data)
+        await persistence.update_chat_data(1, data)
+        await persistence.flush()
+        return written
+
+    written = asyncio.run(scenario())
+    assert sorted(params[2] for _, params, _ in written) == [
+        "tournaments/1/results/#", "tournaments/1/results/1/#",
+        "tournaments/1/results/1/0", "tournaments/1/results/1/1",
+        "tournaments/1/results/1/2", "tournaments/1/results/1/3",
+    ]
+    assert load(path)[1]["tournaments"]["1"]["results"] == [[0, 0, 2, 1], [0, 1, 0, 3]]
+
+
+def test_transient_keys_are_not_persisted(workdir):
+    path = workdir / "state.db"
+
+    async def scenario():
+        persistence = main.SqlitePersistence(str(path))
+        await persistence.get_chat_data()
+        await persistence.update_chat_data(1, {"tournaments": {"1": {"name": "Кубок", "_snapshots": [[0, {}]]}}})
+        await persistence.flush()
+
+    asyncio.run(scenario())
+    assert load(path) == {1: {"tournaments": {"1": {"name": "Кубок"}}}}
@@ -0,0 +1,154 @@
+import copy
+import random
+
+import pytest
+
+import main
+
+# Числа команд подобраны так, чтобы результатов было заметно больше
+# RESULT_SNAPSHOT_EVERY и откаты переходили через границы снимков
+FORMATS = [("single", 24), ("double", 12), ("rr", 10), ("swiss", 20)]
+
+
+def new_state(fmt: str, n: int, seed: int = 7) -> dict:
+    state = {"teams": [{"name": f"T{i}", "players": [f"p{i}"]} for i in range(n)], "seed": seed}
+    main.SCHEDULERS[fmt].create(state)
+    main.init_result_log(state)
+    return state
+
+
+def view(state: dict) -> dict:
+    keys = main.SCHEDULERS[state["format"]].state_keys
+    plain = {key: state[key] for key in keys}
+    plain["bracket"] = [[match.to_list() for match in stage] for stage in state["bracket"]]
+    return {"state": copy.deepcopy(plain), "results": copy.deepcopy(state["results"])}
+
+
+def replayed(state: dict) -> dict:
+    fresh = {"teams": state["teams"], "seed": state["seed"], "format": state["format"]}
+    main.replay_events(fresh, state["events"])
+    return view(fresh)
+
+
+def score(rng: random.Random, state: dict):
+    if main.SCHEDULERS[state["format"]].allows_draws and rng.random() < 0.2:
+        return 1, 1
+    a, b = rng.sample(range(5), 2)
+    return a, b
+
+
+def step(rng: random.Random, state: dict) -> bool:
+    scheduler = main.get_scheduler(state)
+    playable = [(stage, pos) for stage, matches in enumerate(scheduler.stages)
+                for pos, match in enumerate(matches) if match.playable]
+    action = rng.random()
+    if state["results"] and action < 0.1:
+        main.undo_result(state)
+    elif state["results"] and action < 0.2:
+        stage, pos = rng.choice(state["results"])[:2]
+        main.edit_result(state, stage, pos, *score(rng, state))
+    elif playable:
+        main.log_result(state, *rng.choice(playable), *score(rng, state))
+    else:
+        return False
+    return True
+
+
+def reload(state: dict) -> dict:
+    rows = {}
+    main.flatten_state("t", state, rows)
+    return main.unflatten_state(rows)["t"]
+
+
+@pytest.mark.parametrize("fmt, n", FORMATS)
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_replay_matches_live_state(fmt, n, seed):
+    rng = random.Random(seed)
+    state = new_state(fmt, n, seed)
+    crossed = 0
+    for _ in range(3000):
+        before = len(state["results"])
+        if not step(rng, state):
+            break
+        after = len(state["results"])
+        crossed += before // main.RESULT_SNAPSHOT_EVERY != after // main.RESULT_SNAPSHOT_EVERY
+        assert replayed(state) == view(state)
+    assert crossed > 0
+    assert main.get_scheduler(state).finished()
+
+
+@pytest.mark.parametrize("fmt, n", FORMATS)
+def test_undo_to_start_restores_initial_state(fmt, n):
+    rng = random.Random(11)
+    state = new_state(fmt, n)
+    initial = view(state)
+    for _ in range(3 * main.RESULT_SNAPSHOT_EVERY):
+        scheduler = main.get_scheduler(state)
+        playable = [(s, p) for s, matches in enumerate(scheduler.stages)
+                    for p, match in enumerate(matches) if match.playable]
+        if not playable:
+            break
+        main.log_result(state, *rng.choice(playable), *score(rng, state))
+    assert len(state["results"]) > main.RESULT_SNAPSHOT_EVERY
+    while state["results"]:
+        main.undo_result(state)
+        assert replayed(state) == view(state)
+    assert view(state) == initial
+
+
+@pytest.mark.parametrize("fmt, n", FORMATS)
+def test_snapshots_are_not_persisted_and_rebuild_after_reload(fmt, n):
+    rng = random.Random(5)
+    live = new_state(fmt, n)
+    for _ in range(2 * main.RESULT_SNAPSHOT_EVERY + 3):
+        step(rng, live)
+    rows = {}
+    main.flatten_state("t", live, rows)
+    assert not any("_snapshots" in path for path in rows)
+    assert any(path.startswith("t/result_base") for path in rows)
+
+    restored = reload(live)
+    assert "_snapshots" not in restored
+    assert view(restored) == view(live)
+    # Первый откат повторяет результаты от исходного состояния и заново
+    # набирает снимки; дальше оба турнира ведут себя одинаково
+    main.undo_result(live)
+    main.undo_result(restored)
+    assert view(restored) == view(live)
+    assert [count for count, _ in restored["_snapshots"]] == \
+        list(range(0, len(restored["results"]) + 1, main.RESULT_SNAPSHOT_EVERY))
+    for _ in range(60):
+        state_rng = rng.getstate()
+        live_moved = step(rng, live)
+        rng.setstate(state_rng)
+        assert step(rng, restored) == live_moved
+        assert view(restored) == view(live)
+
+
+def test_state_saved_with_all_snapshots_still_undoes():
+    rng = random.Random(3)
+    state = new_state("rr", 10)
+    for _ in range(20):
+        step(rng, state)
+    # Так турнир лежал в персистентности до выноса снимков из состояния
+    legacy = reload(state)
+    legacy["snapshots"] = [[0, legacy.pop("result_base")]]
+    while state["results"]:
+        main.undo_result(state)
+        main.undo_result(legacy)
+        assert view(legacy) == view(state)
+    assert "snapshots" not in legacy
+
+
+def test_edit_drops_results_that_no_longer_apply():
+    state = new_state("single", 4)
+    main.log_result(state, 0, 0, 2, 0)
+    main.log_result(state, 0, 1, 2, 0)
+    main.log_result(state, 1, 0, 3, 1)
+    old, new, dropped = main.edit_result(state, 0, 0, 0, 2)
+    assert old[2:4] == [2, 0] and new[2:4] == [0, 2]
+    # Финалист сменился — финал отбрасывается, второй полуфинал остаётся
+    assert [entry[:2] for entry in dropped] == [[1, 0]]
+    assert [entry[:2] for entry in state["results"]] == [[0, 0], [0, 1]]
+    assert not state["bracket"][1][0].played
+    assert replayed(state) == view(state)
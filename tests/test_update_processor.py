@@ -0,0 +1,96 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+import main
+from fake_bot_api import FakeBotAPI
+
+
+def message_update(update_id: int, chat_id: int, bot) -> Update:
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": str(update_id),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+        "from": {"id": abs(chat_id), "is_bot": False, "first_name": "U"},
+    }}, bot)
+
+
+async def run_updates(updates_of, handler, limit: int = 16):
+    application = (ApplicationBuilder().token("1:TEST").updater(None)
+                   .request(FakeBotAPI()).get_updates_request(FakeBotAPI())
+                   .concurrent_updates(main.PerChatUpdateProcessor(limit)).build())
+    updates = updates_of(application.bot)
+    handled = []
+    finished = asyncio.Event()
+
+    async def counted(update, context):
+        try:
+            await handler(update, context)
+        finally:
+            handled.append(update)
+            if len(handled) == len(updates):
+                finished.set()
+
+    application.add_handler(TypeHandler(Update, counted))
+    async with application:
+        await application.start()
+        try:
+            for update in updates:
+                await application.update_queue.put(update)
+            await asyncio.wait_for(finished.wait(), 10)
+        finally:
+            await application.stop()
+
+
+def test_updates_of_one_chat_run_in_order_one_at_a_time():
+    events = []
+
+    async def handler(update, context):
+        events.append(("start", update.update_id))
+        # Ранние обновления дольше: при параллельной обработке порядок бы сбился
+        await asyncio.sleep(0.01 * (10 - update.update_id))
+        events.append(("end", update.update_id))
+
+    asyncio.run(run_updates(lambda bot: [message_update(i, 42, bot) for i in range(10)], handler))
+    assert events == [(kind, i) for i in range(10) for kind in ("start", "end")]
+
+
+def test_different_chats_are_processed_concurrently():
+    active = 0
+    peak = 0
+    done = []
+
+    async def handler(update, context):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.2)
+        active -= 1
+        done.append(update.effective_chat.id)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await run_updates(lambda bot: [message_update(i, chat, bot) for i, chat in enumerate((1, 2, -3, 4))],
+                          handler)
+        return loop.time() - started
+
+    elapsed = asyncio.run(scenario())
+    assert sorted(done) == [-3, 1, 2, 4]
+    assert peak == 4
+    assert elapsed < 0.6
+
+
+def test_concurrency_is_capped_by_the_processor_limit():
+    active = 0
+    peak = 0
+
+    async def handler(update, context):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.05)
+        active -= 1
+
+    asyncio.run(run_updates(lambda bot: [message_update(i, i + 1, bot) for i in range(8)], handler, limit=2))
+    assert peak == 2